@@ -1,10 +1,57 @@
-from .abstract_experiment import AbstractExperiment
-from .abstract_controller import (AbstractController,
-                                  ApplyRevertControllerMixin, context_editor,
-                                  depends_on)
-from .abstract_data import AbstractData
-from .abstract_paradigm import AbstractParadigm
-from .evaluate import ParameterExpression, Expression
-
-from pkg_resources import resource_filename
-icon_dir = [resource_filename('experiment', 'icons')]
+'''
+The classes exported by this package are imported on first access.  This
+ensures that the core modules (e.g. `experiment.channel`,
+`experiment.coroutine`, `experiment.evaluate` and `experiment.abstract_data`)
+can be used in scripts without importing the GUI toolkit (i.e. `traitsui` and
+`pyface`), which is slow and requires a display.
+'''
+
+import importlib
+import os.path
+import sys
+import types
+
+icon_dir = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icons')]
+
+# Mapping of exported name to the module that defines it
+_exports = {
+    'AbstractExperiment': 'abstract_experiment',
+    'AbstractController': 'abstract_controller',
+    'ApplyRevertControllerMixin': 'abstract_controller',
+    'context_editor': 'abstract_experiment',
+    'get_context_editor': 'abstract_controller',
+    'depends_on': 'abstract_controller',
+    'AbstractData': 'abstract_data',
+    'AbstractParadigm': 'abstract_paradigm',
+    'ParameterExpression': 'evaluate',
+    'Expression': 'evaluate',
+}
+
+__all__ = ['icon_dir'] + sorted(_exports)
+
+
+class _LazyModule(types.ModuleType):
+
+    def __getattr__(self, name):
+        try:
+            module_name = _exports[name]
+        except KeyError:
+            raise AttributeError("'module' object has no attribute '{}'"
+                                 .format(name))
+        module = importlib.import_module('.' + module_name, __name__)
+        value = getattr(module, name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_exports))
+
+
+# Python 2 modules do not support __getattr__, so replace this module with an
+# instance of _LazyModule.  A reference to the original module must be kept
+# since its globals are cleared when it is garbage-collected.
+_module = sys.modules[__name__]
+_lazy_module = _LazyModule(__name__, __doc__)
+_lazy_module.__dict__.update(_module.__dict__)
+_lazy_module._original_module = _module
+sys.modules[__name__] = _lazy_module
@@ -6,12 +6,14 @@ log = logging.getLogger(__name__)
 
 from traits.api import (HasTraits, Dict, List, Any, Bool, on_trait_change, Int,
                         Enum)
-from traitsui.api import TabularEditor, Controller
-from traitsui.tabular_adapter import TabularAdapter
-from pyface.api import confirm, YES, error, FileDialog, OK
+# Only the handler module is needed to define the controller (the editors and
+# the GUI toolkit are imported when a view is built)
+from traitsui.handler import Controller
 
-from .evaluate import ExpressionNamespace
+from .evaluate import ExpressionNamespace, ParameterExpression
+from .evaluate.planner import TrialPlanner
 from . import util
+from .timing import PhaseTimer
 
 COLOR_NAMES = {
     'light green': '#98FB98',
@@ -41,25 +43,47 @@ def depends_on(*dependencies):
     return decorator
 
 
-class ContextAdapter(TabularAdapter):
+def _copy_expressions(expressions):
+    # The default values of the expressions are shared by all instances of the
+    # paradigm class, so each namespace needs its own copies (otherwise
+    # experiments running in the same process would share the generators).
+    return dict((k, v.copy() if isinstance(v, ParameterExpression) else v)
+                for k, v in expressions.items())
 
-    columns = ['Parameter', 'Value', 'Variable']
 
-    def get_image(self, obj, trait, row, column):
-        if column == 0 and self.item[-2]:
-            return '@icons:tuple_node'
+_context_editor = None
 
-    def get_width(self, obj, trait, column):
-        return 100
 
-    def get_bg_color(self, obj, trait, row, column=0):
-        if self.item is not None and self.item[-1]:
-            return COLOR_NAMES['light green']
-        else:
-            return COLOR_NAMES['white']
+def get_context_editor():
+    '''
+    Return the editor for `current_context_list` (created on first use so that
+    `traitsui.api` is only imported when a view is built)
+    '''
+    global _context_editor
+    if _context_editor is None:
+        from traitsui.api import TabularEditor
+        from traitsui.tabular_adapter import TabularAdapter
+
+        class ContextAdapter(TabularAdapter):
+
+            columns = ['Parameter', 'Value', 'Variable']
 
+            def get_image(self, obj, trait, row, column):
+                if column == 0 and self.item[-2]:
+                    return '@icons:tuple_node'
 
-context_editor = TabularEditor(adapter=ContextAdapter(), editable=False)
+            def get_width(self, obj, trait, column):
+                return 100
+
+            def get_bg_color(self, obj, trait, row, column=0):
+                if self.item is not None and self.item[-1]:
+                    return COLOR_NAMES['light green']
+                else:
+                    return COLOR_NAMES['white']
+
+        _context_editor = TabularEditor(adapter=ContextAdapter(),
+                                        editable=False)
+    return _context_editor
 
 
 class ApplyRevertControllerMixin(HasTraits):
@@ -94,6 +118,72 @@ class ApplyRevertControllerMixin(HasTraits):
 
     extra_context = Dict
 
+    # Formatted rows of current_context_list keyed by parameter name
+    _context_rows = Dict
+
+    # Number of upcoming trials to evaluate in advance (see `plan_trials`,
+    # which is called after each trial is logged).  Set to 0 to disable
+    # planning.
+    lookahead = Int(0)
+    planner = Any
+
+    # Incremented each time the shadow paradigm is updated (i.e. when changes
+    # are applied).  Used to cache the expression strings that are saved to the
+    # trial log.
+    paradigm_revision = Int(0)
+    _log_cache = Any
+
+    # If set (e.g. by `TrialEngine`), updates to `current_context_list` are
+    # posted to the updater so that they are run on the GUI thread.  Traits
+    # that the GUI listens to (e.g. `state` and `current_trial`) must be set
+    # using `set_gui_trait` so that their listeners also run on the GUI thread.
+    # The updater is shared with the data (see `AbstractData.gui_updater`).
+    gui_updater = Any
+
+    # Time spent in each phase of the trial (see `PhaseTimer`).  The time spent
+    # drawing values from sequences (select) and calling the `set_<name>`
+    # methods (notify) is excluded from the time spent evaluating the context.
+    # Subclasses can time additional phases, e.g. by wrapping the hardware
+    # setup in `with self.trial_timer.phase('hardware'):` and adding 'hardware'
+    # to `timed_phases`.  If `log_phase_times` is True, the durations of the
+    # timed phases are saved in the trial log as `time_<phase>` (except for
+    # `log_trial` which is still running when the trial is saved).
+    timed_phases = ['refresh_context', 'evaluate', 'select', 'notify', 'plan',
+                    'log_trial']
+    log_phase_times = False
+    trial_timer = Any
+
+    def _trial_timer_default(self):
+        return PhaseTimer(self.timed_phases)
+
+    def _gui_updater_changed(self, gui_updater):
+        data = getattr(self.model, 'data', None)
+        if data is not None:
+            data.gui_updater = gui_updater
+
+    def set_gui_trait(self, name, value):
+        '''
+        Set the trait and notify its listeners on the GUI thread
+
+        The new value can be read immediately.  If `gui_updater` is set, the
+        listeners are notified when the GUI runs the pending updates (only once
+        if the trait is set several times before then).
+        '''
+        if self.gui_updater is None:
+            setattr(self, name, value)
+            return
+        old = getattr(self, name)
+        self.trait_setq(**{name: value})
+        self.gui_updater.post((id(self), name), self.trait_property_changed,
+                              name, old, value)
+
+    def get_phase_summary(self, percentiles=(50, 90, 99)):
+        '''
+        Return the summary of the time spent in each phase per trial (see
+        `PhaseTimer.summary`)
+        '''
+        return self.trial_timer.summary(percentiles)
+
     def is_running(self):
         raise NotImplementedError
 
@@ -137,15 +227,19 @@ class ApplyRevertControllerMixin(HasTraits):
             next trial begins.
         '''
         log.debug('Refreshing context')
-        if extra_context is not None:
-            for k, v in extra_context.items():
-                self.set_current_value(k, v)
-        else:
-            extra_context = {}
-        extra_context.update(self.gather_extra_context())
-        self.namespace.reset_values(extra_context)
-        if evaluate:
-            self.evaluate_pending_expressions()
+        with self.trial_timer.phase('refresh_context'):
+            if extra_context is not None:
+                for k, v in extra_context.items():
+                    self.set_current_value(k, v)
+            else:
+                extra_context = {}
+            extra_context.update(self.gather_extra_context())
+            self.namespace.reset_values(extra_context)
+            if self.planner is not None and \
+                    self.planner.commit(extra_context):
+                self.namespace._notify()
+            if evaluate:
+                self.evaluate_pending_expressions()
 
     def get_extra_context(self):
         return self.extra_context
@@ -168,20 +262,32 @@ class ApplyRevertControllerMixin(HasTraits):
             # evaluation passes, we will make the assumption that the
             # expressions are valid as entered.  However, this will *not* catch
             # all edge cases or situations where actually applying the change
-            # causes an error.
-            pending_expressions = self.model.paradigm.trait_get(context=True)
+            # causes an error.  Only the expressions that differ from the
+            # shadow copy (and the ones that depend on them) need to be
+            # checked.
+            changed = self._get_changed_traits()
+            if not changed:
+                # Note that copy_traits copies all traits if the list is empty
+                self.set_gui_trait('pending_changes', False)
+                return
+            context_names = self.model.paradigm.trait_names(context=True)
+            pending_expressions = self.model.paradigm.trait_get(
+                [n for n in changed if n in context_names])
             extra_context = self.gather_extra_context()
 
-            ns = ExpressionNamespace(pending_expressions, extra_context,
-                                     controller=self)
-            ns.evaluate_values(dry_run=True)
+            ns, affected = self.namespace.replace_expressions(
+                _copy_expressions(pending_expressions), extra_context)
+            ns.validate(affected)
 
             # If we've made it this far, then let's go ahead and copy the
             # changes over to our shadow_paradigm.  We'll apply the requested
             # changes immediately if a trial is not currently running.
-            self.shadow_paradigm.copy_traits(self.model.paradigm)
-            self.pending_changes = False
+            self.shadow_paradigm.copy_traits(self.model.paradigm,
+                                             traits=changed)
+            self.paradigm_revision += 1
+            self.set_gui_trait('pending_changes', False)
             self.namespace = ns
+            self._create_planner()
 
             # Subclasses need to define this function (e.g.
             # abstract_positive_controller and abstract_aversive_controller)
@@ -201,8 +307,24 @@ class ApplyRevertControllerMixin(HasTraits):
             import textwrap
             mesg = textwrap.dedent(mesg).strip().replace('\n', ' ')
             mesg += '\n\nError message: ' + str(e)
+            from pyface.api import error
             error(info.ui.control, message=mesg, title='Error applying changes')
 
+    def _get_changed_traits(self):
+        '''
+        Return names of the paradigm traits that differ from the shadow copy
+        '''
+        changed = []
+        shadow = self.shadow_paradigm
+        for name, value in self.model.paradigm.trait_get().items():
+            try:
+                if not bool(getattr(shadow, name) == value):
+                    changed.append(name)
+            except Exception:
+                # e.g. comparison of arrays with more than one element
+                changed.append(name)
+        return changed
+
     def context_updated(self):
         '''
         This can be overriden in subclasses to implement logic for updating the
@@ -216,7 +338,7 @@ class ApplyRevertControllerMixin(HasTraits):
         '''
         log.debug('Reverting requested changes')
         self.model.paradigm.copy_traits(self.shadow_paradigm)
-        self.pending_changes = False
+        self.set_gui_trait('pending_changes', False)
 
     def get_current_value(self, name):
         '''
@@ -228,9 +350,9 @@ class ApplyRevertControllerMixin(HasTraits):
         try:
             return self.namespace._context[name]
         except KeyError:
-            extra_context = self.gather_extra_context()
-            value = self.namespace.evaluate_value(name, extra_context)
-            return value
+            with self.trial_timer.phase('evaluate'):
+                extra_context = self.gather_extra_context()
+                return self.namespace.evaluate_value(name, extra_context)
 
     def set_current_value(self, name, value):
         log.debug('Setting current value for %s to %r', name, value)
@@ -249,25 +371,89 @@ class ApplyRevertControllerMixin(HasTraits):
         precedence.
         '''
         log.debug('Evaluating pending expressions')
-        if extra_context is None:
-            extra_context = {}
-        extra_context.update(self.gather_extra_context())
-        result = self.namespace.evaluate_values(extra_context)
-        return result
+        with self.trial_timer.phase('evaluate'):
+            if extra_context is None:
+                extra_context = {}
+            extra_context.update(self.gather_extra_context())
+            return self.namespace.evaluate_values(extra_context)
+
+    def _create_planner(self):
+        if self.lookahead:
+            self.planner = TrialPlanner(self.namespace, self.lookahead)
+        else:
+            self.planner = None
+
+    def _lookahead_changed(self):
+        if getattr(self, 'namespace', None) is not None:
+            self._create_planner()
+
+    def plan_trials(self):
+        '''
+        Evaluate the context of the upcoming trials in advance
+
+        This is called by `log_trial` when `lookahead` is set.  It can also be
+        called whenever the controller is otherwise idle (e.g. once the current
+        trial has started).  The planned context is used by the next call to
+        `refresh_context` provided the extra context has not changed (e.g. due
+        to the outcome of the current trial) and no other values were
+        evaluated in the meantime.  Otherwise, the context is evaluated as
+        usual.
+        '''
+        if self.planner is not None:
+            with self.trial_timer.phase('plan'):
+                self.planner.plan(self.gather_extra_context())
+
+    def _format_context_row(self, name, value, changed):
+        label = self.context_labels.get(name, '')
+        log = self.context_log[name]
+        if type(value) in ((type([]), type(()))):
+            str_value = ', '.join('{}'.format(v) for v in value)
+            str_value = '[{}]'.format(str_value)
+        else:
+            str_value = '{}'.format(value)
+        return (name, str_value, label, log, changed)
 
     def _update_current_context_list(self):
-        context = []
-        for name, value in self.namespace._context.items():
-            label = self.context_labels.get(name, '')
+        # Rows are cached along with the value they were formatted from so that
+        # only the rows whose values changed are reformatted and replaced (the
+        # table editor only needs to refresh the replaced rows).
+        cache = self._context_rows
+        context = self.namespace._context
+        rows = []
+        updated = []
+        for name in sorted(context):
+            value = context[name]
             changed = self.namespace.value_changed(name)
-            log = self.context_log[name]
-            if type(value) in ((type([]), type(()))):
-                str_value = ', '.join('{}'.format(v) for v in value)
-                str_value = '[{}]'.format(str_value)
+            entry = cache.get(name)
+            if entry is None or entry[0] is not value or \
+                    entry[1][-1] != changed:
+                row = self._format_context_row(name, value, changed)
+                cache[name] = value, row
+                updated.append(len(rows))
             else:
-                str_value = '{}'.format(value)
-            context.append((name, str_value, label, log, changed))
-        self.current_context_list = sorted(context)
+                row = entry[1]
+            rows.append(row)
+
+        for name in set(cache) - set(context):
+            del cache[name]
+        if self.gui_updater is not None:
+            # Updates may be coalesced, so all rows are compared when the
+            # update is run.
+            self.gui_updater.post((id(self), 'current_context_list'),
+                                  self._set_context_rows, rows,
+                                  range(len(rows)))
+        else:
+            self._set_context_rows(rows, updated)
+
+    def _set_context_rows(self, rows, updated):
+        current = self.current_context_list
+        if len(current) == len(rows) and \
+                all(c[0] == r[0] for c, r in zip(current, rows)):
+            for i in updated:
+                if current[i] != rows[i]:
+                    current[i] = rows[i]
+        else:
+            self.current_context_list = rows
 
     def _add_context(self, instance):
         for name, trait in instance.traits(context=True).items():
@@ -294,23 +480,64 @@ class ApplyRevertControllerMixin(HasTraits):
             pass
 
         self.shadow_paradigm = self.model.paradigm.clone_traits()
+        self.paradigm_revision += 1
         expressions = self.shadow_paradigm.trait_get(context=True)
+        expressions = _copy_expressions(expressions)
         extra_context = self.gather_extra_context()
         self.namespace = ExpressionNamespace(expressions, extra_context,
                                              controller=self)
+        self._create_planner()
+
+    def _get_log_cache(self):
+        '''
+        Return the expression strings, names of the logged context values and
+        names of the logged controller traits for the current revision of the
+        paradigm
+        '''
+        cache = self._log_cache
+        if cache is None or cache[0] != self.paradigm_revision:
+            log.debug('Caching expressions for paradigm revision %d',
+                      self.paradigm_revision)
+            expressions = self.shadow_paradigm.trait_get(context=True)
+            expressions = dict(('expression_{}'.format(k), '{}'.format(v))
+                               for k, v in expressions.items())
+            logged = [k for k, v in self.context_log.items() if v]
+            cache = (self.paradigm_revision, expressions, logged,
+                     self.trait_names(log=True))
+            self._log_cache = cache
+        return cache
 
     def log_trial(self, **kwargs):
         '''
         Add entry to trial log table
+
+        This also ends the trial for `trial_timer`.
         '''
         log.debug('Logging trial')
-        for key, value in self.context_log.items():
-            if value:
+        with self.trial_timer.phase('log_trial'):
+            self._log_trial(kwargs)
+        self.trial_timer.end_trial()
+        # Planning counts towards the next trial
+        self.plan_trials()
+
+    def _log_trial(self, kwargs):
+        revision, expressions, logged, trait_names = self._get_log_cache()
+        # The logged values are normally already in the context of the current
+        # trial.
+        context = self.namespace._context
+        for key in logged:
+            try:
+                kwargs[key] = context[key]
+            except KeyError:
                 kwargs[key] = self.namespace.evaluate_value(key)
-        for key, value in self.shadow_paradigm.trait_get(context=True).items():
-            kwargs['expression_{}'.format(key)] = '{}'.format(value)
-        for key, value in self.trait_get(log=True).items():
-            kwargs[key] = value
+        kwargs.update(expressions)
+        for key in trait_names:
+            kwargs[key] = getattr(self, key)
+        if self.log_phase_times:
+            durations = self.trial_timer.durations
+            for name in self.timed_phases:
+                if name != 'log_trial':
+                    kwargs['time_{}'.format(name)] = durations.get(name, 0.0)
         self.model.data.log_trial(**kwargs)
 
     @classmethod
@@ -323,6 +550,9 @@ class ApplyRevertControllerMixin(HasTraits):
         dtypes = [(k, v.dtype) for k, v in traits.items()]
         if hasattr(cls, 'extra_dtypes'):
             dtypes.extend(cls.extra_dtypes)
+        if cls.log_phase_times:
+            dtypes.extend(('time_{}'.format(p), 'f8') for p in cls.timed_phases
+                          if p != 'log_trial')
         dtypes.sort()
         return dtypes
 
@@ -401,6 +631,7 @@ class AbstractController(ApplyRevertControllerMixin, Controller):
         # button (e.g. "no", "abort", etc.) is pressed, the return value will be
         # something other than YES and we will assume that the user has
         # requested not to quit the experiment.
+        from pyface.api import confirm, YES
         if confirm(info.ui.control, mesg) != YES:
             return False
         else:
@@ -418,17 +649,17 @@ class AbstractController(ApplyRevertControllerMixin, Controller):
         self.initialize_context()
         self.setup_experiment(info)
         self.start_experiment(info)
-        self.state = 'running'
+        self.set_gui_trait('state', 'running')
 
     def stop(self, info=None):
-        self.state = 'halted'
+        self.set_gui_trait('state', 'halted')
         self.stop_experiment()
 
     def pause(self, info=None):
         raise NotImplementedError
 
     def resume(self, info=None):
-        self.state = 'running'
+        self.set_gui_trait('state', 'running')
         self.pause_requested = False
         self.next_trial()
 
@@ -450,7 +681,7 @@ class AbstractController(ApplyRevertControllerMixin, Controller):
         '''
         raise NotImplementedError
         self.refresh_context()
-        self.current_trial += 1
+        self.set_gui_trait('current_trial', self.current_trial+1)
 
     def setup_experiment(self, info=None):
         '''
@@ -461,7 +692,7 @@ class AbstractController(ApplyRevertControllerMixin, Controller):
         Often you may need to override this method initialize hardware.
         '''
         self.register_dtypes()
-        self.state = 'initialized'
+        self.set_gui_trait('state', 'initialized')
 
     def start_experiment(self, info=None):
         '''
@@ -480,6 +711,7 @@ class AbstractController(ApplyRevertControllerMixin, Controller):
             self.model.data.save()
 
     def save_paradigm(self, path, wildcard, info=None):
+        from pyface.api import FileDialog, OK
         wildcard_base = wildcard.split('|')[1][1:]
         fd = FileDialog(action='save as', default_directory=path,
                         wildcard=wildcard)
@@ -489,6 +721,7 @@ class AbstractController(ApplyRevertControllerMixin, Controller):
             self.model.paradigm.write_json(fd.path)
 
     def load_paradigm(self, path, wildcard, info=None):
+        from pyface.api import FileDialog, OK
         fd = FileDialog(action='open', default_directory=path,
                         wildcard=wildcard)
         if fd.open() == OK and fd.path:
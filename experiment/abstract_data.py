@@ -1,9 +1,15 @@
 import logging
 log = logging.getLogger(__name__)
 
+import threading
+from functools import partial
+
 import numpy as np
-from traits.api import Any, Event, HasTraits, Property, cached_property
-from traitsui.api import View
+from traits.api import (Any, Event, HasTraits, Property, cached_property, Int,
+                        Float, Dict, List, Str, Bool)
+
+from .buffered_table import BufferedTable, EventLog, _NULL_LOCK
+from .trial_summary import TrialColumns
 
 
 class AbstractData(HasTraits):
@@ -14,8 +20,58 @@ class AbstractData(HasTraits):
     trial_log = Any
     event_log_updated = Event
     trial_log_updated = Event
+
+    # If set (see `AbstractController.gui_updater`), the `event_log_updated` and
+    # `trial_log_updated` events are fired on the GUI thread.  The events are
+    # queued until the GUI runs the pending updates and are then fired in
+    # order (once per record).
+    gui_updater = Any
     trial_log_dtype = Any
 
+    # Trials are appended to the trial log in batches (see `BufferedTable`).
+    # The buffer is also flushed when the data is saved.  The flush interval is
+    # only checked when a row is appended, so rows logged before the session
+    # goes idle stay in the buffer until the next row, `flush_logs` or `save`
+    # (or the next flush by `experiment.rig.SharedWriter`).
+    trial_log_batch_size = Int(16)
+    trial_log_flush_interval = Float(10)
+
+    # Events are also appended in batches.  The most recent events are kept in
+    # memory and can be queried (e.g. `event_log.query(start, end, 'lick')`)
+    # without reading the table.
+    event_log_batch_size = Int(256)
+    event_log_flush_interval = Float(5)
+    event_log_tail_size = Int(4096)
+
+    # Columns of the trial and event logs to create indexes for (to speed up
+    # `query_trials` and `query_events`).  Columns that are not in the table
+    # are ignored.
+    trial_log_indexes = List(Str)
+    event_log_indexes = List(Str, ['timestamp', 'name'])
+
+    # In-memory copy of the trial log with one array per column (see
+    # `TrialColumns`) and the aggregates that are updated on each trial.  If
+    # the columns cannot grow (e.g. `memory_budget` is exhausted), they are
+    # discarded (set to None) and `get_column` reads the trial log instead.
+    trial_columns = Any
+    aggregates = Dict
+
+    # When several experiments run in the same process (see
+    # `experiment.rig`), access to HDF5 is serialized by a shared lock and the
+    # logs are flushed by a background writer rather than when a row is
+    # appended (i.e. the flush intervals are ignored).  The memory used by the
+    # buffers and `trial_columns` is reserved from `memory_budget` (if set
+    # before the tables are created).
+    hdf5_lock = Any
+    background_flush = Bool(False)
+    memory_budget = Any
+
+    def __init__(self, **traits):
+        # Events to fire on the GUI thread (see `gui_updater`)
+        self._pending_events = []
+        self._pending_lock = threading.Lock()
+        super(AbstractData, self).__init__(**traits)
+
     @cached_property
     def _get_fh(self):
         if self.store_node is not None:
@@ -24,35 +80,168 @@ class AbstractData(HasTraits):
     def register_dtypes(self, dtypes):
         description = np.dtype(dtypes)
         self.trial_log_description = description
-        self.trial_log = self.fh.create_table(self.store_node, 'trial_log',
-                                              description)
+        table = self.fh.create_table(self.store_node, 'trial_log', description)
+        self._create_indexes(table, self.trial_log_indexes)
+        nbytes = self.trial_log_batch_size*description.itemsize
+        self._reserve('trial_log', nbytes)
+        self.trial_log = BufferedTable(table, self.trial_log_batch_size,
+                                       self._flush_interval('trial_log'),
+                                       self.hdf5_lock)
+        self.trial_columns = TrialColumns(
+            description, reserve=partial(self._reserve, 'trial_columns'))
+        for aggregate in self.aggregates.values():
+            aggregate.reset()
+
+    def _flush_interval(self, name):
+        if self.background_flush:
+            return None
+        return getattr(self, name + '_flush_interval')
+
+    def _reserve(self, name, nbytes):
+        if self.memory_budget is not None:
+            self.memory_budget.reserve((id(self), name), nbytes)
+
+    def release_memory(self):
+        '''
+        Release the memory reserved from `memory_budget`
+        '''
+        if self.memory_budget is not None:
+            for name in ('trial_log', 'trial_columns', 'event_log'):
+                self.memory_budget.release((id(self), name))
+
+    def _logs(self):
+        # Don't create the event log if no events were logged
+        if self.trial_log is not None:
+            yield self.trial_log
+        if 'event_log' in self.__dict__:
+            yield self.event_log
+
+    def _hdf5_lock_changed(self, lock):
+        for table in self._logs():
+            table.lock = _NULL_LOCK if lock is None else lock
+
+    def _background_flush_changed(self):
+        if self.trial_log is not None:
+            self.trial_log.flush_interval = self._flush_interval('trial_log')
+        if 'event_log' in self.__dict__:
+            self.event_log.flush_interval = self._flush_interval('event_log')
+
+    def _create_indexes(self, table, columns):
+        for column in columns:
+            if column in table.colnames:
+                log.debug('Creating index for %s.%s', table.name, column)
+                table.cols._f_col(column).create_index()
+            else:
+                log.debug('No column %s in %s to index', column, table.name)
+
+    def query_trials(self, condition, columns=None, condvars=None):
+        '''
+        Return the trials matching the condition (e.g. "(ttype == 'GO') &
+        (level > 20)") as a structured array
+
+        See `BufferedTable.select` for details.
+        '''
+        return self.trial_log.select(condition, columns, condvars)
+
+    def query_events(self, condition, columns=None, condvars=None):
+        '''
+        Return the events matching the condition (e.g. "(name == 'lick') &
+        (timestamp > t0)" with `condvars={'t0': t0}`) as a structured array
+
+        To search only the recent events, use `event_log.query` instead, which
+        does not read the table.
+        '''
+        return self.event_log.select(condition, columns, condvars)
+
+    def register_aggregate(self, name, aggregate):
+        '''
+        Add an aggregate (see `experiment.trial_summary`) that is updated each
+        time a trial is logged
+
+        Trials that have already been logged are included.
+        '''
+        if self.trial_log is not None:
+            for record in self.trial_log.read():
+                aggregate.update(record)
+        self.aggregates[name] = aggregate
+
+    def get_column(self, name):
+        '''
+        Return the values of the column in the trial log as an array (without
+        reading the table)
+        '''
+        if self.trial_columns is None:
+            return self.trial_log.col(name)
+        return self.trial_columns[name]
 
     def _event_log_default(self):
         dtype = [('timestamp', 'f'), ('name', 'S64')]
         description = np.dtype(dtype)
         node = self.fh.create_table(self.store_node, 'event_log', description)
-        return node
+        self._create_indexes(node, self.event_log_indexes)
+        nbytes = (self.event_log_batch_size+self.event_log_tail_size) * \
+            description.itemsize
+        self._reserve('event_log', nbytes)
+        return EventLog(node, self.event_log_batch_size,
+                        self._flush_interval('event_log'),
+                        self.event_log_tail_size, self.hdf5_lock)
+
+    def _fire(self, name, value):
+        if self.gui_updater is None:
+            setattr(self, name, value)
+            return
+        with self._pending_lock:
+            self._pending_events.append((name, value))
+        self.gui_updater.post((id(self), 'events'), self._fire_pending)
+
+    def _fire_pending(self):
+        with self._pending_lock:
+            pending = self._pending_events
+            self._pending_events = []
+        for name, value in pending:
+            setattr(self, name, value)
 
     def log_event(self, timestamp, event):
-        # The append() method of a tables.Table class requires a list of rows
-        # (i.e. records) to append to the table.  Since we only append a single
-        # row at a time, we need to nest it as a list that contains a single
-        # record.
-        self.event_log.append([(timestamp, event)])
-        self.event_log_updated = (timestamp, event)
+        self.event_log.log(timestamp, event)
+        self._fire('event_log_updated', (timestamp, event))
+
+    def _append_columns(self, record):
+        # The trial is already in the log, so running out of memory must not
+        # interrupt the trial.
+        try:
+            self.trial_columns.append(record)
+        except MemoryError, e:
+            log.warning('Discarding the in-memory trial columns: %s', e)
+            self.trial_columns = None
+            if self.memory_budget is not None:
+                self.memory_budget.release((id(self), 'trial_columns'))
 
     def log_trial(self, **kwargs):
-        # Create the record with appropriate names for the columns then convert
-        # to the order needed for the trial log
-        record = np.rec.fromrecords([kwargs.values()], names=kwargs.keys())
-        record = record.astype(self.trial_log_description)
-        self.trial_log.append(record)
-        self.trial_log_updated = record
+        # Columns that are not provided are left as zero and values without a
+        # column are dropped.
+        record = self.trial_log.append_row(kwargs)
+        if self.trial_columns is not None:
+            self._append_columns(record[0])
+        for aggregate in self.aggregates.values():
+            aggregate.update(record[0])
+        self._fire('trial_log_updated', record.view(np.recarray))
         return len(self.trial_log)
 
+    def flush_logs(self):
+        '''
+        Append the buffered trials and events to their tables
+        '''
+        for table in self._logs():
+            table.flush()
+
     def save(self, **kwargs):
-        for name, value in kwargs.items():
-            self.store_node._f_setAttr(name, value)
-        self.fh.flush()
+        with self.hdf5_lock or _NULL_LOCK:
+            self.flush_logs()
+            for name, value in kwargs.items():
+                self.store_node._f_setAttr(name, value)
+            self.fh.flush()
 
-    traits_view = View()
+    def default_traits_view(self):
+        # Imported here so that the GUI toolkit is only loaded when needed
+        from traitsui.api import View
+        return View()
@@ -0,0 +1,339 @@
+'''
+Buffered writes to PyTables tables
+
+Appending a single row to a table is relatively expensive (each call converts
+the row and updates the table on disk).  `BufferedTable` collects rows in a
+preallocated structured array and appends them to the table in batches.
+
+Reads go through the buffer as well, so the rows that have not been written yet
+are still visible to code reading the table:
+
+* `len`, indexing, slicing, iteration, `read` and `col` combine the rows in the
+  table with the buffered rows.
+* `select` and any other attribute (e.g. `cols` or `read_where`) are looked
+  up on the underlying table after flushing the buffer.
+
+`EventLog` additionally keeps the most recent events in memory so that they
+can be queried by time and name without reading from the table.
+
+If a lock is provided, each method holds the lock while accessing the buffer
+or the table.  Tables in different files can then be written to from several
+threads (e.g. by `experiment.rig.SharedWriter`) since all access to HDF5 is
+serialized.
+'''
+
+import logging
+log = logging.getLogger(__name__)
+
+import numpy as np
+
+from .timing import clock
+
+
+class _NullLock(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_LOCK = _NullLock()
+
+
+class BufferedTable(object):
+    '''
+    Wraps a table so that rows are appended in batches
+
+    Parameters
+    ----------
+    table : tables.Table
+        Table to append rows to.
+    batch_size : int
+        Number of rows to buffer before appending them to the table.
+    flush_interval : {None, float}
+        If not None, the buffer is also flushed when a row is appended and the
+        buffer was last flushed more than this many seconds ago.
+    lock : {None, lock}
+        Lock to hold while accessing the buffer or the table (must be
+        reentrant).
+    '''
+
+    def __init__(self, table, batch_size=16, flush_interval=None, lock=None):
+        self.table = table
+        self.lock = _NULL_LOCK if lock is None else lock
+        self.dtype = table.dtype
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = np.zeros(batch_size, dtype=self.dtype)
+        self._n = 0
+        self._last_flush = clock()
+
+        # Precompute the order of the fields and the value to use for fields
+        # that are not provided.
+        self._names = self.dtype.names
+        self._name_set = frozenset(self._names)
+        self._defaults = self._buffer[0].item()
+        # Sets of keys that did not match the fields (warned about once)
+        self._mismatched = set()
+
+    def append_row(self, values):
+        '''
+        Append a row to the buffer and return it
+
+        Parameters
+        ----------
+        values : dict
+            Mapping of field name to value.  Fields that are not provided are
+            set to zero (or an empty string) and values that do not correspond
+            to a field are ignored.  A warning is logged the first time each
+            set of keys that does not match the fields is appended.
+
+        Returns
+        -------
+        row : array
+            Copy of the row (as a structured array with a single element).
+        '''
+        if values.viewkeys() != self._name_set:
+            self._check_keys(values)
+        record = tuple(values.get(n, d) for n, d in zip(self._names,
+                                                        self._defaults))
+        self.append_record(record)
+        return np.array([record], dtype=self.dtype)
+
+    def _check_keys(self, values):
+        keys = frozenset(values)
+        if keys in self._mismatched:
+            return
+        self._mismatched.add(keys)
+        missing = sorted(self._name_set - keys)
+        unknown = sorted(keys - self._name_set)
+        if missing:
+            log.warning('No value for %s in %s (saved as zero)',
+                        ', '.join(missing), self.table.name)
+        if unknown:
+            log.warning('No column for %s in %s (not saved)',
+                        ', '.join(unknown), self.table.name)
+
+    def append_record(self, record):
+        '''
+        Append a row, provided as a tuple of values in field order, to the
+        buffer
+        '''
+        with self.lock:
+            self._buffer[self._n] = record
+            self._n += 1
+            if self._n == self.batch_size:
+                self.flush()
+            elif self.flush_interval is not None and \
+                    (clock()-self._last_flush) >= self.flush_interval:
+                self.flush()
+
+    def append(self, rows):
+        '''
+        Append a sequence of rows (e.g. a structured array) to the table
+
+        Pending rows are flushed first to preserve the order.
+        '''
+        with self.lock:
+            self.flush()
+            self.table.append(rows)
+
+    def flush(self):
+        '''
+        Append the buffered rows to the table
+        '''
+        with self.lock:
+            if self._n:
+                log.debug('Flushing %d rows to %s', self._n, self.table.name)
+                self.table.append(self._buffer[:self._n])
+                self._n = 0
+            self._last_flush = clock()
+
+    @property
+    def pending(self):
+        '''
+        Number of rows that have not been appended to the table yet
+        '''
+        return self._n
+
+    def __len__(self):
+        with self.lock:
+            return self.table.nrows + self._n
+
+    @property
+    def nrows(self):
+        return len(self)
+
+    def read(self, start=None, stop=None, field=None):
+        '''
+        Read rows from the table and the buffer (arguments are the same as
+        `slice` except that the step must be 1)
+        '''
+        with self.lock:
+            start, stop, step = slice(start, stop).indices(len(self))
+            n_table = self.table.nrows
+            parts = []
+            if start < n_table:
+                parts.append(self.table.read(start, min(stop, n_table),
+                                             field=field))
+            if stop > n_table:
+                lb = max(start-n_table, 0)
+                buffered = self._buffer[lb:stop-n_table]
+                if field is not None:
+                    buffered = buffered[field]
+                parts.append(buffered.copy())
+        if not parts:
+            dtype = self.dtype if field is None else self.dtype[field]
+            return np.empty(0, dtype=dtype)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def col(self, name):
+        return self.read(field=name)
+
+    def select(self, condition, columns=None, condvars=None):
+        '''
+        Return the rows matching the condition
+
+        The buffer and the table are flushed first so that the condition can
+        be evaluated by PyTables (the column indexes, if any, are only updated
+        when the table is flushed).
+
+        Parameters
+        ----------
+        condition : str
+            Condition in the syntax used by `tables.Table.where` (e.g.
+            "(ttype == 'GO') & (level > 20)").  Note that comparisons must be
+            enclosed in parentheses when combined with `&` or `|`.
+        columns : {None, list of str}
+            Columns to return.  If None, all columns are returned.  Only the
+            requested columns are read from the table.
+        condvars : {None, dict}
+            Values of variables referenced by the condition that are not
+            columns.
+
+        Returns
+        -------
+        rows : array
+            Structured array containing the requested columns.
+        '''
+        with self.lock:
+            self.flush()
+            self.table.flush()
+            if columns is None:
+                return self.table.read_where(condition, condvars)
+            coords = self.table.get_where_list(condition, condvars)
+            dtype = np.dtype([(c, self.dtype.fields[c][0]) for c in columns])
+            rows = np.empty(len(coords), dtype=dtype)
+            for column in columns:
+                rows[column] = self.table.read_coordinates(coords, field=column)
+            return rows
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                return self.read()[key]
+            return self.read(key.start, key.stop)
+        if isinstance(key, (int, long, np.integer)):
+            with self.lock:
+                n = len(self)
+                if key < 0:
+                    key += n
+                if not 0 <= key < n:
+                    raise IndexError('Index out of range')
+                n_table = self.table.nrows
+                if key < n_table:
+                    return self.table[key]
+                return self._buffer[key-n_table].copy()
+        return self.read()[key]
+
+    def __iter__(self):
+        return iter(self.read())
+
+    def __getattr__(self, name):
+        # Called only for attributes not defined on this class
+        if name.startswith('_'):
+            raise AttributeError(name)
+        with self.lock:
+            self.flush()
+            return getattr(self.table, name)
+
+
+class EventLog(BufferedTable):
+    '''
+    Buffered table of events that keeps the most recent events in memory
+
+    The table must have `timestamp` and `name` fields.
+
+    Parameters
+    ----------
+    table : tables.Table
+        Table to append events to.
+    tail_size : int
+        Number of recent events to keep in memory for `query`.
+    batch_size, flush_interval, lock
+        See `BufferedTable`.
+    '''
+
+    def __init__(self, table, batch_size=256, flush_interval=None,
+                 tail_size=4096, lock=None):
+        super(EventLog, self).__init__(table, batch_size, flush_interval, lock)
+        self._tail = np.zeros(tail_size, dtype=self.dtype)
+        self._count = 0
+
+    def append_record(self, record):
+        with self.lock:
+            self._tail[self._count % len(self._tail)] = record
+            self._count += 1
+            super(EventLog, self).append_record(record)
+
+    def log(self, timestamp, name):
+        self.append_record((timestamp, name))
+
+    def get_tail(self):
+        '''
+        Return the recent events in the order they were logged
+        '''
+        with self.lock:
+            size = len(self._tail)
+            if self._count <= size:
+                return self._tail[:self._count].copy()
+            i = self._count % size
+            return np.concatenate((self._tail[i:], self._tail[:i]))
+
+    def query(self, start=None, end=None, name=None):
+        '''
+        Return the recent events with start <= timestamp < end
+
+        Only the events still held in memory (see `tail_size`) are searched.
+
+        Parameters
+        ----------
+        start : {None, float}
+            If None, there is no lower bound.
+        end : {None, float}
+            If None, there is no upper bound.
+        name : {None, str, list of str}
+            Only return events with this name (or one of these names).
+        '''
+        events = self.get_tail()
+        mask = np.ones(len(events), dtype=bool)
+        if start is not None:
+            mask &= events['timestamp'] >= start
+        if end is not None:
+            mask &= events['timestamp'] < end
+        if name is not None:
+            if isinstance(name, basestring):
+                mask &= events['name'] == name
+            else:
+                mask &= np.in1d(events['name'], name)
+        return events[mask]
+
+    def count(self, start=None, end=None, name=None):
+        '''
+        Number of recent events matching the query (see `query`)
+        '''
+        return len(self.query(start, end, name))
@@ -1,9 +1,20 @@
 import logging
 log = logging.getLogger(__name__)
 
+import sys
 import time
+import threading
+import traceback
+import Queue
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from collections import OrderedDict
+from functools import wraps, partial
+
 import numpy as np
 
+from .timing import clock, LatencyStats
+
 '''
 Generators and Coroutines
 -------------------------
@@ -19,6 +30,7 @@ http://www.python.org/dev/peps/pep-0342/
 ################################################################################
 def coroutine(func):
     '''Decorator to auto-start a coroutine.'''
+    @wraps(func)
     def start(*args, **kwargs):
         cr = func(*args, **kwargs)
         cr.next()
@@ -26,16 +38,609 @@ def coroutine(func):
     return start
 
 
-def create_pipeline(*args):
-    current = args[-1]
+def create_pipeline(*args, **kwargs):
+    '''
+    Chain the stages together, returning the first stage of the pipeline
+
+    Each stage (except the last one) must be a callable that accepts the
+    downstream target as its final argument (e.g., a `functools.partial` of one
+    of the coroutines defined below).  The last stage may either be a callable
+    that takes no arguments or an already-initialized sink.
+
+    Parameters
+    ----------
+    concurrency : {None, 'threaded', sequence of int}
+        If None, all stages run synchronously in the thread that calls `send`.
+        If 'threaded', every stage runs on its own thread.  If a sequence of
+        integers, only the stages at those positions in the argument list run
+        on their own thread.  See `threaded`.
+    maxsize : int
+        Maximum number of blocks queued for each threaded stage.
+    overflow : {'block', 'drop', 'error'}
+        Backpressure policy for threaded stages.  See `ThreadedStage`.
+    stats : {None, PipelineStats}
+        If provided, each stage is instrumented and its statistics are
+        collected by `stats`.  If None, the stages are not wrapped at all.
+    fuse : bool
+        If True, replace adjacent stages that have a fused equivalent (e.g.
+        `blocked`, `rms` and `db`) with the fused stage (e.g. `block_rms_db`).
+        Only stages provided as a `functools.partial` of the coroutines defined
+        in this module are recognized.  Fusion changes the stages of the
+        pipeline (and hence the statistics collected by `stats`), so it is off
+        by default.
+    '''
+    concurrency = kwargs.pop('concurrency', None)
+    maxsize = kwargs.pop('maxsize', 0)
+    overflow = kwargs.pop('overflow', 'block')
+    stats = kwargs.pop('stats', None)
+    fuse = kwargs.pop('fuse', False)
+    if kwargs:
+        mesg = 'Unexpected keyword arguments: {}'.format(', '.join(kwargs))
+        raise TypeError(mesg)
+
+    stages = list(args)
+    threaded_stages = _threaded_stages(concurrency, len(stages))
+    if fuse:
+        stages, threaded_stages = fuse_stages(stages, threaded_stages)
+    for i in threaded_stages:
+        stages[i] = threaded(stages[i], maxsize, overflow)
+    if stats is not None:
+        names = stats.get_stage_names(stages)
+        for i, name in enumerate(names):
+            stages[i] = stats.instrumented(name, stages[i])
+
+    current = stages[-1]
     # Initialize final step in pipeline if it hasn't been already.
     if hasattr(current, '__call__'):
         current = current()
-    for b in args[-2::-1]:
+    for b in stages[-2::-1]:
         current = b(current)
     return current
 
 
+def get_stage_name(stage):
+    '''
+    Return a human-readable name for a stage or stage factory
+    '''
+    if isinstance(stage, partial):
+        return get_stage_name(stage.func)
+    if isinstance(stage, ThreadedStage):
+        return get_stage_name(stage.stage)
+    if isinstance(stage, InstrumentedStage):
+        return stage.name
+    if hasattr(stage, 'gi_code'):
+        return stage.gi_code.co_name
+    if hasattr(stage, '__name__'):
+        return stage.__name__
+    return type(stage).__name__
+
+
+def _threaded_stages(concurrency, n):
+    if concurrency is None:
+        return []
+    if concurrency == 'threaded':
+        return range(n)
+    if isinstance(concurrency, basestring):
+        raise ValueError('Unsupported concurrency {}'.format(concurrency))
+    return sorted(set(i % n for i in concurrency))
+
+
+################################################################################
+# Threading
+################################################################################
+_SENTINEL = object()
+
+
+class ThreadedStage(object):
+    '''
+    Runs a stage on a dedicated worker thread behind a bounded queue
+
+    Calls to `send` return as soon as the data has been queued so that an
+    expensive stage (e.g. filtering or writing to disk) does not stall the
+    acquisition callback feeding the pipeline.  Any exception raised by the
+    stage on the worker thread is re-raised in the caller on the next call to
+    `send` or `close`.
+
+    Parameters
+    ----------
+    stage : coroutine
+        Initialized stage (i.e. an object with a `send` method).
+    maxsize : int
+        Maximum number of blocks waiting in the queue.  If 0, the queue is
+        unbounded.
+    overflow : {'block', 'drop', 'error'}
+        What to do when the queue is full.  'block' waits until the worker
+        frees up space, 'drop' discards the oldest queued block (the number of
+        discarded blocks is tracked by `dropped`) and 'error' raises
+        `Queue.Full`.
+    '''
+
+    OVERFLOW_POLICIES = ('block', 'drop', 'error')
+
+    def __init__(self, stage, maxsize=0, overflow='block'):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('Unsupported overflow policy {}'.format(overflow))
+        self.stage = stage
+        self.overflow = overflow
+        self.dropped = 0
+        self._queue = Queue.Queue(maxsize)
+        self._exc_info = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            try:
+                if data is _SENTINEL:
+                    return
+                # Once the stage has failed, discard the remaining data rather
+                # than sending it to a stage in an undefined state.
+                if self._exc_info is None:
+                    self.stage.send(data)
+            except (Exception, GeneratorExit):
+                log.exception('Error in threaded stage')
+                self._exc_info = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _raise_worker_error(self):
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_tb = self._exc_info
+            raise exc_type, exc_value, exc_tb
+
+    def send(self, data):
+        self._raise_worker_error()
+        if self._closed:
+            raise ValueError('Cannot send to a closed stage')
+        if self.overflow == 'block':
+            self._queue.put(data)
+        elif self.overflow == 'error':
+            try:
+                self._queue.put_nowait(data)
+            except Queue.Full:
+                raise Queue.Full('Threaded stage queue is full')
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(data)
+                    break
+                except Queue.Full:
+                    try:
+                        self._queue.get_nowait()
+                        self._queue.task_done()
+                        self.dropped += 1
+                    except Queue.Empty:
+                        pass
+
+    def qsize(self):
+        '''
+        Approximate number of blocks waiting to be processed
+        '''
+        return self._queue.qsize()
+
+    def join(self):
+        '''
+        Block until all queued data has been processed by the stage
+        '''
+        self._queue.join()
+        self._raise_worker_error()
+
+    def close(self):
+        '''
+        Process the remaining queued data, stop the worker thread and close the
+        wrapped stage (raising `GeneratorExit` inside it).
+        '''
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_SENTINEL)
+            self._thread.join()
+            if hasattr(self.stage, 'close'):
+                self.stage.close()
+        self._raise_worker_error()
+
+
+def threaded(stage, maxsize=0, overflow='block'):
+    '''
+    Run the stage on its own thread.  See `ThreadedStage` for details.
+
+    If `stage` is already initialized, the `ThreadedStage` is returned
+    directly.  Otherwise, a callable is returned that initializes the stage
+    (e.g. with the downstream target) and wraps it in a `ThreadedStage`.  This
+    means that the result can be passed to `create_pipeline`:
+
+        >>> pipeline = create_pipeline(threaded(partial(rms, -1), maxsize=8),
+        ...                            sink)
+    '''
+    if hasattr(stage, 'send'):
+        return ThreadedStage(stage, maxsize, overflow)
+
+    def start(*args, **kwargs):
+        return ThreadedStage(stage(*args, **kwargs), maxsize, overflow)
+    start.__name__ = get_stage_name(stage)
+    return start
+
+
+################################################################################
+# Multiprocessing
+################################################################################
+def _shared_slots(capacity, shape, dtype):
+    dtype = np.dtype(dtype)
+    slot_size = int(np.prod(shape))
+    raw = RawArray('b', capacity*slot_size*dtype.itemsize)
+    return raw, slot_size
+
+
+def _slot_view(raw, slot_size, dtype):
+    return np.frombuffer(raw, dtype=dtype).reshape((-1, slot_size))
+
+
+def _process_worker(func, in_raw, in_slot_size, in_dtype, out_raw,
+                    out_slot_size, out_dtype, requests, results):
+    inputs = _slot_view(in_raw, in_slot_size, in_dtype)
+    outputs = _slot_view(out_raw, out_slot_size, out_dtype)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        seq, slot, shape = request
+        try:
+            data = inputs[slot, :int(np.prod(shape))].reshape(shape)
+            result = np.asarray(func(data), dtype=out_dtype)
+            if result.size > out_slot_size:
+                raise ValueError('Result does not fit in output slot')
+            outputs[slot, :result.size] = result.ravel()
+            results.put((seq, slot, result.shape, None))
+        except Exception:
+            results.put((seq, slot, None, traceback.format_exc()))
+
+
+class ProcessStage(object):
+    '''
+    Offloads processing of each block to one or more worker processes
+
+    Blocks are copied into a ring of slots in shared memory and only the
+    sequence number, slot and shape of each block are sent to the worker (i.e.
+    arrays are never pickled).  The worker calls `func` on the block and writes
+    the result into the matching output slot.  Results are forwarded to
+    `target`, in the order the blocks were sent, from the thread that calls
+    `send` (results that are ready are forwarded on each call to `send` and the
+    remainder on `close`).
+
+    Note that this uses `multiprocessing.sharedctypes` rather than
+    `multiprocessing.shared_memory` so it works under Python 2.
+
+    Parameters
+    ----------
+    func : callable
+        Function that takes a single array and returns the processed array.
+        Must be picklable (i.e. defined at the module level).  If `workers` is
+        greater than 1, `func` should not keep state between calls since
+        consecutive blocks are processed by different workers.
+    shape : tuple
+        Maximum shape of the blocks sent to the stage.  Smaller blocks are
+        accepted as long as they fit in the slot.
+    dtype : dtype
+        Data type of the blocks.
+    target : coroutine
+        Receives the processed blocks.
+    capacity : int
+        Number of slots (i.e. maximum number of blocks in flight).  When all
+        slots are in use, `send` blocks until a result is available.
+    out_shape : {None, tuple}
+        Maximum shape of the result.  Defaults to `shape`.
+    out_dtype : {None, dtype}
+        Data type of the result.  Defaults to `dtype`.
+    workers : int
+        Number of worker processes.
+    poll_interval : float
+        How often (in seconds) to check whether the workers are still alive
+        while waiting for results.
+    '''
+
+    def __init__(self, func, shape, dtype, target, capacity=8, out_shape=None,
+                 out_dtype=None, workers=1, poll_interval=0.5):
+        if out_shape is None:
+            out_shape = shape
+        if out_dtype is None:
+            out_dtype = dtype
+        self.target = target
+        self.poll_interval = poll_interval
+        self.dtype = np.dtype(dtype)
+        self.out_dtype = np.dtype(out_dtype)
+
+        in_raw, self._in_slot_size = _shared_slots(capacity, shape, dtype)
+        out_raw, self._out_slot_size = _shared_slots(capacity, out_shape,
+                                                     out_dtype)
+        self._inputs = _slot_view(in_raw, self._in_slot_size, self.dtype)
+        self._outputs = _slot_view(out_raw, self._out_slot_size,
+                                   self.out_dtype)
+
+        self._free = range(capacity)
+        self._seq = 0
+        self._next_seq = 0
+        self._completed = {}
+        self._closed = False
+        self._error = None
+        self._requests = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        args = (func, in_raw, self._in_slot_size, self.dtype, out_raw,
+                self._out_slot_size, self.out_dtype, self._requests,
+                self._results)
+        self._workers = []
+        for i in range(workers):
+            process = multiprocessing.Process(target=_process_worker,
+                                              args=args)
+            process.daemon = True
+            process.start()
+            self._workers.append(process)
+
+    @property
+    def pending(self):
+        '''
+        Number of blocks sent to the workers that have not been forwarded yet
+        '''
+        return self._seq-self._next_seq
+
+    def _check_workers(self):
+        if self._error is not None:
+            raise RuntimeError(self._error)
+        for process in self._workers:
+            if not process.is_alive():
+                mesg = 'Worker process {} exited with code {}'
+                self._error = mesg.format(process.pid, process.exitcode)
+                raise RuntimeError(self._error)
+
+    def _receive(self, block):
+        try:
+            if block:
+                result = self._results.get(timeout=self.poll_interval)
+            else:
+                result = self._results.get_nowait()
+        except Queue.Empty:
+            if block:
+                self._check_workers()
+            return False
+
+        seq, slot, shape, error = result
+        if error is not None:
+            self._free.append(slot)
+            mesg = 'Worker failed to process block {}:\n{}'
+            self._error = mesg.format(seq, error)
+            raise RuntimeError(self._error)
+
+        # Copy the result out of shared memory so the slot can be reused.
+        size = int(np.prod(shape))
+        self._completed[seq] = self._outputs[slot, :size].reshape(shape).copy()
+        self._free.append(slot)
+        while self._next_seq in self._completed:
+            self.target.send(self._completed.pop(self._next_seq))
+            self._next_seq += 1
+        return True
+
+    def send(self, data):
+        if self._closed:
+            raise ValueError('Cannot send to a closed stage')
+        self._check_workers()
+        data = np.asarray(data, dtype=self.dtype)
+        if data.size > self._in_slot_size:
+            raise ValueError('Block does not fit in input slot')
+        while not self._free:
+            self._receive(block=True)
+        slot = self._free.pop()
+        self._inputs[slot, :data.size] = data.ravel()
+        self._requests.put((self._seq, slot, data.shape))
+        self._seq += 1
+        while self._receive(block=False):
+            pass
+
+    def join(self):
+        '''
+        Block until all blocks sent so far have been forwarded to the target
+        '''
+        while self.pending:
+            self._check_workers()
+            self._receive(block=True)
+
+    def close(self):
+        '''
+        Forward the remaining results and shut down the worker processes
+        '''
+        if self._closed:
+            return
+        try:
+            if self._error is None:
+                self.join()
+        finally:
+            self._closed = True
+            for process in self._workers:
+                self._requests.put(None)
+            for process in self._workers:
+                process.join(self.poll_interval)
+                if process.is_alive():
+                    process.terminate()
+
+
+def offload(func, shape, dtype, target, **kwargs):
+    '''
+    Process each block in a worker process.  See `ProcessStage` for details.
+
+        >>> pipeline = create_pipeline(partial(offload, filter_block,
+        ...                                    (128, 10000), 'f'), sink)
+    '''
+    return ProcessStage(func, shape, dtype, target, **kwargs)
+
+
+################################################################################
+# Instrumentation
+################################################################################
+class InstrumentedStage(object):
+    '''
+    Proxy that records statistics each time data is sent to the stage
+
+    The time reported as `self_time` excludes the time spent in instrumented
+    stages further down the pipeline (when they run in the same thread).
+    '''
+
+    def __init__(self, name, stage, stats, maxlen=1000):
+        self.name = name
+        self.stage = stage
+        self.items = 0
+        self.samples = 0
+        self.total_time = 0.0
+        self.latency = LatencyStats(maxlen)
+        self.queue = None
+        self._stats = stats
+
+    def send(self, data):
+        stack = self._stats._get_stack()
+        stack.append(0.0)
+        start = clock()
+        try:
+            self.stage.send(data)
+        finally:
+            elapsed = clock() - start
+            downstream = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.items += 1
+            self.samples += np.shape(data)[-1] if np.ndim(data) else 1
+            self.total_time += elapsed
+            self.latency.add(elapsed-downstream)
+            self._stats._check_log()
+
+    def close(self):
+        if hasattr(self.stage, 'close'):
+            self.stage.close()
+
+    def snapshot(self, percentiles=(50, 90, 99)):
+        summary = self.latency.summary(percentiles)
+        result = {
+            'items': self.items,
+            'samples': self.samples,
+            'total_time': self.total_time,
+            'self_time': summary.pop('total'),
+        }
+        summary.pop('n')
+        for k, v in summary.items():
+            result['{}_time'.format(k)] = v
+        if self.queue is not None:
+            result['queue_depth'] = self.queue.qsize()
+            result['dropped'] = self.queue.dropped
+        return result
+
+
+class PipelineStats(object):
+    '''
+    Collects per-stage statistics for a pipeline built with `create_pipeline`
+
+    For each stage, the number of items and samples (i.e. length of the last
+    axis) processed, the cumulative time spent in `send` and percentiles of the
+    time spent in the stage itself are tracked.  For threaded stages, the time
+    is measured on the worker thread and the current queue depth is reported.
+
+        >>> stats = PipelineStats(log_interval=10)
+        >>> pipeline = create_pipeline(partial(blocked, 1000, -1),
+        ...                            partial(rms, -1), sink, stats=stats)
+        >>> stats.snapshot()['rms']['p99_time']
+
+    Parameters
+    ----------
+    log_interval : {None, float}
+        If provided, log a summary of the statistics every `log_interval`
+        seconds (checked whenever data passes through the pipeline).
+    maxlen : int
+        Number of recent timings per stage used for computing percentiles.
+    '''
+
+    def __init__(self, log_interval=None, maxlen=1000):
+        self.stages = OrderedDict()
+        self.log_interval = log_interval
+        self._maxlen = maxlen
+        self._local = threading.local()
+        self._log_lock = threading.Lock()
+        self._last_log = clock()
+
+    def _get_stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def get_stage_names(self, stages):
+        names = []
+        for stage in stages:
+            name = base_name = get_stage_name(stage)
+            i = 1
+            while name in names or name in self.stages:
+                name = '{}_{}'.format(base_name, i)
+                i += 1
+            names.append(name)
+        return names
+
+    def instrument(self, name, stage):
+        '''
+        Wrap an initialized stage.  If the stage is a `ThreadedStage`, the
+        stage running on the worker thread is instrumented instead.
+        '''
+        if self.stages.get(name) is not None:
+            raise ValueError('Stage {} already instrumented'.format(name))
+        if isinstance(stage, ThreadedStage):
+            wrapped = InstrumentedStage(name, stage.stage, self, self._maxlen)
+            wrapped.queue = stage
+            stage.stage = wrapped
+        else:
+            wrapped = stage = InstrumentedStage(name, stage, self,
+                                                self._maxlen)
+        self.stages[name] = wrapped
+        return stage
+
+    def instrumented(self, name, stage):
+        '''
+        Instrument the stage if initialized, otherwise return a callable that
+        initializes and instruments the stage.
+        '''
+        if hasattr(stage, 'send'):
+            return self.instrument(name, stage)
+
+        # Reserve the name so that the stages are reported in pipeline order
+        # even though they are initialized starting from the last stage.
+        self.stages.setdefault(name, None)
+
+        def start(*args, **kwargs):
+            return self.instrument(name, stage(*args, **kwargs))
+        start.__name__ = name
+        return start
+
+    def snapshot(self, percentiles=(50, 90, 99)):
+        '''
+        Return dictionary mapping stage name to a dictionary of statistics
+        '''
+        return OrderedDict((n, s.snapshot(percentiles))
+                           for n, s in self.stages.items() if s is not None)
+
+    def _check_log(self):
+        if self.log_interval is None:
+            return
+        if (clock()-self._last_log) < self.log_interval:
+            return
+        with self._log_lock:
+            if (clock()-self._last_log) < self.log_interval:
+                return
+            self._last_log = clock()
+        self.log_snapshot()
+
+    def log_snapshot(self):
+        for name, s in self.snapshot().items():
+            log.info('Stage %s: %d items, %d samples, %.3fs self time, '
+                     'p50 %.2es, p99 %.2es, queue depth %s', name,
+                     s['items'], s['samples'], s['self_time'], s['p50_time'],
+                     s['p99_time'], s.get('queue_depth', 'n/a'))
+
+
 ################################################################################
 # Coroutines
 ################################################################################
@@ -125,6 +730,267 @@ def broadcast(*targets):
             target.send(input)
 
 
+def _sos_initial_state(sos, shape, axis):
+    zi_shape = list(shape)
+    zi_shape[axis] = 2
+    return np.zeros([len(sos)] + zi_shape)
+
+
+@coroutine
+def sosfilt(sos, axis, target):
+    '''
+    Filter data using cascaded second-order sections
+
+    The filter state of each channel is preserved between blocks so the output
+    is identical to filtering the continuous signal in one go (i.e. there are no
+    edge artifacts at block boundaries).  The filter starts from rest.
+
+    Parameters
+    ----------
+    sos : array
+        Second-order sections (e.g. as returned by `scipy.signal.iirfilter`
+        with output='sos').
+    axis : int
+        Axis to filter along (typically the time axis).
+    '''
+    from scipy import signal
+    sos = np.asarray(sos)
+    zi = None
+    while True:
+        data = (yield)
+        if zi is None:
+            zi = _sos_initial_state(sos, data.shape, axis)
+        filtered, zi = signal.sosfilt(sos, data, axis=axis, zi=zi)
+        target.send(filtered)
+
+
+@coroutine
+def filter_bank(sos_bands, axis, *targets):
+    '''
+    Filter data through a bank of filters, sending each band to its own target
+
+    Each band keeps its own filter state between blocks (see `sosfilt`).
+
+    Parameters
+    ----------
+    sos_bands : list of arrays
+        Second-order sections for each band.
+    axis : int
+        Axis to filter along (typically the time axis).
+    targets : coroutines
+        One target per band.
+    '''
+    from scipy import signal
+    if len(sos_bands) != len(targets):
+        raise ValueError('Must provide one target per band')
+    sos_bands = [np.asarray(sos) for sos in sos_bands]
+    zi = None
+    while True:
+        data = (yield)
+        if zi is None:
+            zi = [_sos_initial_state(sos, data.shape, axis)
+                  for sos in sos_bands]
+        for i, (sos, target) in enumerate(zip(sos_bands, targets)):
+            filtered, zi[i] = signal.sosfilt(sos, data, axis=axis, zi=zi[i])
+            target.send(filtered)
+
+
+################################################################################
+# Fused coroutines
+################################################################################
+'''
+The fused coroutines produce the same output as the equivalent chain of
+coroutines (e.g. `block_rms_db` is equivalent to `blocked`, `rms` and `db`);
+however, all complete blocks in the incoming data are processed in a single
+pass using in-place operations on preallocated arrays rather than allocating
+intermediate arrays at every stage.  Each block is still sent separately to the
+target.
+'''
+
+def _float_dtype(dtype):
+    return np.result_type(dtype, np.float16)
+
+
+@coroutine
+def _block_reduce(block_size, axis, reduce, target, new_shape=None):
+    '''
+    Split data into blocks along axis and send `reduce(blocks, out)` for each
+    block where `blocks` has the samples in the block on the last axis.
+    `reduce` must store the result (i.e. `blocks` reduced along the last axis)
+    in `out`.  If `new_shape` is provided, each result is reshaped before being
+    sent.
+    '''
+    if new_shape is None:
+        send = target.send
+    else:
+        send = lambda r: target.send(r.reshape(new_shape))
+    buffer = None
+    n_buffered = 0
+    while True:
+        data = np.rollaxis(np.asarray((yield)), axis, 0)
+        data = np.rollaxis(data, 0, data.ndim)
+        if buffer is None:
+            buffer = np.empty(data.shape[:-1] + (block_size,), data.dtype)
+        n = data.shape[-1]
+
+        i = 0
+        if n_buffered:
+            i = min(block_size-n_buffered, n)
+            buffer[..., n_buffered:n_buffered+i] = data[..., :i]
+            n_buffered += i
+            if n_buffered == block_size:
+                n_buffered = 0
+                result = np.empty(buffer.shape[:-1] + (1,),
+                                  _float_dtype(buffer.dtype))
+                reduce(buffer[..., np.newaxis, :], result)
+                send(result[..., 0])
+
+        m = (n-i)//block_size
+        if m:
+            blocks = data[..., i:i+m*block_size]
+            blocks = blocks.reshape(data.shape[:-1] + (m, block_size))
+            result = np.empty(data.shape[:-1] + (m,),
+                              _float_dtype(data.dtype))
+            reduce(blocks, result)
+            for j in range(m):
+                send(result[..., j])
+            i += m*block_size
+
+        if i < n:
+            n_buffered = n-i
+            buffer[..., :n_buffered] = data[..., i:]
+
+
+def _mean_square(scratch):
+    def reduce(blocks, out):
+        shape = blocks.shape
+        if scratch[0] is None or scratch[0].shape != shape:
+            scratch[0] = np.empty(shape, out.dtype)
+        np.multiply(blocks, blocks, out=scratch[0])
+        np.mean(scratch[0], axis=-1, out=out)
+    return reduce
+
+
+def block_rms(block_size, axis, target):
+    '''
+    Fused equivalent of `blocked`, `rms`
+    '''
+    mean_square = _mean_square([None])
+
+    def reduce(blocks, out):
+        mean_square(blocks, out)
+        np.sqrt(out, out=out)
+    return _block_reduce(block_size, axis, reduce, target)
+
+
+def block_rms_db(block_size, axis, reference, target):
+    '''
+    Fused equivalent of `blocked`, `rms`, `db`
+    '''
+    mean_square = _mean_square([None])
+
+    def reduce(blocks, out):
+        # 20*log10(sqrt(x)/r) is computed as 10*log10(x/r**2) to avoid the
+        # square root.
+        mean_square(blocks, out)
+        np.divide(out, reference**2, out=out)
+        np.log10(out, out=out)
+        np.multiply(out, 10, out=out)
+    return _block_reduce(block_size, axis, reduce, target)
+
+
+def block_average_reshape(block_size, axis, new_shape, target):
+    '''
+    Fused equivalent of `block_average`, `reshape`
+    '''
+    def reduce(blocks, out):
+        np.mean(blocks, axis=-1, out=out)
+    return _block_reduce(block_size, axis, reduce, target, new_shape)
+
+
+# Each entry maps a chain of coroutines (and the names of their arguments,
+# excluding target) to the fused coroutine.  The fused coroutine is called with
+# the arguments of the chain, in order, omitting duplicate names.  A chain only
+# matches if arguments with the same name have the same value.
+FUSED_STAGES = [
+    (((blocked, ('block_size', 'axis')),
+      (rms, ('axis',)),
+      (db, ('reference',))), block_rms_db),
+    (((blocked, ('block_size', 'axis')),
+      (rms, ('axis',))), block_rms),
+    (((block_average, ('block_size', 'axis')),
+      (reshape, ('new_shape',))), block_average_reshape),
+]
+
+
+def _partial_arguments(stage, func, names):
+    if not isinstance(stage, partial) or stage.func is not func:
+        return None
+    if len(stage.args) > len(names):
+        return None
+    arguments = dict(zip(names, stage.args))
+    for k, v in (stage.keywords or {}).items():
+        if k not in names or k in arguments:
+            return None
+        arguments[k] = v
+    if len(arguments) != len(names):
+        return None
+    return arguments
+
+
+def _match_chain(stages, chain):
+    if len(stages) < len(chain):
+        return None
+    arguments = []
+    names = []
+    for stage, (func, func_names) in zip(stages, chain):
+        stage_arguments = _partial_arguments(stage, func, func_names)
+        if stage_arguments is None:
+            return None
+        for name in func_names:
+            value = stage_arguments[name]
+            if name in names:
+                if arguments[names.index(name)] != value:
+                    return None
+            else:
+                names.append(name)
+                arguments.append(value)
+    return arguments
+
+
+def fuse_stages(stages, threaded_stages=()):
+    '''
+    Replace chains of stages with their fused equivalent (see `FUSED_STAGES`)
+
+    Chains are not fused if any stage other than the first one in the chain is
+    in `threaded_stages` (i.e. the indices of stages that will run in their own
+    thread).  Returns the new list of stages and the updated indices of the
+    threaded stages.
+    '''
+    fused = []
+    fused_threaded = []
+    i = 0
+    while i < len(stages):
+        for chain, func in FUSED_STAGES:
+            j = i + len(chain)
+            if any(k in threaded_stages for k in range(i+1, j)):
+                continue
+            arguments = _match_chain(stages[i:j], chain)
+            if arguments is not None:
+                log.debug('Fusing stages %d to %d into %s', i, j-1,
+                          func.__name__)
+                stage = partial(func, *arguments)
+                break
+        else:
+            j = i + 1
+            stage = stages[i]
+        if i in threaded_stages:
+            fused_threaded.append(len(fused))
+        fused.append(stage)
+        i = j
+    return fused, fused_threaded
+
+
 ################################################################################
 # SINKS
 ################################################################################
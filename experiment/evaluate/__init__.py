@@ -4,6 +4,7 @@ import logging
 log = logging.getLogger(__name__)
 
 import re
+from collections import deque, OrderedDict
 from time import time
 import types
 
@@ -12,6 +13,12 @@ from traits.api import TraitType
 
 from . import choice
 from . import expr
+from .compiler import compile_expression, _is_immutable
+
+
+# Types of values that are treated as a sequence (i.e. a new value is drawn
+# each time the expression is evaluated)
+GENERATOR_TYPES = (types.GeneratorType, choice.ChoiceSequence)
 
 
 class ParameterExpression(object):
@@ -35,9 +42,18 @@ class ParameterExpression(object):
 
     DEPENDENCY_PATTERN = re.compile(r'u\((.*), ([_A-Za-z][_A-Za-z0-9]*)\)')
 
+    # Names that return a different value each time they are called (e.g.
+    # random numbers or generators).  Expressions that use any of these (or
+    # np.random) are volatile and must be re-evaluated on every trial.
+    VOLATILE_NAMES = set(['time', 'toss', 'choice']) | set(choice.options)
+
     def __init__(self, value):
         self._original_expression = value
         self._next_when = None
+        # Values drawn from the generator ahead of time (see `peek`) and the
+        # number of values consumed from the current generator.
+        self._lookahead = deque()
+        self._drawn = 0
         if isinstance(value, basestring):
             match = self.DEPENDENCY_PATTERN.match(value)
             if match is not None:
@@ -45,62 +61,161 @@ class ParameterExpression(object):
             else:
                 self._expression = value
 
-            self._code = compile(self._expression, '<string>', 'eval')
             self._cached_value = None
             self._generator = None
-            self._dependencies = list(self._code.co_names)
-            if self._next_when is not None:
-                self._dependencies += [self._next_when]
-            try:
-                # Do a quick check to see if any syntax errors pop out.
-                # NameError is going to be a common one (especially when we are
-                # making it dependent on other modules).  If we can successfully
-                # evaluate it and it does not depend on any values, then we
-                # might as well cache the resulting value.
-                eval(self._code, self.GLOBALS)
-            except NameError:
-                # This is the one error we will allow since it may suggest the
-                # expression requires values not present in the global
-                # namespace (but we don't know that for sure ...)
-                pass
+            self._compile()
         else:
             self._dependencies = []
+            self._volatile = False
             self._expression = str(value)
             self._cached_value = value
             self._code = None
+            self._function = None
+            self._globals = None
             self._generator = None
 
-    def evaluate(self, local_context=None, dry_run=False, next_value=True):
+    def _compile(self):
+        # The expression is not evaluated here (even if it has no dependencies)
+        # since that would advance the state of random number generators.
+        # Syntax errors are raised by the compiler.
+        compiled = compile_expression(self._expression, self.GLOBALS,
+                                      self.VOLATILE_NAMES)
+        self._code = compiled.code
+        self._function = compiled.function
+        self._globals = compiled.globals
+        self._arguments = compiled.dependencies
+        self._global_names = compiled.global_names
+        self._dependencies = compiled.dependencies[:]
+        self._volatile = compiled.volatile or self._next_when is not None
+        if self._next_when is not None:
+            self._dependencies.append(self._next_when)
+
+    def _call(self, local_context, arguments=None):
+        '''
+        Compute the value of the expression
+
+        Parameters
+        ----------
+        local_context : {None, mapping}
+            Values of the names referenced by the expression.
+        arguments : {None, list}
+            Values of the dependencies if already looked up in the local
+            context.  Any extra values (i.e. of `_next_when`) are ignored.
+        '''
+        if local_context is None:
+            local_context = {}
+        for name in self._global_names:
+            if name in local_context:
+                # The context overrides a global, which the function does not
+                # support.
+                return eval(self._code, self._globals, local_context)
+        if arguments is None:
+            arguments = []
+            for name in self._arguments:
+                try:
+                    arguments.append(local_context[name])
+                except KeyError:
+                    raise NameError("name '{}' is not defined".format(name))
+        elif len(arguments) != len(self._arguments):
+            arguments = arguments[:len(self._arguments)]
+        return self._function(*arguments)
+
+    @property
+    def kind(self):
+        '''
+        How the value of the expression can change from trial to trial
+
+        constant
+            The expression does not depend on any other values.
+        dependent
+            The value only changes when the values it depends on change.
+        volatile
+            The value may change on every evaluation (e.g. it uses a random
+            number or sequence generator).
+        '''
+        if self._volatile or self._generator is not None:
+            return 'volatile'
+        if self._dependencies:
+            return 'dependent'
+        return 'constant'
+
+    def evaluate(self, local_context=None, dry_run=False, next_value=True,
+                 arguments=None):
         '''
         Evaluate expression given the provided context
 
         Parameters
         ----------
         local_context : { None, dict }
-            Context to pass to `eval`
+            Values of the names referenced by the expression
         dry_run : bool
             Don't cache result of eval.  Important if we have a generator
             expression and are doing an initial check to make sure that the
             list of expressions are valid.
+        next_value : bool
+            Advance the generator (if the expression returned one).
+        arguments : { None, list }
+            Values of the dependencies (in the order listed in
+            `_dependencies`) if they have already been looked up.
         '''
         if self._generator is not None:
             if next_value:
-                self._cached_value = self._generator.next()
+                if self._lookahead:
+                    self._cached_value = self._lookahead.popleft()
+                else:
+                    self._cached_value = self._generator.next()
+                self._drawn += 1
             return self._cached_value
 
         if self._code is not None:
-            value = eval(self._code, self.GLOBALS, local_context)
-            if not dry_run and isinstance(value, types.GeneratorType):
+            value = self._call(local_context, arguments)
+            if dry_run and isinstance(value, GENERATOR_TYPES):
+                # The first value is needed to check the dependents, but the
+                # new generator is discarded.
+                return value.next()
+            elif isinstance(value, GENERATOR_TYPES):
                 self._generator = value
                 self._cached_value = self._generator.next()
+                self._drawn = 1
             else:
                 self._cached_value = value
         return self._cached_value
 
+    def peek(self, i=0):
+        '''
+        Return the upcoming values of the generator without consuming them
+
+        Parameters
+        ----------
+        i : int
+            Index of the value to return, where 0 is the value that will be
+            returned the next time the expression is evaluated.
+
+        Raises
+        ------
+        StopIteration
+            If the generator is exhausted before reaching the value.
+        '''
+        while len(self._lookahead) <= i:
+            self._lookahead.append(self._generator.next())
+        return self._lookahead[i]
+
+    def copy(self):
+        '''
+        Return a new expression with the same definition but none of the
+        state (e.g. the generator)
+
+        The default value of an `Expression` trait is shared by all instances
+        of the class, so each namespace needs its own copies.
+        '''
+        return type(self)(self._original_expression)
+
     def reset(self):
         if self._generator is not None:
             self._cached_value = None
             self._generator = None
+            self._lookahead.clear()
+            self._drawn = 0
 
     def __str__(self):
         return str(self._original_expression)
@@ -123,33 +238,270 @@ class ParameterExpression(object):
 
     def __getstate__(self):
         '''
-        Code objects cannot be pickled
+        Code objects (and the modules in the global namespace) cannot be
+        pickled
         '''
         state = self.__dict__.copy()
         del state['_code']
+        del state['_function']
+        del state['_globals']
         return state
 
     def __setstate__(self, state):
         self.__dict__.update(state)
-        if not self._cache_valid:
-            self._code = compile(self._expression, '<string>', 'eval')
+        if isinstance(self._original_expression, basestring):
+            self._compile()
         else:
             self._code = None
+            self._function = None
+            self._globals = None
+
+
+_MISSING = object()
+
+
+def _same_values(a, b):
+    for x, y in zip(a, b):
+        if x is y:
+            continue
+        try:
+            if not (x == y):
+                return False
+        except Exception:
+            # e.g. comparison of arrays with more than one element
+            return False
+        if type(x) is not type(y):
+            return False
+    return True
+
+
+class _Scope(object):
+    '''
+    Mapping used as the local namespace when evaluating expressions
+
+    Looks up names in each of the mappings, in order, without copying them.
+    Names assigned while evaluating an expression (e.g. the loop variable of a
+    list comprehension) are stored in a separate dictionary that is cleared
+    before each expression is evaluated.
+    '''
+
+    def __init__(self, *mappings):
+        self._local = {}
+        self._mappings = [self._local]
+        self._mappings.extend(m for m in mappings if m is not None)
+
+    def clear_local(self):
+        if self._local:
+            self._local.clear()
+
+    def __getitem__(self, key):
+        for mapping in self._mappings:
+            if key in mapping:
+                return mapping[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self._local[key] = value
+
+    def __contains__(self, key):
+        return any(key in mapping for mapping in self._mappings)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
 
 class ExpressionNamespace(object):
 
-    def __init__(self, expressions, extra_context=None, controller=None):
+    def __init__(self, expressions, extra_context=None, controller=None,
+                 reset=None):
         self._cached_expressions = expressions
+        self._build_graph()
         self._catch = []
-        for e in self._cached_expressions.values():
+        # Only reset the requested expressions and the ones that depend on
+        # them.  Generators of the other expressions continue where they left
+        # off.
+        if reset is None:
+            reset = self._cached_expressions.keys()
+        else:
+            reset = self._get_dependents(reset)
+        for name in reset:
+            e = self._cached_expressions[name]
             if isinstance(e, ParameterExpression):
-                if e._next_when is not None:
-                    self._catch.append(e._next_when)
                 e.reset()
+        for e in self._cached_expressions.values():
+            if isinstance(e, ParameterExpression) and e._next_when is not None:
+                self._catch.append(e._next_when)
+        # Values of non-volatile expressions along with the inputs used to
+        # compute them.  Retained across trials so that the expression is only
+        # re-evaluated when one of its inputs changes.
+        self._memo = {}
         self._context = {}
         self.reset_values(extra_context)
         self.controller = controller
+        # If the controller has a `PhaseTimer`, the time spent drawing values
+        # from sequences and calling the setters is tracked.
+        self.timer = getattr(controller, 'trial_timer', None)
+
+    def replace_expressions(self, expressions, extra_context=None):
+        '''
+        Create a new namespace with some of the expressions replaced
+
+        The expressions that are not replaced (and do not depend on a replaced
+        expression) are shared with the new namespace along with their state
+        (e.g. the position of a sequence generator) and cached values.
+
+        Parameters
+        ----------
+        expressions : dict
+            Mapping of parameter name to the new expression.
+        extra_context : {None, dict}
+            Extra context of the new namespace.
+
+        Returns
+        -------
+        namespace : ExpressionNamespace
+            The new namespace.  Values evaluated for the current trial are used
+            to determine which values have changed on the next trial.
+        affected : list
+            Names of the replaced expressions and those that depend on them,
+            in the order they are evaluated.
+        '''
+        cached_expressions = self._cached_expressions.copy()
+        cached_expressions.update(expressions)
+        ns = ExpressionNamespace(cached_expressions, extra_context,
+                                 self.controller, reset=())
+        # Use the dependency graph of the new namespace since the replaced
+        # expressions may have different dependencies.
+        affected = ns._get_dependents(expressions.keys())
+        # The affected expressions are restarted.  Those that are shared with
+        # this namespace are replaced by copies rather than reset, so this
+        # namespace is not modified (e.g. if the new namespace fails
+        # validation).
+        for name in affected:
+            e = ns._cached_expressions[name]
+            if isinstance(e, ParameterExpression):
+                if name in expressions:
+                    e.reset()
+                else:
+                    ns._cached_expressions[name] = e.copy()
+        for name, memo in self._memo.items():
+            if name not in affected:
+                ns._memo[name] = memo
+        ns._context = self._context
+        ns.reset_values(extra_context)
+        return ns, affected
+
+    def validate(self, names, extra_context=None):
+        '''
+        Check that the expressions can be evaluated
+
+        The expressions (along with the ones they depend on) are evaluated
+        without advancing any sequences.  The namespace is reset afterwards.
+
+        Raises
+        ------
+        Exception
+            Any error raised while evaluating the expressions.
+        '''
+        old_context = self._old_context
+        try:
+            for name in names:
+                self._evaluate_value(name, extra_context, dry_run=True)
+        finally:
+            self.reset_values(self._extra_context)
+            self._old_context = old_context
+
+    def _build_graph(self):
+        '''
+        Build the dependency graph of the expressions and compute the order in
+        which they need to be evaluated (i.e., dependencies first).
+
+        Raises
+        ------
+        ValueError
+            If there is a circular reference between expressions.
+        '''
+        graph = {}
+        for name, expression in self._cached_expressions.items():
+            dependencies = []
+            if isinstance(expression, ParameterExpression):
+                for d in expression._dependencies:
+                    # Names that are not in the namespace are provided by the
+                    # global or extra context (e.g. a function name).  A
+                    # reference to itself can only be resolved by the extra
+                    # context.
+                    if d in self._cached_expressions and d != name and \
+                            d not in dependencies:
+                        dependencies.append(d)
+            graph[name] = dependencies
+
+        order = []
+        visited = set()
+        for name in sorted(graph):
+            if name in visited:
+                continue
+            # Iterative depth-first search.  The path tracks the names that are
+            # currently being visited to detect cycles.
+            path = [name]
+            stack = [iter(graph[name])]
+            visited.add(name)
+            while stack:
+                for d in stack[-1]:
+                    if d in path:
+                        cycle = path[path.index(d):] + [d]
+                        mesg = 'Circular reference between {}'
+                        raise ValueError(mesg.format(' -> '.join(cycle)))
+                    if d not in visited:
+                        visited.add(d)
+                        path.append(d)
+                        stack.append(iter(graph[d]))
+                        break
+                else:
+                    stack.pop()
+                    order.append(path.pop())
+
+        self._graph = graph
+        self._order = order
+        self._plans = {}
+
+    def _get_plan(self, parameter):
+        '''
+        Return the list of expressions that need to be evaluated (in order) to
+        compute the value of the parameter
+        '''
+        try:
+            return self._plans[parameter]
+        except KeyError:
+            pass
+        required = set([parameter])
+        pending = [parameter]
+        while pending:
+            for d in self._graph[pending.pop()]:
+                if d not in required:
+                    required.add(d)
+                    pending.append(d)
+        plan = [n for n in self._order if n in required]
+        self._plans[parameter] = plan
+        return plan
+
+    def _get_dependents(self, names):
+        '''
+        Return the names along with all expressions that depend on them
+        (directly or indirectly) in the order they are evaluated
+        '''
+        dependents = set(names)
+        for name in self._order:
+            if any(d in dependents for d in self._graph[name]):
+                dependents.add(name)
+        return [n for n in self._order if n in dependents]
+
+    def _get_scope(self, extra_context=None):
+        # Values in extra_context take precedence over those in the namespace
+        # context.
+        return _Scope(extra_context, self._extra_context, self._context)
 
     def reset_values(self, extra_context=None):
         '''
@@ -166,7 +518,9 @@ class ExpressionNamespace(object):
         self._old_context = self._context
         self._context = {}
         self._expressions = self._cached_expressions.copy()
-        self._changed_values = {}
+        # Ordered so that notifications are processed in the order the values
+        # were set (i.e., dependencies first).
+        self._changed_values = OrderedDict()
         self._seq_end = [None]
 
     def reset_generator(self, value):
@@ -181,6 +535,7 @@ class ExpressionNamespace(object):
         # TODO - should we check dependencies?
         log.debug('Setting %s to %r', parameter, value)
         self._context[parameter] = value
+        self._expressions.pop(parameter, None)
         if self.value_changed(parameter):
             log.debug('Marking %s as changed', parameter)
             self._changed_values[parameter] = value
@@ -188,25 +543,34 @@ class ExpressionNamespace(object):
     def set_value(self, parameter, value, notify=True):
         self._set_value(parameter, value)
         if notify:
-            self._process_context_notifications()
-            self.controller._update_current_context_list()
+            self._notify()
 
     def evaluate_values(self, extra_context=None, notify=True):
-        while self._expressions:
-            self.evaluate_value(self._expressions.keys()[0], extra_context)
-            if notify:
-                self._process_context_notifications()
-                self.controller._update_current_context_list()
+        '''
+        Evaluate all expressions that are not in the context yet
+
+        Notifications are processed once all expressions have been evaluated.
+        '''
+        scope = self._get_scope(extra_context)
+        for parameter in self._order:
+            if parameter not in self._context:
+                self._evaluate_expression(parameter, scope)
+        if notify:
+            self._notify()
         return self._context
 
     def evaluate_value(self, parameter, extra_context=None, dry_run=False,
                        notify=True):
         value = self._evaluate_value(parameter, extra_context, dry_run)
         if notify:
-            self._process_context_notifications()
-            self.controller._update_current_context_list()
+            self._notify()
         return value
 
+    def _notify(self):
+        self._process_context_notifications()
+        if self.controller is not None:
+            self.controller._update_current_context_list()
+
     def _process_context_notifications(self):
         '''
         Once an expression (and all dependencies) has been evaluated, go through
@@ -219,8 +583,17 @@ class ExpressionNamespace(object):
         evaluating a dependency expression and calling the notification
         triggered a recursive loop.
         '''
+        if not self._changed_values:
+            return
+        if self.timer is None:
+            self._call_setters()
+        else:
+            with self.timer.phase('notify'):
+                self._call_setters()
+
+    def _call_setters(self):
         while self._changed_values:
-            k, v = self._changed_values.popitem()
+            k, v = self._changed_values.popitem(last=False)
             log.debug('Processing context notification for %s', k)
             setter = 'set_{}'.format(k)
             if hasattr(self.controller, setter):
@@ -228,10 +601,10 @@ class ExpressionNamespace(object):
 
     def _evaluate_value(self, parameter, extra_context=None, dry_run=False):
         '''
-        Given a stack of expressions and the desired parameter to evaluate,
-        evaluates all the expressions necessary to evaluate the desired
-        parameter.  If an expression is evaluated, it is removed from the stack
-        of expressions and added to the context.
+        Evaluates the parameter along with all the expressions it depends on
+        (in the order determined when the namespace was created).  Evaluated
+        expressions are removed from the stack of expressions and added to the
+        context.
         '''
         log.debug('Evaluating value %s', parameter)
 
@@ -241,11 +614,17 @@ class ExpressionNamespace(object):
             log.debug('Value found in context')
             return self._context[parameter]
 
-        # Otherwise, find the expression that is used to compute the value of
-        # the parameter.  Check to see if the parameter has any dependencies
-        # (i.e., other unevaluated parameters that need to be comptued first).
-        # If so, iterate through those.
-        log.debug('Popping expression from stack')
+        scope = self._get_scope(extra_context)
+        for name in self._get_plan(parameter):
+            if name not in self._context:
+                self._evaluate_expression(name, scope, dry_run)
+        return self._context[parameter]
+
+    def _evaluate_expression(self, parameter, scope, dry_run=False):
+        '''
+        Evaluate a single expression.  All dependencies must already be in the
+        context.
+        '''
         expression = self._expressions.pop(parameter)
 
         # Check whether this is a raw value rather than an Expression
@@ -254,26 +633,45 @@ class ExpressionNamespace(object):
             self._set_value(parameter, expression)
             return expression
 
-        # Evaluate the dependencies first.  Check to see if the dependency is in
-        # self._expressions first since it may actually be part of the global
-        # namespace (e.g. a function name).
-        for d in expression._dependencies:
-            if d in self._expressions:
-                log.debug('Evaluating dependency %s for %s', d, parameter)
-                self._evaluate_value(d, extra_context, dry_run)
-
-        # TODO: how to deal with variables in extra_context that override
-        # cached context variables?  Just use once and discard the value?
-        log.debug('Preparing context for evaluating %s', parameter)
-        context = self._context.copy()
-        if self._extra_context is not None:
-            context.update(self._extra_context)
-        if extra_context is not None:
-            context.update(extra_context)
-
-        next_value = expression._next_when in self._seq_end
+        memoize = False
+        if not dry_run and expression.kind != 'volatile':
+            inputs = self._get_inputs(expression, scope)
+            # Values computed from mutable inputs are not reused (a mutable
+            # value, e.g. a list in the extra context, may have changed even
+            # though it is the same object)
+            memoize = inputs is not None and \
+                all(v is _MISSING or _is_immutable(v) for v in inputs)
+            if not memoize:
+                self._memo.pop(parameter, None)
+            elif parameter in self._memo:
+                memo_inputs, memo_value = self._memo[parameter]
+                if _same_values(inputs, memo_inputs):
+                    log.debug('Inputs of %s unchanged, reusing value',
+                              parameter)
+                    self._set_value(parameter, memo_value)
+                    return memo_value
+        else:
+            inputs = None
+
+        # The values looked up for the memo can be passed directly to the
+        # compiled expression (if a value is missing, let the expression raise
+        # the NameError).
+        if inputs is None or any(v is _MISSING for v in inputs):
+            arguments = None
+        else:
+            arguments = inputs
+
+        scope.clear_local()
+        # A dry run must not advance the sequence generators
+        next_value = not dry_run and expression._next_when in self._seq_end
         try:
-            value = expression.evaluate(context, dry_run, next_value)
+            if self.timer is not None and expression._generator is not None:
+                with self.timer.phase('select'):
+                    value = expression.evaluate(scope, dry_run, next_value,
+                                                arguments)
+            else:
+                value = expression.evaluate(scope, dry_run, next_value,
+                                            arguments)
             log.debug('Successfully computed value for %s', parameter)
         except StopIteration:
             log.debug('%s has reached end of sequence', parameter)
@@ -281,12 +679,33 @@ class ExpressionNamespace(object):
                 log.debug('Resetting sequence for %s', parameter)
                 expression.reset()
                 self._seq_end.append(parameter)
-                value = expression.evaluate(context, dry_run, next_value)
+                value = expression.evaluate(scope, dry_run, next_value,
+                                            arguments)
             else:
                 raise
+        # Mutable values are rebuilt on each trial so that changes made to the
+        # value (e.g. by a setter) do not carry over to the next trial
+        if memoize and _is_immutable(value):
+            self._memo[parameter] = inputs, value
+        else:
+            self._memo.pop(parameter, None)
         self._set_value(parameter, value)
         return value
 
+    def _get_inputs(self, expression, scope):
+        '''
+        Return the values of all names referenced by the expression or None if
+        the expression calls a function provided by the context (which may not
+        return the same value each time).
+        '''
+        inputs = []
+        for d in expression._dependencies:
+            value = scope.get(d, _MISSING)
+            if callable(value):
+                return None
+            inputs.append(value)
+        return inputs
+
 
 class Expression(TraitType):
     '''
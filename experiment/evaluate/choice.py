@@ -3,15 +3,25 @@ Each generator takes a sequence and returns a single element on each call.  The
 order of the elements returned depends on the algorithm.  The generators do not
 modify the sequence.
 
-* When adding a generator, use the check_sequence decorator to ensure
-  that the sequence passed is a shallow copy that you can modify in-place
-  without any side effects.
+* Generators are subclasses of `ChoiceSequence` that compute the order of an
+  entire cycle through the sequence at once (as an array of indices into the
+  sequence).  `take` returns the indices of the next n draws as a single array,
+  which is much faster than calling `next` n times.
 * All generators must be infinite (i.e. they never end) or raise a StopIteration
   error when the sequence is exhausted.
 * Random sequences have a hard dependency on Numpy (the built-in Python random
-  module is suboptimal for scientific work).
+  module is suboptimal for scientific work).  Each generator has its own
+  `RandomState` (seeded with the `seed` argument) so that it cannot be affected
+  by other parts of the code that require random data (e.g. noise).  If no
+  seed is given, it is drawn from the global `np.random` state, so calling
+  `np.random.seed` before creating the generators still reproduces a session.
+* The state of a generator can be saved with `get_state` and restored with
+  `set_state` (e.g. to simulate the upcoming trials without consuming them).
 * If your sequence contains mutable objects, then any modifications to the
   objects themselves will be reflected in the output of the generator.
+* The sequence can be replaced with `update` (e.g. when settings are added,
+  removed or edited).  The elements already presented in the current cycle
+  are not presented again until the next cycle.
 
 Examples
 --------
@@ -39,6 +49,27 @@ then modifications to the mutable object will alter the output of the selector:
     >>> print choice.next()
     [-5, 3]
 
+The indices of the upcoming draws can be obtained in bulk:
+
+    >>> choice = ascending([1, 3, 8, 9, 12, 0, 4])
+    >>> choice.take(9)
+    array([5, 0, 1, 6, 2, 3, 4, 5, 0])
+    >>> state = choice.get_state()
+    >>> choice.next()
+    3
+    >>> choice.set_state(state)
+    >>> choice.next()
+    3
+
+Updating the sequence in the middle of a cycle keeps the position in the cycle:
+
+    >>> choice = ascending([1, 3, 8, 9, 12, 0, 4])
+    >>> [choice.next() for i in range(3)]
+    [0, 1, 3]
+    >>> choice.update([1, 3, 5, 9, 12, 0, 4])
+    >>> [choice.next() for i in range(5)]
+    [4, 5, 9, 12, 0]
+
 An error is also raised when an empty sequence is passed:
 
     >>> choice = ascending([])
@@ -48,29 +79,178 @@ An error is also raised when an empty sequence is passed:
 '''
 
 
-from functools import wraps
+import copy
 import doctest
 
 import numpy as np
 
 
-def check_sequence(f):
+def check_sequence(sequence):
     '''
-    Used to ensure that the sequence has at least one item and passes a shallow
-    copy of the sequence to the selector so that we don't have side-effects if
-    the sequence gets modified elsewhere in the program.
+    Used to ensure that the sequence has at least one item and returns a
+    shallow copy of the sequence so that the selector does not have
+    side-effects if the sequence gets modified elsewhere in the program.
     '''
-    @wraps(f)
-    def wrapper(sequence, *args, **kw):
-        if len(sequence) == 0:
-            raise ValueError("Cannot use an empty sequence")
-        sequence = sequence[:]
-        return f(sequence, *args, **kw)
-    return wrapper
+    if len(sequence) == 0:
+        raise ValueError("Cannot use an empty sequence")
+    # Slicing a Numpy array returns a view rather than a copy, so use the copy
+    # module instead.
+    return copy.copy(sequence)
 
 
-@check_sequence
-def ascending(sequence, c=np.inf):
+class ChoiceSequence(object):
+    '''
+    Base class for the generators
+
+    Subclasses must implement `_next_block`, which returns the indices of the
+    elements for the next cycle through the sequence.
+
+    Parameters
+    ----------
+    sequence : sequence
+        Elements to draw from.  A shallow copy is made.
+    c : {int, np.inf}
+        Number of cycles through the sequence before raising StopIteration.
+    seed : {None, int}
+        Seed for the random number generator (only used by random sequences).
+        If None, the seed is drawn from `np.random`.
+    '''
+
+    random = False
+
+    def __init__(self, sequence, c=np.inf, seed=None):
+        self._set_sequence(check_sequence(sequence))
+        self.c = c
+        if self.random:
+            if seed is None:
+                seed = np.random.randint(np.iinfo(np.int32).max)
+            self.random_state = np.random.RandomState(seed)
+        else:
+            self.random_state = None
+        self._cycle = 0
+        self._block = np.empty(0, dtype=np.intp)
+        self._position = 0
+
+    def _set_sequence(self, sequence):
+        # The sequence has been checked and copied by `check_sequence`
+        self.sequence = sequence
+        # Indices of the elements in a single cycle (in order)
+        self._order = np.arange(len(self.sequence))
+
+    def update(self, sequence):
+        '''
+        Replace the sequence without starting a new cycle
+
+        Elements of the new sequence are matched to the elements of the old
+        sequence by equality.  The remainder of the current cycle is rebuilt
+        from the new sequence, excluding the elements that have already been
+        presented in this cycle.  Removed elements are not presented again and
+        added elements are presented in the remainder of the current cycle
+        (for random generators, at random positions).
+        '''
+        sequence = check_sequence(sequence)
+        mapping = _match(self.sequence, sequence)
+        presented = mapping[self._block[:self._position]]
+        presented = presented[presented >= 0]
+        in_cycle = self._position < len(self._block)
+        self._set_sequence(sequence)
+        if in_cycle:
+            remaining = self._remaining_block(presented)
+            self._block = np.concatenate((presented, remaining))
+            self._position = len(presented)
+        else:
+            self._block = np.empty(0, dtype=np.intp)
+            self._position = 0
+
+    def _remaining_block(self, presented):
+        '''
+        Return the indices of the elements of a cycle that have not been
+        presented yet (in order)
+        '''
+        order = self._order
+        counts = np.bincount(presented, minlength=len(self.sequence))
+        # Number of times each element occurs earlier in the cycle
+        i = np.argsort(order, kind='mergesort')
+        sorted_order = order[i]
+        occurrence = np.empty(len(order), dtype=np.intp)
+        occurrence[i] = np.arange(len(order)) - \
+            np.searchsorted(sorted_order, sorted_order)
+        remaining = order[occurrence >= counts[order]]
+        if self.random:
+            remaining = self.random_state.permutation(remaining)
+        return remaining
+
+    def _next_block(self):
+        raise NotImplementedError
+
+    def _fill(self):
+        '''
+        Generate the next block if the current one is used up.  Returns False
+        if the sequence is exhausted.
+        '''
+        if self._position < len(self._block):
+            return True
+        if self._cycle >= self.c:
+            return False
+        self._block = self._next_block()
+        self._position = 0
+        self._cycle += 1
+        return True
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self._fill():
+            raise StopIteration
+        i = self._block[self._position]
+        self._position += 1
+        return self.sequence[i]
+
+    def take(self, n):
+        '''
+        Return the indices (into `sequence`) of the next n draws
+
+        Fewer than n indices are returned if the sequence is exhausted before
+        then.
+
+        Raises
+        ------
+        StopIteration
+            If the sequence is already exhausted.
+        '''
+        blocks = []
+        while n > 0 and self._fill():
+            block = self._block[self._position:self._position+n]
+            self._position += len(block)
+            n -= len(block)
+            blocks.append(block)
+        if not blocks:
+            raise StopIteration
+        return np.concatenate(blocks)
+
+    def get_state(self):
+        '''
+        Return the current state of the generator
+
+        Blocks are never modified once generated, so the state only references
+        the current block rather than copying it.
+        '''
+        random_state = None
+        if self.random_state is not None:
+            random_state = self.random_state.get_state()
+        return self._cycle, self._block, self._position, random_state
+
+    def set_state(self, state):
+        '''
+        Restore the state returned by `get_state`
+        '''
+        self._cycle, self._block, self._position, random_state = state
+        if random_state is not None:
+            self.random_state.set_state(random_state)
+
+
+class ascending(ChoiceSequence):
     '''
     Returns elements from the sequence in ascending order.  When the last
     element is reached, loop around to the beginning.
@@ -83,16 +263,24 @@ def ascending(sequence, c=np.inf):
     >>> choice.next()
     3
     '''
-    sequence.sort()
-    cycle = 0
-    while cycle < c:
-        for i in range(len(sequence)):
-            yield sequence[i]
-        cycle += 1
 
+    reverse = False
+
+    def __init__(self, sequence, c=np.inf):
+        super(ascending, self).__init__(sequence, c)
 
-@check_sequence
-def descending(sequence, c=np.inf):
+    def _set_sequence(self, sequence):
+        super(ascending, self)._set_sequence(sequence)
+        # Python's sort is stable for both ascending and descending order
+        order = sorted(range(len(self.sequence)), reverse=self.reverse,
+                       key=self.sequence.__getitem__)
+        self._order = np.array(order, dtype=np.intp)
+
+    def _next_block(self):
+        return self._order
+
+
+class descending(ascending):
     '''
     Returns elements from the sequence in descending order.  When the last
     element is reached, loop around to the beginning.
@@ -105,32 +293,33 @@ def descending(sequence, c=np.inf):
     >>> choice.next()
     8
     '''
-    sequence.sort(reverse=True)
-    cycle = 0
-    while cycle < c:
-        for i in range(len(sequence)):
-            yield sequence[i]
-        cycle += 1
+
+    reverse = True
 
 
-@check_sequence
-def pseudorandom(sequence, seed=None):
+class pseudorandom(ChoiceSequence):
     '''
     Returns a randomly selected element from the sequence.
     '''
-    # We need to create a stand-alone generator that cannot be affected by other
-    # parts of the code that may require random data (e.g. noise).
-    from numpy.random import RandomState
-    state = RandomState()
-    state.seed(seed)
-    n = len(sequence)
-    while True:
-        i = state.randint(0, n)
-        yield sequence[i]
 
+    random = True
 
-@check_sequence
-def exact_order(sequence, c=np.inf):
+    # Number of draws generated at a time
+    block_size = 256
+
+    def __init__(self, sequence, seed=None):
+        super(pseudorandom, self).__init__(sequence, np.inf, seed)
+
+    def _next_block(self):
+        n = len(self.sequence)
+        return self.random_state.randint(0, n, size=self.block_size)
+
+    def _remaining_block(self, presented):
+        # Draws are independent, so discard the rest of the block
+        return np.empty(0, dtype=np.intp)
+
+
+class exact_order(ChoiceSequence):
     '''
     Returns elements in the exact order they are provided.
 
@@ -142,31 +331,28 @@ def exact_order(sequence, c=np.inf):
     >>> choice.next()
     8
     '''
-    cycle = 0
-    while cycle < c:
-        for i in range(len(sequence)):
-            yield sequence[i]
-        cycle += 1
 
+    def __init__(self, sequence, c=np.inf):
+        super(exact_order, self).__init__(sequence, c)
 
-@check_sequence
-def shuffled_set(sequence, c=np.inf):
+    def _next_block(self):
+        return self._order
+
+
+class shuffled_set(ChoiceSequence):
     '''
     Returns a randomly selected element from the sequence and removes it from
     the sequence.  Once the sequence is exhausted, repopulate list with the
     original sequence.
     '''
-    cycle = 0
-    while cycle < c:
-        indices = range(len(sequence))
-        np.random.shuffle(indices)  # Shuffle is in-place
-        for i in indices:
-            yield sequence[i]
-        cycle += 1
+
+    random = True
+
+    def _next_block(self):
+        return self.random_state.permutation(len(self.sequence))
 
 
-@check_sequence
-def counterbalanced(sequence, n, c=np.inf):
+class counterbalanced(ChoiceSequence):
     '''
     Ensures that each value in `sequence` is presented an equal number of times
     over `n` trials.  At the end of the set, will regenerate a new list.  If you
@@ -188,17 +374,58 @@ def counterbalanced(sequence, n, c=np.inf):
     5
 
     '''
-    sequence = np.asanyarray(sequence)
-    cycle = 0
-    while cycle < c:
-        full_sequence = np.empty(n, dtype=sequence.dtype)
-        sub_sequences = np.array_split(full_sequence, len(sequence))
-        for s, value in zip(sub_sequences, sequence):
-            s[:] = value
-        np.random.shuffle(full_sequence)
-        for s in full_sequence:
-            yield s
-        cycle += 1
+
+    random = True
+
+    def __init__(self, sequence, n, c=np.inf, seed=None):
+        self.n = n
+        super(counterbalanced, self).__init__(sequence, c, seed)
+
+    def _set_sequence(self, sequence):
+        self.sequence = np.asanyarray(sequence)
+        # Split the n trials as evenly as possible among the elements
+        sizes = [len(s) for s in np.array_split(np.empty(self.n),
+                                                len(sequence))]
+        self._order = np.repeat(np.arange(len(sequence)), sizes)
+
+    def _next_block(self):
+        return self.random_state.permutation(self._order)
+
+
+def _match(old, new):
+    '''
+    Return an array that maps each index in `old` to the index of an equal
+    element in `new` (or -1 if there is none).  Each element in `new` is
+    matched at most once.
+    '''
+    mapping = np.empty(len(old), dtype=np.intp)
+    try:
+        available = {}
+        for j in range(len(new)-1, -1, -1):
+            available.setdefault(_hashable(new[j]), []).append(j)
+        for i in range(len(old)):
+            indices = available.get(_hashable(old[i]))
+            mapping[i] = indices.pop() if indices else -1
+    except TypeError:
+        # Unhashable elements (e.g. dictionaries)
+        unmatched = range(len(new))
+        for i in range(len(old)):
+            for k, j in enumerate(unmatched):
+                if bool(new[j] == old[i]):
+                    mapping[i] = unmatched.pop(k)
+                    break
+            else:
+                mapping[i] = -1
+    return mapping
+
+
+def _hashable(element):
+    if isinstance(element, np.ndarray):
+        return element.tobytes()
+    if isinstance(element, dict):
+        # Raises TypeError if one of the values is unhashable
+        return frozenset(element.items())
+    return element
 
 
 options = {
@@ -0,0 +1,296 @@
+'''
+Compiles parameter expressions
+
+The expression is parsed into an abstract syntax tree (AST) which is used to:
+
+* Find the free variables (i.e. names that must be provided by the namespace
+  the expression is evaluated in).  Unlike `code.co_names`, this excludes
+  attribute names (e.g. `arange` in `np.arange`), keyword argument names and
+  variables bound inside the expression (e.g. by a list comprehension).
+* Determine whether the expression is volatile (i.e. it may return a different
+  value each time it is evaluated, e.g. `np.random.uniform(1, 5)`).
+* Fold calls that only depend on constants and pure functions available in the
+  global namespace (e.g. `octave_space(2e3, 16e3, 0.5)`) into a constant that
+  is computed once at compile time.
+* Build a function that takes the values of the free variables as positional
+  arguments (e.g. `a*b` becomes `lambda a, b: a*b`) with the global namespace
+  bound once.  Calling the function avoids the dictionary lookups of `eval`.
+
+Names in the global namespace are treated as reserved (i.e. a parameter that
+has the same name as a global function will not be recognized as a
+dependency).
+
+Compiled expressions are cached by the expression string and global namespace
+so that identical expressions (e.g. the same expression used across several
+paradigms) are only compiled once.  Only the most recently used expressions
+are kept.  Folded arrays are shared by every evaluation of the
+expression, so they are marked read-only and each evaluation uses a copy (the
+caller may modify the value in place).
+'''
+
+# Expressions are compiled in this module, so they inherit its division
+from __future__ import division
+
+import __builtin__
+import ast
+import numbers
+import threading
+from collections import OrderedDict
+import logging
+log = logging.getLogger(__name__)
+
+import numpy as np
+
+
+# Builtin functions that are safe to call at compile time
+PURE_BUILTINS = set(['abs', 'bool', 'float', 'int', 'len', 'max', 'min',
+                     'round', 'str', 'sum', 'tuple'])
+
+# Types of values that can be shared between evaluations of the expression
+_IMMUTABLE_TYPES = (numbers.Number, basestring, np.generic, type(None))
+
+
+def _is_immutable(value):
+    '''
+    True if the value cannot be modified in place
+    '''
+    if isinstance(value, _IMMUTABLE_TYPES):
+        return True
+    if isinstance(value, (tuple, frozenset)):
+        return all(_is_immutable(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return not value.flags.writeable and not value.dtype.hasobject
+    return False
+
+# Node types that may appear in a subexpression that is folded
+_FOLDABLE_NODES = (ast.Call, ast.Name, ast.Attribute, ast.Num, ast.Str,
+                   ast.List, ast.Tuple, ast.BinOp, ast.UnaryOp, ast.keyword,
+                   ast.operator, ast.unaryop, ast.expr_context)
+
+
+class CompiledExpression(object):
+
+    def __init__(self, code, function, globals, dependencies, global_names,
+                 volatile, constants, tree):
+        # Compiled code object
+        self.code = code
+        # Function that takes the values of the dependencies as positional
+        # arguments
+        self.function = function
+        # Global namespace (including the constants) to evaluate the code in
+        self.globals = globals
+        # Free variables that must be provided by the namespace, in the order
+        # they are evaluated.
+        self.dependencies = dependencies
+        # Free variables that are provided by the global namespace or builtins.
+        # If the namespace defines one of these names, the code must be
+        # evaluated with `eval` since the function always uses the global.
+        self.global_names = global_names
+        # True if the expression may return a different value each time
+        self.volatile = volatile
+        # Mapping of name to value for the folded subexpressions.  The names
+        # are referenced by the compiled code and must be included in the
+        # globals when evaluating.
+        self.constants = constants
+        # AST of the expression (after folding)
+        self.tree = tree
+
+
+class _Analyzer(ast.NodeVisitor):
+    '''
+    Find the free variables and check whether the expression is volatile
+    '''
+
+    def __init__(self, volatile_names):
+        self.volatile_names = volatile_names
+        self.free = []
+        self.volatile = False
+        self._bound = [set()]
+
+    def _is_bound(self, name):
+        return any(name in bound for bound in self._bound)
+
+    def _bind(self, target):
+        for node in ast.walk(target):
+            if isinstance(node, ast.Name):
+                self._bound[-1].add(node.id)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, (ast.Store, ast.Param)):
+            self._bound[-1].add(node.id)
+        elif not self._is_bound(node.id):
+            if node.id in self.volatile_names:
+                self.volatile = True
+            if node.id not in self.free:
+                self.free.append(node.id)
+
+    def visit_Attribute(self, node):
+        if _is_np_random(node):
+            self.volatile = True
+        self.generic_visit(node)
+
+    def visit_Lambda(self, node):
+        # Defaults are evaluated in the enclosing scope
+        for default in node.args.defaults:
+            self.visit(default)
+        self._bound.append(set())
+        self._bind(node.args)
+        self.visit(node.body)
+        self._bound.pop()
+
+    def _visit_comprehension(self, node, elements):
+        # The iterable of the first generator is evaluated in the enclosing
+        # scope.
+        self.visit(node.generators[0].iter)
+        self._bound.append(set())
+        for i, generator in enumerate(node.generators):
+            if i != 0:
+                self.visit(generator.iter)
+            self._bind(generator.target)
+            for condition in generator.ifs:
+                self.visit(condition)
+        for element in elements:
+            self.visit(element)
+        self._bound.pop()
+
+    def visit_ListComp(self, node):
+        self._visit_comprehension(node, [node.elt])
+
+    def visit_GeneratorExp(self, node):
+        self._visit_comprehension(node, [node.elt])
+
+    def visit_SetComp(self, node):
+        self._visit_comprehension(node, [node.elt])
+
+    def visit_DictComp(self, node):
+        self._visit_comprehension(node, [node.key, node.value])
+
+
+def _is_np_random(node):
+    return isinstance(node, ast.Attribute) and node.attr == 'random' and \
+        isinstance(node.value, ast.Name) and node.value.id == 'np'
+
+
+class _Folder(ast.NodeTransformer):
+    '''
+    Replace calls that only depend on constants and pure functions with a
+    reference to the precomputed value
+    '''
+
+    def __init__(self, global_namespace, volatile_names):
+        self.global_namespace = global_namespace
+        self.volatile_names = volatile_names
+        self.constants = {}
+
+    def _is_foldable(self, node):
+        for child in ast.walk(node):
+            if not isinstance(child, _FOLDABLE_NODES):
+                return False
+            if _is_np_random(child):
+                return False
+            if isinstance(child, ast.Name):
+                if child.id in self.volatile_names:
+                    return False
+                if child.id not in self.global_namespace and \
+                        child.id not in PURE_BUILTINS:
+                    return False
+        return True
+
+    def visit_Call(self, node):
+        if self._is_foldable(node):
+            try:
+                expression = ast.fix_missing_locations(ast.Expression(node))
+                code = compile(expression, '<string>', 'eval')
+                value = eval(code, self.global_namespace)
+            except Exception as e:
+                # Leave the call as-is so the error is raised when the
+                # expression is evaluated.
+                log.debug('Unable to fold %s: %s', ast.dump(node), e)
+            else:
+                if isinstance(value, np.ndarray) and \
+                        not value.dtype.hasobject:
+                    # Evaluates to a copy of the folded array
+                    value.flags.writeable = False
+                    name = self._add_constant(value)
+                    attr = ast.Attribute(ast.Name(name, ast.Load()), 'copy',
+                                         ast.Load())
+                    new_node = ast.Call(attr, [], [], None, None)
+                    new_node = ast.copy_location(new_node, node)
+                    return ast.fix_missing_locations(new_node)
+                elif _is_immutable(value):
+                    name = self._add_constant(value)
+                    new_node = ast.Name(name, ast.Load())
+                    return ast.copy_location(new_node, node)
+        return self.generic_visit(node)
+
+    def _add_constant(self, value):
+        name = '__constant_{}'.format(len(self.constants))
+        self.constants[name] = value
+        return name
+
+
+def _build_function(tree, arguments, global_namespace):
+    args = [ast.Name(a, ast.Param()) for a in arguments]
+    node = ast.Lambda(ast.arguments(args, None, None, []), tree.body)
+    node = ast.fix_missing_locations(ast.Expression(node))
+    return eval(compile(node, '<string>', 'eval'), global_namespace)
+
+
+# Maps the expression and the id of the global namespace to the namespace
+# (which is kept alive so that the id is not reused while cached) and the
+# compiled expression.
+_CACHE_SIZE = 1024
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def compile_expression(expression, global_namespace, volatile_names=()):
+    '''
+    Compile the expression (see module docstring for details)
+
+    Parameters
+    ----------
+    expression : str
+        Python expression
+    global_namespace : dict
+        Global namespace the expression will be evaluated in.
+    volatile_names : set
+        Names in the global namespace that may return a different value each
+        time they are called.
+
+    Returns
+    -------
+    compiled : CompiledExpression
+    '''
+    key = expression, id(global_namespace)
+    with _cache_lock:
+        entry = _cache.pop(key, None)
+        if entry is not None and entry[0] is global_namespace:
+            _cache[key] = entry
+            return entry[1]
+
+    tree = ast.parse(expression, '<string>', 'eval')
+    analyzer = _Analyzer(volatile_names)
+    analyzer.visit(tree)
+    dependencies = [n for n in analyzer.free if n not in global_namespace and
+                    not hasattr(__builtin__, n)]
+    global_names = [n for n in analyzer.free if n not in dependencies]
+
+    key_namespace = global_namespace
+    folder = _Folder(global_namespace, volatile_names)
+    tree = folder.visit(tree)
+    constants = folder.constants
+    if constants:
+        global_namespace = global_namespace.copy()
+        global_namespace.update(constants)
+
+    code = compile(tree, '<string>', 'eval')
+    function = _build_function(tree, dependencies, global_namespace)
+    compiled = CompiledExpression(code, function, global_namespace,
+                                  dependencies, global_names,
+                                  analyzer.volatile, constants, tree)
+    with _cache_lock:
+        _cache[key] = key_namespace, compiled
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return compiled
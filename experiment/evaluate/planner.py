@@ -0,0 +1,186 @@
+'''
+Speculative evaluation of upcoming trials
+
+The planner evaluates the context of the next few trials ahead of time (e.g.
+while waiting for the subject to respond) so that the context is available
+immediately when the trial starts.  Values are drawn from the sequence
+generators via `ParameterExpression.peek`, which buffers the values rather than
+consuming them.  Values that are not used (e.g. if the plan is discarded)
+therefore remain available to the live evaluation in the original order.
+
+A planned trial is only committed if nothing it depended on has changed since
+it was planned:
+
+* The values in the extra context (e.g. the outcome of the previous trial)
+  must be the same as those used for planning.  Since the extra context of a
+  future trial is not known, the current extra context is used for planning.
+* None of the generators may have been advanced or reset by a live evaluation
+  in the meantime.
+
+Otherwise, all planned trials are discarded and the context is evaluated as
+usual.  Planning ends at the first trial where a sequence is exhausted since
+what happens next (e.g. the sequence restarts and advances the expressions
+that use `u(...)`) is only determined when the trial is actually evaluated.
+
+The planner assumes that every expression in the namespace is evaluated on each
+trial (e.g. via `evaluate_values`) since committing a trial advances all the
+generators.
+'''
+
+from collections import deque
+
+import logging
+log = logging.getLogger(__name__)
+
+from . import (ParameterExpression, GENERATOR_TYPES, _Scope, _MISSING,
+               _same_values)
+
+
+class _Unplannable(Exception):
+    pass
+
+
+class TrialPlanner(object):
+    '''
+    Evaluates the context of upcoming trials for an `ExpressionNamespace`
+
+    Parameters
+    ----------
+    namespace : ExpressionNamespace
+        Namespace to plan trials for.
+    depth : int
+        Maximum number of trials to plan ahead.
+    '''
+
+    def __init__(self, namespace, depth=1):
+        self.namespace = namespace
+        self.depth = depth
+        self._planned = deque()
+
+        # Names the expressions may read from the extra context.  These are
+        # the inputs that are checked before committing a planned trial.
+        inputs = set()
+        for name, e in namespace._cached_expressions.items():
+            inputs.add(name)
+            if isinstance(e, ParameterExpression):
+                inputs.update(e._dependencies)
+        self._input_names = sorted(inputs)
+
+    def __len__(self):
+        return len(self._planned)
+
+    def discard(self):
+        '''
+        Discard all planned trials
+        '''
+        if self._planned:
+            log.debug('Discarding %d planned trials', len(self._planned))
+            self._planned.clear()
+
+    def plan(self, extra_context=None):
+        '''
+        Plan trials until `depth` trials are available or a trial cannot be
+        planned
+
+        Parameters
+        ----------
+        extra_context : {None, dict}
+            Extra context that will be used for the upcoming trials.
+
+        Returns
+        -------
+        n : int
+            Number of trials that are currently planned.
+        '''
+        if extra_context is None:
+            extra_context = {}
+        inputs = [extra_context.get(n, _MISSING) for n in self._input_names]
+        while len(self._planned) < self.depth:
+            try:
+                trial = self._plan_trial(len(self._planned), extra_context)
+            except _Unplannable as e:
+                log.debug('Unable to plan trial: %s', e)
+                break
+            self._planned.append((inputs, trial))
+        return len(self._planned)
+
+    def _plan_trial(self, offset, extra_context):
+        '''
+        Evaluate the context of the trial `offset` trials after the next one
+        '''
+        namespace = self.namespace
+        context = {}
+        positions = {}
+        scope = _Scope(extra_context, context)
+        for name in namespace._order:
+            e = namespace._cached_expressions[name]
+            if not isinstance(e, ParameterExpression):
+                value = e
+            elif e._next_when is not None and e._generator is not None:
+                # Only advances when the sequence it depends on is exhausted,
+                # which ends the plan.
+                positions[name] = e._generator, e._drawn
+                value = e._cached_value
+            elif e._generator is not None:
+                # Each of the trials committed before this one will consume a
+                # value.
+                positions[name] = e._generator, e._drawn + offset
+                try:
+                    value = e.peek(offset)
+                except StopIteration:
+                    raise _Unplannable('{} is exhausted'.format(name))
+            elif e._code is None:
+                value = e._cached_value
+            else:
+                scope.clear_local()
+                try:
+                    value = e._call(scope)
+                except StopIteration:
+                    raise _Unplannable('{} is exhausted'.format(name))
+                if isinstance(value, GENERATOR_TYPES):
+                    # The generator is created by the first live evaluation
+                    raise _Unplannable('{} is not initialized'.format(name))
+            context[name] = value
+        return context, positions
+
+    def commit(self, extra_context=None):
+        '''
+        Install the next planned trial in the namespace
+
+        The namespace must have been reset (i.e. no values are evaluated yet).
+
+        Returns
+        -------
+        committed : bool
+            False if there was no planned trial or the planned trial was
+            discarded.  If False, the context must be evaluated as usual.
+        '''
+        if not self._planned:
+            return False
+        if extra_context is None:
+            extra_context = {}
+        inputs, (context, positions) = self._planned.popleft()
+        current = [extra_context.get(n, _MISSING) for n in self._input_names]
+        if not _same_values(inputs, current):
+            log.debug('Extra context changed since trial was planned')
+            self.discard()
+            return False
+
+        # None of the generators can have been advanced (other than by
+        # committing the preceding trials) or reset since planning.
+        namespace = self.namespace
+        for name, (generator, drawn) in positions.items():
+            e = namespace._cached_expressions[name]
+            if e._generator is not generator or e._drawn != drawn:
+                log.debug('%s was evaluated since trial was planned', name)
+                self.discard()
+                return False
+
+        log.debug('Committing planned trial')
+        for name in namespace._order:
+            e = namespace._cached_expressions[name]
+            if name in positions and e._next_when is None:
+                # Consume the value that was peeked
+                e.evaluate(next_value=True)
+            namespace._set_value(name, context[name])
+        return True
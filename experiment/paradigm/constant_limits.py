@@ -1,3 +1,4 @@
+import numpy as np
 from traits.api import HasTraits, Bool, Instance, List, Trait, Any
 from traitsui.api import VGroup, Item, View, Include
 
@@ -34,31 +35,47 @@ class GoNogoCLControllerMixin(object):
     remind_requested = Bool(False)
     selectors = List()
 
-    def _create_selectors(self):
-        # The selectors are generator functions which yield values from a list
-        # of elements. In this case, we initialize the selector (the generator)
+    # Setting table and orders the selectors were last updated from
+    _selector_source = None
+
+    def _update_selectors(self):
+        # The selectors are generators which yield values from a list of
+        # elements. In this case, we initialize the selector (the generator)
         # with a list of the setting dictionaries. If we wish for a certain
         # parameter to be presented multiple times in a single set, we need to
-        # repeat this parameter in the list (e.g. if repeats is >= 1).
+        # repeat this parameter in the list (e.g. if repeats is >= 1).  The
+        # setting table is cached by the selector until the settings change, so
+        # checking for changes is cheap.  The settings are read from the shadow
+        # paradigm so that changes made in the GUI only take effect once they
+        # are applied (and can be reverted until then).  Applying the changes
+        # replaces the shadow copy of the selector.
+        selector = self.shadow_paradigm.selector
+        orders = tuple(getattr(selector, '{}_order'.format(t))
+                       for t in SETTING_TYPES)
+        source = selector.get_setting_table(), orders
+        if self._selector_source is not None and \
+                self._selector_source[0] is source[0] and \
+                self._selector_source[1] == orders:
+            return
+        # Existing selectors are updated in place so that they keep their
+        # position in the current cycle (selectors whose settings did not
+        # change are left as-is).
         for setting_type in SETTING_TYPES:
-            selector = self.paradigm.selector.create_selector(setting_type)
-            setattr(self, 'current_sequence_{}'.format(setting_type), selector)
+            name = 'current_sequence_{}'.format(setting_type)
+            current = getattr(self, name, None)
+            setattr(self, name, selector.update_selector(current, setting_type))
+        self._selector_source = source
 
     def next_setting(self):
         # Must be able to handle both the initial (first trial) and repeat nogo
         # cases as needed.  Check for special cases first.
+        self._update_selectors()
         if self.remind_requested:
             self.remind_requested = False
             return self.current_sequence_GO_REMIND.next()
         if len(self.model.data.trial_log) == 0:
             return self.current_sequence_GO_REMIND.next()
 
-        # Now, check to see if we need to update the selector
-        if self.current_sequence is None or \
-                self.value_changed('go_setting_order') or \
-                self.value_changed('go_settings'):
-            self._create_selectors()
-
         # This is a regular case.  Select the appropriate setting.
         spout = self.model.data.yes_seq[-1]
         nogo = self.model.data.nogo_seq[-1]
@@ -0,0 +1,306 @@
+'''
+Runs several experiments in the same process
+
+Each experiment (a controller and its data) runs on its own `TrialEngine`, so
+a slow experiment does not delay the trials of the others.  The experiments
+share the resources that should not be duplicated:
+
+* `SharedWriter` serializes all access to HDF5 (PyTables is not thread-safe)
+  and periodically flushes the buffered trial and event logs of each
+  experiment from a background thread.
+* `RenderScheduler` runs the GUI updates of all experiments on the GUI thread,
+  spending at most a fixed amount of time per pass so that the GUI remains
+  responsive when many experiments update at once.
+* `MemoryBudget` limits the total memory used by the buffered logs and the
+  in-memory trial columns.
+
+    >>> rig = Rig(memory_budget=64e6)
+    >>> engine_a = rig.add('booth_a', controller_a)
+    >>> engine_b = rig.add('booth_b', controller_b)
+    >>> engine_a.start()
+    >>> engine_b.start()
+    >>> ...
+    >>> rig.close()
+
+Experiments must be added before they are started (i.e. before the tables are
+created).  Any other code that accesses the data files while the rig is
+running (e.g. code writing acquired samples to a channel) must hold
+`rig.writer.lock`.
+'''
+
+import threading
+from collections import OrderedDict
+
+import logging
+log = logging.getLogger(__name__)
+
+from .timing import clock, LatencyStats
+from .trial_engine import TrialEngine, GUIUpdater
+
+
+class MemoryBudget(object):
+    '''
+    Tracks the memory reserved by several consumers against a limit
+
+    Parameters
+    ----------
+    max_bytes : int
+        Total number of bytes that can be reserved.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._reserved = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key, nbytes):
+        '''
+        Set the number of bytes reserved for key (replacing the previous
+        reservation for the key, if any)
+
+        Raises
+        ------
+        MemoryError
+            If the reservation would exceed the budget.  The previous
+            reservation is kept.
+        '''
+        with self._lock:
+            used = self._used() - self._reserved.get(key, 0) + nbytes
+            if used > self.max_bytes:
+                mesg = 'Reserving {} bytes for {} would exceed the budget ' \
+                    '({} of {} bytes used)'
+                raise MemoryError(mesg.format(nbytes, key, self._used(),
+                                              self.max_bytes))
+            self._reserved[key] = nbytes
+
+    def release(self, key):
+        with self._lock:
+            self._reserved.pop(key, None)
+
+    def _used(self):
+        return sum(self._reserved.values())
+
+    @property
+    def used(self):
+        with self._lock:
+            return self._used()
+
+    @property
+    def available(self):
+        return self.max_bytes - self.used
+
+
+class SharedWriter(object):
+    '''
+    Flushes the logs of several experiments from a background thread
+
+    Parameters
+    ----------
+    interval : float
+        Time (in seconds) between flushes.
+    maxlen : int
+        Number of recent flush durations retained for computing percentiles.
+    '''
+
+    def __init__(self, interval=1.0, maxlen=1000):
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.stats = LatencyStats(maxlen)
+        self._data = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='SharedWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def register(self, data):
+        '''
+        Add an `AbstractData` to the writer
+
+        Access to the tables is serialized using the writer's lock, and the
+        logs are no longer flushed when rows are appended.
+        '''
+        with self.lock:
+            data.hdf5_lock = self.lock
+            data.background_flush = True
+            self._data.append(data)
+
+    def unregister(self, data):
+        '''
+        Flush the logs and remove the `AbstractData` from the writer
+        '''
+        with self.lock:
+            self._data.remove(data)
+            data.flush_logs()
+            data.background_flush = False
+            data.hdf5_lock = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def flush(self):
+        '''
+        Flush the logs of all registered experiments
+        '''
+        start = clock()
+        with self.lock:
+            files = set()
+            for data in self._data:
+                try:
+                    data.flush_logs()
+                    if data.fh is not None:
+                        files.add(data.fh)
+                except Exception:
+                    log.exception('Error flushing %r', data)
+            for fh in files:
+                fh.flush()
+        self.stats.add(clock()-start)
+
+    def close(self):
+        '''
+        Stop the background thread and flush the logs one last time
+        '''
+        if not self._stop.is_set():
+            self._stop.set()
+            self._thread.join()
+            self.flush()
+
+
+class RenderScheduler(GUIUpdater):
+    '''
+    GUI updater that limits the time spent running updates in each pass
+
+    Updates that do not fit in the budget are run on the next pass (before any
+    updates posted since), so each experiment gets a turn even when the GUI
+    cannot keep up.  At least one update is run on each pass.
+
+    Parameters
+    ----------
+    budget : float
+        Maximum time (in seconds) to spend running updates before returning
+        control to the GUI event loop.
+    dispatch : {None, callable}
+        See `GUIUpdater`.
+    '''
+
+    def __init__(self, budget=0.02, dispatch=None):
+        super(RenderScheduler, self).__init__(dispatch)
+        self.budget = budget
+        self.deferred = 0
+
+    def flush(self):
+        deadline = clock() + self.budget
+        pending = self._take_pending()
+        for i, (key, update) in enumerate(pending):
+            if i and clock() >= deadline:
+                break
+            self._run_update(key, *update)
+        else:
+            return
+
+        # Requeue the remaining updates ahead of the ones posted since (unless
+        # they have been replaced by a more recent update).
+        deferred = OrderedDict(pending[i:])
+        with self._lock:
+            for key, update in self._pending.items():
+                deferred.pop(key, None)
+                deferred[key] = update
+            self.deferred += len(pending) - i
+            self._pending = deferred
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.dispatch(self.flush)
+
+
+class Rig(object):
+    '''
+    Runs several experiments that share a writer, a render scheduler and a
+    memory budget
+
+    Parameters
+    ----------
+    writer_interval : float
+        See `SharedWriter`.
+    render_budget : float
+        See `RenderScheduler`.
+    memory_budget : {None, int}
+        Total number of bytes that can be used for buffering by all
+        experiments.  If None, the memory is not limited.
+    dispatch : {None, callable}
+        See `GUIUpdater`.
+    '''
+
+    def __init__(self, writer_interval=1.0, render_budget=0.02,
+                 memory_budget=None, dispatch=None):
+        self.writer = SharedWriter(writer_interval)
+        self.renderer = RenderScheduler(render_budget, dispatch)
+        if memory_budget is not None:
+            memory_budget = MemoryBudget(memory_budget)
+        self.memory_budget = memory_budget
+        self.engines = OrderedDict()
+        self._data = {}
+
+    def add(self, name, controller, data=None):
+        '''
+        Add an experiment and return the `TrialEngine` that runs it
+
+        Parameters
+        ----------
+        name : str
+            Name of the experiment (must be unique).
+        controller : AbstractController
+            Controller of the experiment.
+        data : {None, AbstractData}
+            Data of the experiment.  If None, `controller.model.data` is used.
+        '''
+        if name in self.engines:
+            raise ValueError('Experiment {} already added'.format(name))
+        if data is None:
+            data = controller.model.data
+        if data.trial_log is not None:
+            raise ValueError('Experiment {} already started'.format(name))
+        data.memory_budget = self.memory_budget
+        self.writer.register(data)
+        engine = TrialEngine(controller, gui_updater=self.renderer,
+                             name='TrialEngine-{}'.format(name))
+        self.engines[name] = engine
+        self._data[name] = data
+        return engine
+
+    def remove(self, name):
+        '''
+        Wait for the submitted commands of the experiment to run, flush its
+        logs and release its memory
+        '''
+        engine = self.engines.pop(name)
+        data = self._data.pop(name)
+        try:
+            engine.close()
+        finally:
+            self.writer.unregister(data)
+            data.release_memory()
+            data.memory_budget = None
+
+    def close(self):
+        try:
+            for name in list(self.engines):
+                self.remove(name)
+        finally:
+            self.writer.close()
+
+    def get_summary(self, percentiles=(50, 90, 99)):
+        '''
+        Return a dictionary with the summary of each engine (see
+        `TrialEngine.get_summary`), the time spent flushing the logs and the
+        memory used
+        '''
+        summary = {
+            'engines': OrderedDict((n, e.get_summary(percentiles))
+                                   for n, e in self.engines.items()),
+            'writer': self.writer.stats.summary(percentiles),
+            'gui_updates_deferred': self.renderer.deferred,
+        }
+        if self.memory_budget is not None:
+            summary['memory_used'] = self.memory_budget.used
+        return summary
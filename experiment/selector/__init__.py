@@ -1,5 +1,6 @@
 from .abstract_selector import AbstractSelector
 from .fixed_sequence import ListSelector, MultiTypeListSelector
+from .setting_table import SettingTable, SettingRow
 
 def get_selectors(setting_types=None):
     '''
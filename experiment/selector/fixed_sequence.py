@@ -1,12 +1,13 @@
 from collections import OrderedDict
 
-from traits.api import Button, List, Instance, Trait
+from traits.api import Button, List, Instance, Trait, Any
 from traitsui.api import (TabularEditor, View, Item, HGroup, VGroup, spring,
                           Include)
 from traitsui.tabular_adapter import TabularAdapter
 
 from ..evaluate import choice
 from .abstract_selector import AbstractSelector
+from .setting_table import SettingTable
 
 
 ###############################################################################
@@ -19,6 +20,8 @@ class DictTabularAdapter(TabularAdapter):
 
     def _set_text(self, value):
         self.item[self.column_id] = value
+        # The selector does not see changes made to the settings in place
+        self.object.settings_updated()
 
     def _get_bg_color(self):
         if 'setting_type' in self.item:
@@ -41,10 +44,49 @@ class BaseListSelector(AbstractSelector):
     _sort = Button('Sort')
     _remove = Button('-')
 
+    # Copy of the sequence as a `SettingTable` (created when needed)
+    _setting_table = Any(transient=True)
+
     def __init__(self):
         self._parameters = OrderedDict()
         self._selected_settings = None
 
+    def _clone(self):
+        return self.__class__()
+
+    def __deepcopy__(self, memo):
+        # Called when the paradigm is cloned (e.g. for the shadow paradigm).
+        # `HasTraits.clone_traits` does not call `__init__`, so the parameters
+        # (and any traits added by `__init__`) would be missing from the copy.
+        if id(self) in memo:
+            return memo[id(self)]
+        new = self._clone()
+        memo[id(self)] = new
+        new._parameters = self._parameters.copy()
+        new.copy_traits(self, self.copyable_trait_names(), memo, 'deep')
+        return new
+
+    def _sequence_changed(self):
+        self._setting_table = None
+
+    def _sequence_items_changed(self):
+        self._setting_table = None
+
+    def settings_updated(self):
+        '''
+        Must be called when a setting in the sequence is modified in place
+        '''
+        self._setting_table = None
+
+    def get_setting_table(self):
+        '''
+        Return the settings in the sequence as a `SettingTable`
+        '''
+        if self._setting_table is None:
+            names = self._hidden_keys + self._parameters.keys()
+            self._setting_table = SettingTable.from_dicts(self.sequence, names)
+        return self._setting_table
+
     def add_parameter(self, parameter, label=None, default_value=None):
         if parameter in self._parameters:
             raise ValueError('Parameter already exists')
@@ -53,6 +95,7 @@ class BaseListSelector(AbstractSelector):
         self._parameters[parameter] = label
         for setting in self.sequence:
             setting[parameter] = default_value
+        self.settings_updated()
 
     def remove_parameter(self, parameter):
         if parameter not in self._parameters:
@@ -60,6 +103,7 @@ class BaseListSelector(AbstractSelector):
         self._parameters.remove(parameter)
         for setting in self.sequence:
             del(setting[parameter])
+        self.settings_updated()
 
     def _new_setting(self):
         if self._selected_settings:
@@ -88,7 +132,8 @@ class BaseListSelector(AbstractSelector):
         self.remove_selected_settings()
 
     def __sort_fired(self):
-        self.sequence = sorted(self.sequence)
+        index = self.get_setting_table().sort_index()
+        self.sequence = [self.sequence[i] for i in index]
 
     def _buttons_view(self):
         raise NotImplementedError
@@ -163,6 +208,9 @@ class MultiTypeListSelector(BaseListSelector):
             self.on_trait_change(cb, button_name)
         self._buttons.extend(['_remove', '_sort'])
 
+    def _clone(self):
+        return self.__class__(*self.setting_types)
+
     def add_setting(self, trial_type, setting=None):
         if setting is None:
             setting = self._new_setting()
@@ -176,13 +224,31 @@ class MultiTypeListSelector(BaseListSelector):
         return VGroup(*self._sequences)
 
     def get_sequence(self, setting_type):
-        return [s for s in self.sequence if s['setting_type'] == setting_type]
+        table = self.get_setting_table().select(setting_type=setting_type)
+        return table.records()
 
     def create_selector(self, setting_type):
         order = getattr(self, '{}_order_'.format(setting_type))
         sequence = self.get_sequence(setting_type)
         return order(sequence)
 
+    def update_selector(self, selector, setting_type):
+        '''
+        Return a selector for the setting type that reflects the current
+        sequence
+
+        If the order is unchanged, the existing selector is updated in place
+        (see `ChoiceSequence.update`) so that the position in the current cycle
+        is kept.  Otherwise, a new selector is created.
+        '''
+        order = getattr(self, '{}_order_'.format(setting_type))
+        if selector is None or type(selector) is not order:
+            return self.create_selector(setting_type)
+        sequence = self.get_sequence(setting_type)
+        if sequence != list(selector.sequence):
+            selector.update(sequence)
+        return selector
+
 
 def main():
     selector = MultiTypeListSelector('GO', 'GO_REMIND', 'NOGO')
@@ -0,0 +1,283 @@
+'''
+Array-backed table of trial settings
+
+The selectors store their settings as a list of dictionaries (which is what
+the `TabularEditor` edits).  For large sweeps (e.g. thousands of settings),
+filtering, sorting and removing duplicates from the list in Python is slow.
+`SettingTable` copies the settings into a structured array once so that these
+operations are vectorized:
+
+    >>> table = SettingTable.from_dicts([
+    ...     {'setting_type': 'GO', 'level': 20},
+    ...     {'setting_type': 'NOGO', 'level': 0},
+    ...     {'setting_type': 'GO', 'level': 10},
+    ...     {'setting_type': 'GO', 'level': 20},
+    ... ], ['setting_type', 'level'])
+    >>> go = table.select(setting_type='GO')
+    >>> [row['level'] for row in go.sort().dedupe()]
+    [10, 20]
+
+Indexing or iterating over the table returns `SettingRow` objects, which are
+lightweight views of a row that support the dictionary interface used by the
+selectors and `DictTabularAdapter`.
+
+Converting the values to arrays may change their type (e.g. integers in a
+column that also contains floats are converted to floats).  The comparisons
+are not affected, but the values returned by the rows are read from the
+dictionaries the table was created from (see `records`) when available.
+'''
+
+import numpy as np
+
+
+class SettingRow(object):
+    '''
+    View of a row in a `SettingTable`
+
+    Values are read from (and written to) the table.  Rows compare (and hash)
+    by their values in the order of the table columns.
+    '''
+
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getitem__(self, name):
+        if name not in self._table.names:
+            raise KeyError(name)
+        if self._table._records is not None:
+            return self._table._records[self._index][name]
+        value = self._table.data[name][self._index]
+        return value.item() if isinstance(value, np.generic) else value
+
+    def __setitem__(self, name, value):
+        try:
+            self._table.data[name][self._index] = value
+        except ValueError:
+            raise KeyError(name)
+        if self._table._records is not None:
+            self._table._records[self._index][name] = value
+        self._table._invalidate()
+
+    def __contains__(self, name):
+        return name in self._table.names
+
+    def __iter__(self):
+        return iter(self._table.names)
+
+    def __len__(self):
+        return len(self._table.names)
+
+    def keys(self):
+        return list(self._table.names)
+
+    def values(self):
+        return [self[n] for n in self._table.names]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def copy(self):
+        '''
+        Return the values of the row as a dictionary
+        '''
+        return dict(self.items())
+
+    def _key(self):
+        return self._table.data[self._index].item()
+
+    def __eq__(self, other):
+        if isinstance(other, SettingRow):
+            return self._key() == other._key()
+        if isinstance(other, dict):
+            return self.copy() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __lt__(self, other):
+        if not isinstance(other, SettingRow):
+            return NotImplemented
+        return self._key() < other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return '<SettingRow {}>'.format(self.copy())
+
+
+class SettingTable(object):
+    '''
+    Trial settings stored as a structured array
+
+    Parameters
+    ----------
+    data : array
+        Structured array with one field per parameter.  The order of the fields
+        determines the default sort order.
+    records : {None, list of dict}
+        Dictionaries the rows were created from (in the same order).
+    '''
+
+    def __init__(self, data, records=None):
+        self.data = data
+        self.names = data.dtype.names
+        self._records = records
+        self._invalidate()
+
+    @classmethod
+    def from_dicts(cls, settings, names=None):
+        '''
+        Create a table from a sequence of dictionaries
+
+        Parameters
+        ----------
+        settings : sequence of dict
+            Settings.  All settings must have a value for each name.
+        names : {None, list of str}
+            Names of the columns.  If None, the sorted keys of the first setting
+            are used.
+        '''
+        if names is None:
+            names = sorted(settings[0].keys()) if settings else []
+        settings = list(settings)
+        if not len(settings):
+            return cls(np.empty(0, dtype=[(n, 'O') for n in names]), [])
+        columns = [np.array([s[n] for s in settings]) for n in names]
+        dtype = [(n, c.dtype) for n, c in zip(names, columns)]
+        data = np.empty(len(settings), dtype=dtype)
+        for name, column in zip(names, columns):
+            data[name] = column
+        return cls(data, settings)
+
+    def _invalidate(self):
+        # Cached sort order and row keys (computed when needed)
+        self._sort_index = None
+        self._row_keys = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.data)
+        if not 0 <= index < len(self.data):
+            raise IndexError('Index out of range')
+        return SettingRow(self, index)
+
+    def __iter__(self):
+        for i in range(len(self.data)):
+            yield SettingRow(self, i)
+
+    def to_dicts(self):
+        '''
+        Return the values of each row as a new dictionary
+        '''
+        return [row.copy() for row in self]
+
+    def records(self):
+        '''
+        Return the dictionaries the rows were created from (or new
+        dictionaries if the table was not created from dictionaries)
+        '''
+        if self._records is None:
+            return self.to_dicts()
+        return list(self._records)
+
+    def take(self, indices):
+        '''
+        Return a new table containing the rows at the given indices
+        '''
+        records = None
+        if self._records is not None:
+            records = [self._records[i] for i in indices]
+        return SettingTable(self.data[indices], records)
+
+    def mask(self, **criteria):
+        '''
+        Return a boolean array indicating the rows where each column has the
+        given value
+        '''
+        mask = np.ones(len(self.data), dtype=bool)
+        for name, value in criteria.items():
+            mask &= self.data[name] == value
+        return mask
+
+    def select(self, **criteria):
+        '''
+        Return a new table containing only the rows where each column has the
+        given value (e.g. `table.select(setting_type='GO')`)
+        '''
+        return self.take(np.flatnonzero(self.mask(**criteria)))
+
+    def sort_index(self, order=None):
+        '''
+        Return the indices that sort the table (the sort is stable)
+
+        Parameters
+        ----------
+        order : {None, list of str}
+            Columns to sort by.  If None, the table is sorted by all columns in
+            order.
+        '''
+        if order is not None:
+            return self._lexsort(order)
+        if self._sort_index is None:
+            self._sort_index = self._lexsort(self.names)
+        return self._sort_index
+
+    def _lexsort(self, order):
+        # Unlike `np.argsort`, ties are not broken by the remaining fields
+        if not len(self.data):
+            return np.arange(0)
+        return np.lexsort([self.data[n] for n in reversed(order)])
+
+    def sort(self, order=None):
+        '''
+        Return a new table with the rows sorted (see `sort_index`)
+        '''
+        return self.take(self.sort_index(order))
+
+    def _get_row_keys(self):
+        # Each row viewed as a single opaque value so that rows can be compared
+        # as a whole.
+        if self._row_keys is None:
+            dtype = np.dtype((np.void, self.data.dtype.itemsize))
+            self._row_keys = np.ascontiguousarray(self.data).view(dtype)
+        return self._row_keys
+
+    def unique_index(self):
+        '''
+        Return the indices of the first occurrence of each unique row (in the
+        order they appear in the table)
+        '''
+        if self.data.dtype.hasobject:
+            seen = set()
+            indices = []
+            for i, key in enumerate(self.data.tolist()):
+                if key not in seen:
+                    seen.add(key)
+                    indices.append(i)
+            return np.array(indices, dtype=int)
+        _, indices = np.unique(self._get_row_keys(), return_index=True)
+        return np.sort(indices)
+
+    def dedupe(self):
+        '''
+        Return a new table with duplicate rows removed (the first occurrence of
+        each row is kept)
+        '''
+        return self.take(self.unique_index())
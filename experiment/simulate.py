@@ -0,0 +1,297 @@
+'''
+Headless simulation of the trial loop
+
+Drives a controller through a sequence of trials without a GUI.  The responses
+of the subject are generated by a `SubjectModel`.  This is useful for checking
+that a new paradigm behaves as expected (e.g. the sequence of settings and the
+resulting trial log) and for load-testing the trial loop.
+
+    >>> simulator = Simulator(MyController(), MyParadigm(),
+    ...                       PsychometricSubject('level', 30, 0.2))
+    >>> result = simulator.run(1000)
+    >>> print result['trials_per_second']
+
+The data is stored in an in-memory HDF5 file unless a data object is provided.
+Neither the simulator nor `AbstractController` import the GUI toolkit (i.e.
+`traitsui.api` or `pyface.api`), so controllers can be simulated without a
+display as long as their modules do not import it either.  `AbstractController`
+only depends on the small `traitsui.handler` module, which it needs as its base
+class.
+
+Each trial consists of the following phases (the time spent in each is
+tracked):
+
+    evaluate_pending_expressions
+        Compute the context for the trial.
+    subject
+        Generate the response of the subject.
+    log_trial
+        Save the trial to the trial log.
+    next_trial
+        Prepare the next trial.  The time spent in `refresh_context` (which is
+        typically called by `next_trial`) is reported separately as well as
+        being included in the time for `next_trial`.
+'''
+
+from collections import OrderedDict
+from functools import wraps
+import itertools
+
+import logging
+log = logging.getLogger(__name__)
+
+import numpy as np
+from traits.api import HasTraits, Any
+
+from .timing import clock, LatencyStats
+
+
+class SubjectModel(object):
+    '''
+    Generates the response of the subject on each trial
+    '''
+
+    def respond(self, context):
+        '''
+        Return a dictionary of values (e.g. the response and reaction time)
+        that are passed to `log_trial`
+
+        Parameters
+        ----------
+        context : dict
+            Context of the current trial.
+        '''
+        raise NotImplementedError
+
+
+class RandomSubject(SubjectModel):
+    '''
+    Responds randomly, regardless of the trial context
+
+    Parameters
+    ----------
+    responses : list
+        Possible responses.
+    p : {None, list}
+        Probability of each response.  If None, all responses are equally
+        likely.
+    name : str
+        Name of the response in the trial log.
+    seed : {None, int}
+        Seed for the random number generator.
+    '''
+
+    def __init__(self, responses, p=None, name='response', seed=None):
+        self.responses = responses
+        self.p = p
+        self.name = name
+        self.random_state = np.random.RandomState(seed)
+
+    def respond(self, context):
+        i = self.random_state.choice(len(self.responses), p=self.p)
+        return {self.name: self.responses[i]}
+
+
+class PsychometricSubject(SubjectModel):
+    '''
+    Detects the stimulus with a probability that is a logistic function of a
+    context value (e.g. the stimulus level)
+
+    Parameters
+    ----------
+    parameter : str
+        Name of the context value.
+    threshold : float
+        Value at which the stimulus is detected half the time (ignoring the
+        guess and lapse rates).
+    slope : float
+        Slope of the logistic function.
+    guess : float
+        Probability of responding when the stimulus is not detected.
+    lapse : float
+        Probability of not responding when the stimulus is detected.
+    name : str
+        Name of the response in the trial log.
+    seed : {None, int}
+        Seed for the random number generator.
+    '''
+
+    def __init__(self, parameter, threshold, slope, guess=0, lapse=0,
+                 name='response', seed=None):
+        self.parameter = parameter
+        self.threshold = threshold
+        self.slope = slope
+        self.guess = guess
+        self.lapse = lapse
+        self.name = name
+        self.random_state = np.random.RandomState(seed)
+
+    def probability(self, value):
+        p = 1.0/(1.0+np.exp(-self.slope*(value-self.threshold)))
+        return self.guess + (1-self.guess-self.lapse)*p
+
+    def respond(self, context):
+        p = self.probability(context[self.parameter])
+        return {self.name: bool(self.random_state.uniform() < p)}
+
+
+class SimulatedExperiment(HasTraits):
+    '''
+    Stands in for the `AbstractExperiment` (which defines the GUI) as the model
+    of the controller
+    '''
+
+    paradigm = Any
+    data = Any
+
+
+def _timed(method, stats):
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        start = clock()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            stats.add(clock()-start)
+    return wrapper
+
+
+class Simulator(object):
+    '''
+    Runs a controller through a sequence of trials
+
+    Parameters
+    ----------
+    controller : AbstractController
+        Controller to simulate.  The controller is not attached to a GUI, so
+        `info` will be None in the methods called by the simulator.
+    paradigm : AbstractParadigm
+        Paradigm to simulate.
+    subject : SubjectModel
+        Generates the responses.
+    data : {None, AbstractData}
+        Data object to log the trials to.  If None, an `AbstractData` backed by
+        an in-memory HDF5 file is created.
+    maxlen : int
+        Number of recent durations retained for computing the percentiles of
+        the time spent in each phase.
+    '''
+
+    PHASES = ('evaluate_pending_expressions', 'subject', 'log_trial',
+              'next_trial', 'refresh_context')
+
+    _file_counter = itertools.count()
+
+    def __init__(self, controller, paradigm, subject, data=None, maxlen=1000):
+        self._fh = None
+        if data is None:
+            data = self._create_data()
+        self.controller = controller
+        self.paradigm = paradigm
+        self.subject = subject
+        self.data = data
+        self.stats = OrderedDict((p, LatencyStats(maxlen))
+                                 for p in self.PHASES)
+        self.trials = 0
+        self.elapsed = 0.0
+
+        # Wrap the methods on the instance so that calls made by the
+        # controller itself (e.g. `next_trial` calling `refresh_context`) are
+        # also timed.
+        for name in ('evaluate_pending_expressions', 'log_trial',
+                     'next_trial', 'refresh_context'):
+            method = getattr(controller, name)
+            setattr(controller, name, _timed(method, self.stats[name]))
+        controller.model = SimulatedExperiment(paradigm=paradigm, data=data)
+        self._started = False
+
+    def _create_data(self):
+        import tables
+        from .abstract_data import AbstractData
+        # PyTables keeps track of the open files by name, so each simulator
+        # needs a unique name even though nothing is written to disk.
+        filename = 'simulation_{}.h5'.format(next(self._file_counter))
+        self._fh = tables.open_file(filename, 'w', driver='H5FD_CORE',
+                                    driver_core_backing_store=0)
+        return AbstractData(store_node=self._fh.root)
+
+    def start(self):
+        '''
+        Start the experiment (this also prepares the first trial)
+        '''
+        self.controller.start()
+        self._started = True
+
+    def run_trial(self):
+        '''
+        Run a single trial
+
+        Raises
+        ------
+        StopIteration
+            If one of the sequences used by the paradigm is exhausted.
+        '''
+        start = clock()
+        context = self.controller.evaluate_pending_expressions()
+        subject_start = clock()
+        response = self.subject.respond(context)
+        self.stats['subject'].add(clock()-subject_start)
+        self.end_trial(response)
+        self.elapsed += clock()-start
+        self.trials += 1
+
+    def end_trial(self, response):
+        '''
+        Log the trial and prepare the next one
+
+        Override this if the controller needs to process the response in some
+        other way (e.g. via the methods it uses to handle hardware events).
+        '''
+        self.controller.log_trial(**response)
+        self.controller.next_trial()
+
+    def run(self, n):
+        '''
+        Run n trials (or until a sequence is exhausted)
+
+        Returns
+        -------
+        result : dict
+            See `get_summary`.
+        '''
+        if not self._started:
+            self.start()
+        for i in range(n):
+            try:
+                self.run_trial()
+            except StopIteration:
+                log.info('Sequence exhausted after %d trials', self.trials)
+                break
+        return self.get_summary()
+
+    def get_summary(self, percentiles=(50, 90, 99)):
+        '''
+        Return a dictionary with the number of trials, total time spent running
+        them, trials per second and the summary of each phase (see
+        `LatencyStats.summary`).
+        '''
+        if self.elapsed:
+            rate = self.trials/self.elapsed
+        else:
+            rate = np.nan
+        phases = OrderedDict((p, s.summary(percentiles))
+                             for p, s in self.stats.items())
+        return {
+            'trials': self.trials,
+            'elapsed': self.elapsed,
+            'trials_per_second': rate,
+            'phases': phases,
+        }
+
+    def close(self):
+        '''
+        Close the in-memory file (if one was created)
+        '''
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
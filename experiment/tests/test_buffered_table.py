@@ -0,0 +1,109 @@
+import logging
+import unittest
+
+import numpy as np
+import tables
+
+from experiment.buffered_table import BufferedTable, EventLog
+
+
+class TestBufferedTable(unittest.TestCase):
+
+    def setUp(self):
+        self.fh = tables.open_file('buffered_table', 'w', driver='H5FD_CORE',
+                                   driver_core_backing_store=0)
+        dtype = np.dtype([('x', 'i'), ('y', 'f'), ('name', 'S8')])
+        table = self.fh.create_table(self.fh.root, 'log', dtype)
+        self.table = BufferedTable(table, batch_size=4)
+
+    def tearDown(self):
+        self.fh.close()
+
+    def append(self, n):
+        for i in range(n):
+            self.table.append_row({'x': i, 'y': i*0.5, 'name': 'r{}'.format(i),
+                                   'extra': 1})
+
+    def test_batches(self):
+        self.append(6)
+        self.assertEqual(self.table.table.nrows, 4)
+        self.assertEqual(self.table.pending, 2)
+        self.assertEqual(len(self.table), 6)
+        self.table.flush()
+        self.assertEqual(self.table.table.nrows, 6)
+
+    def test_read(self):
+        self.append(6)
+        np.testing.assert_array_equal(self.table.col('x'), range(6))
+        self.assertEqual(self.table[-1]['name'], 'r5')
+        self.assertEqual(self.table[1]['name'], 'r1')
+        np.testing.assert_array_equal(self.table[3:5]['x'], [3, 4])
+        np.testing.assert_array_equal(self.table[::2]['x'], [0, 2, 4])
+        self.assertEqual([r['x'] for r in self.table], range(6))
+        self.assertRaises(IndexError, self.table.__getitem__, 6)
+
+        # Attributes of the table flush the buffer first
+        np.testing.assert_array_equal(self.table.cols.x[:], range(6))
+        self.assertEqual(self.table.pending, 0)
+
+    def test_defaults(self):
+        record = self.table.append_row({'y': 2})
+        self.assertEqual(record['x'][0], 0)
+        self.assertEqual(record['name'][0], '')
+        self.assertEqual(record['y'][0], 2)
+
+    def test_mismatched_keys(self):
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logger = logging.getLogger('experiment.buffered_table')
+        logger.addHandler(handler)
+        try:
+            self.append(2)
+            self.table.append_row({'x': 1, 'y': 2, 'name': 'a'})
+            self.table.append_row({'y': 2})
+        finally:
+            logger.removeHandler(handler)
+        # Each mismatched set of keys is only reported once
+        self.assertEqual(messages, ['No column for extra in log (not saved)',
+                                    'No value for name, x in log (saved as '
+                                    'zero)'])
+
+    def test_flush_interval(self):
+        self.table.flush_interval = 0
+        self.append(1)
+        self.assertEqual(self.table.pending, 0)
+
+
+class TestEventLog(unittest.TestCase):
+
+    def setUp(self):
+        self.fh = tables.open_file('event_log', 'w', driver='H5FD_CORE',
+                                   driver_core_backing_store=0)
+        dtype = np.dtype([('timestamp', 'f'), ('name', 'S64')])
+        table = self.fh.create_table(self.fh.root, 'event_log', dtype)
+        self.log = EventLog(table, batch_size=4, tail_size=8)
+        for i in range(10):
+            self.log.log(i, 'lick' if i % 2 else 'tone')
+
+    def tearDown(self):
+        self.fh.close()
+
+    def test_tail(self):
+        # Only the last 8 events are kept in memory, but all are in the table
+        np.testing.assert_array_equal(self.log.get_tail()['timestamp'],
+                                      range(2, 10))
+        self.assertEqual(len(self.log), 10)
+        self.assertEqual(self.log.table.nrows, 8)
+
+    def test_query(self):
+        np.testing.assert_array_equal(self.log.query(3, 6)['timestamp'],
+                                      [3, 4, 5])
+        np.testing.assert_array_equal(self.log.query(name='lick')['timestamp'],
+                                      [3, 5, 7, 9])
+        self.assertEqual(self.log.count(end=5, name=['lick', 'tone']), 3)
+        self.assertEqual(self.log.count(name='reward'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
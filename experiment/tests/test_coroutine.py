@@ -0,0 +1,286 @@
+import os
+import unittest
+import threading
+import Queue
+from functools import partial
+
+import numpy as np
+
+from experiment import coroutine as cr
+
+
+class Collector(object):
+
+    def __init__(self):
+        self.data = []
+
+    def send(self, data):
+        self.data.append(data)
+
+
+class BlockingCollector(Collector):
+
+    def __init__(self):
+        super(BlockingCollector, self).__init__()
+        self.event = threading.Event()
+
+    def send(self, data):
+        self.event.wait()
+        super(BlockingCollector, self).send(data)
+
+
+def square(data):
+    return data**2
+
+
+def channel_sum(data):
+    return data.sum(axis=0)
+
+
+def fail(data):
+    raise ValueError('bad data')
+
+
+def crash(data):
+    os._exit(3)
+
+
+class Failure(object):
+
+    def send(self, data):
+        raise ValueError('bad data')
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_synchronous(self):
+        sink = Collector()
+        pipeline = cr.create_pipeline(partial(cr.blocked, 4, -1),
+                                      partial(cr.rms, -1), sink)
+        pipeline.send(np.ones((2, 10)))
+        self.assertEqual(len(sink.data), 2)
+        np.testing.assert_array_equal(sink.data[0], [1, 1])
+
+    def test_threaded(self):
+        sink = Collector()
+        stage = cr.threaded(partial(cr.rms, -1), maxsize=4)(sink)
+        pipeline = cr.create_pipeline(partial(cr.blocked, 4, -1), stage)
+        pipeline.send(np.ones((2, 16)))
+        stage.close()
+        self.assertEqual(len(sink.data), 4)
+
+    def test_concurrency(self):
+        sink = Collector()
+        pipeline = cr.create_pipeline(partial(cr.reshape, (-1,)), sink,
+                                      concurrency=[0])
+        self.assertTrue(isinstance(pipeline, cr.ThreadedStage))
+        for i in range(10):
+            pipeline.send(np.ones((2, 2))*i)
+        pipeline.join()
+        self.assertEqual([d[0] for d in sink.data], range(10))
+        self.assertRaises(TypeError, cr.create_pipeline, sink, foo=1)
+
+    def test_drop_oldest(self):
+        sink = BlockingCollector()
+        stage = cr.ThreadedStage(sink, maxsize=2, overflow='drop')
+        for i in range(10):
+            stage.send(i)
+        sink.event.set()
+        stage.close()
+        self.assertTrue(stage.dropped > 0)
+        self.assertEqual(sink.data[-1], 9)
+        self.assertEqual(len(sink.data) + stage.dropped, 10)
+
+    def test_overflow_error(self):
+        sink = BlockingCollector()
+        stage = cr.ThreadedStage(sink, maxsize=1, overflow='error')
+        with self.assertRaises(Queue.Full):
+            for i in range(3):
+                stage.send(i)
+        sink.event.set()
+        stage.close()
+
+    def test_worker_exception(self):
+        stage = cr.ThreadedStage(Failure())
+        stage.send(1)
+        self.assertRaises(ValueError, stage.join)
+        self.assertRaises(ValueError, stage.send, 2)
+
+    def test_close_generator(self):
+        closed = []
+
+        @cr.coroutine
+        def sink():
+            try:
+                while True:
+                    (yield)
+            except GeneratorExit:
+                closed.append(True)
+
+        stage = cr.threaded(sink())
+        stage.send(1)
+        stage.close()
+        self.assertEqual(closed, [True])
+
+
+class TestFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.data = np.random.normal(size=(4, 1000))
+        self.splits = [0, 3, 250, 600, 1000]
+
+    def send_all(self, pipeline):
+        for lb, ub in zip(self.splits[:-1], self.splits[1:]):
+            pipeline.send(self.data[:, lb:ub])
+
+    def test_sosfilt(self):
+        from scipy import signal
+        sos = signal.iirfilter(4, 0.1, btype='lowpass', output='sos')
+        sink = Collector()
+        self.send_all(cr.sosfilt(sos, -1, sink))
+        actual = np.concatenate(sink.data, axis=-1)
+        expected = signal.sosfilt(sos, self.data, axis=-1)
+        np.testing.assert_array_almost_equal(actual, expected)
+
+    def test_filter_bank(self):
+        from scipy import signal
+        bands = [signal.iirfilter(2, w, output='sos')
+                 for w in ([0.05, 0.1], [0.1, 0.2], [0.2, 0.4])]
+        sinks = [Collector() for b in bands]
+        self.send_all(cr.filter_bank(bands, -1, *sinks))
+        for sos, sink in zip(bands, sinks):
+            actual = np.concatenate(sink.data, axis=-1)
+            expected = signal.sosfilt(sos, self.data, axis=-1)
+            np.testing.assert_array_almost_equal(actual, expected)
+        self.assertRaises(ValueError, cr.filter_bank, bands, -1, sinks[0])
+
+
+class TestPipelineStats(unittest.TestCase):
+
+    def test_snapshot(self):
+        sink = Collector()
+        stats = cr.PipelineStats()
+        pipeline = cr.create_pipeline(partial(cr.blocked, 4, -1),
+                                      partial(cr.rms, -1),
+                                      partial(cr.rms, -1), sink,
+                                      concurrency=[1], stats=stats)
+        pipeline.send(np.ones((2, 16)))
+        stats.stages['rms'].queue.join()
+        snapshot = stats.snapshot()
+        self.assertEqual(snapshot.keys(),
+                         ['blocked', 'rms', 'rms_1', 'Collector'])
+        self.assertEqual(snapshot['blocked']['items'], 1)
+        self.assertEqual(snapshot['blocked']['samples'], 16)
+        self.assertEqual(snapshot['rms']['items'], 4)
+        self.assertEqual(snapshot['rms']['samples'], 16)
+        self.assertEqual(snapshot['rms']['queue_depth'], 0)
+        self.assertEqual(snapshot['rms_1']['samples'], 8)
+        self.assertEqual(snapshot['Collector']['items'], 4)
+        self.assertTrue(snapshot['blocked']['total_time'] >=
+                        snapshot['blocked']['self_time'])
+        self.assertEqual(len(sink.data), 4)
+
+    def test_disabled(self):
+        sink = Collector()
+        pipeline = cr.create_pipeline(partial(cr.rms, -1), sink)
+        self.assertFalse(isinstance(pipeline, cr.InstrumentedStage))
+
+
+class TestFused(unittest.TestCase):
+
+    def setUp(self):
+        self.data = np.random.uniform(0.1, 1, size=(3, 1000))
+        # Uneven block sizes ensure that data is carried over between sends.
+        self.splits = [0, 7, 250, 251, 600, 1000]
+
+    def send_all(self, pipeline, axis=-1):
+        for lb, ub in zip(self.splits[:-1], self.splits[1:]):
+            pipeline.send(np.take(self.data, np.arange(lb, ub), axis=axis))
+
+    def assert_equivalent(self, chain, fused, axis=-1):
+        expected, actual, chained = Collector(), Collector(), Collector()
+        self.send_all(cr.create_pipeline(*chain + [expected]), axis)
+        self.send_all(cr.create_pipeline(fused, actual), axis)
+        self.send_all(cr.create_pipeline(*chain + [chained], fuse=True), axis)
+        for result in (actual, chained):
+            self.assertEqual(len(expected.data), len(result.data))
+            for e, a in zip(expected.data, result.data):
+                np.testing.assert_array_almost_equal(e, a)
+
+    def test_block_rms_db(self):
+        chain = [partial(cr.blocked, 100, -1), partial(cr.rms, -1),
+                 partial(cr.db, 0.5)]
+        self.assert_equivalent(chain, partial(cr.block_rms_db, 100, -1, 0.5))
+
+    def test_block_rms_axis(self):
+        self.data = self.data.T
+        chain = [partial(cr.blocked, 30, 0), partial(cr.rms, 0)]
+        self.assert_equivalent(chain, partial(cr.block_rms, 30, 0), axis=0)
+
+    def test_block_average_reshape(self):
+        chain = [partial(cr.block_average, 10, -1), partial(cr.reshape, (3, 1))]
+        fused = partial(cr.block_average_reshape, 10, -1, (3, 1))
+        self.assert_equivalent(chain, fused)
+
+    def test_fuse_stages(self):
+        sink = Collector()
+        stages = [partial(cr.blocked, 100, -1), partial(cr.rms, -1),
+                  partial(cr.db, 1), sink]
+        fused, threaded = cr.fuse_stages(stages, [0, 3])
+        self.assertEqual(len(fused), 2)
+        self.assertEqual(fused[0].func, cr.block_rms_db)
+        self.assertEqual(fused[0].args, (100, -1, 1))
+        self.assertEqual(threaded, [0, 1])
+
+        # Stages that run on their own thread cannot be fused and neither can
+        # stages that operate on different axes.
+        fused, threaded = cr.fuse_stages(stages, [1])
+        self.assertEqual(len(fused), 4)
+        stages[1] = partial(cr.rms, 0)
+        self.assertEqual(len(cr.fuse_stages(stages)[0]), 4)
+
+
+class TestProcessStage(unittest.TestCase):
+
+    def test_offload(self):
+        sink = Collector()
+        stage = cr.offload(square, (4, 100), 'f', sink, capacity=2)
+        blocks = [np.random.uniform(size=(4, n)) for n in (100, 10, 50, 100)]
+        for block in blocks:
+            stage.send(block)
+        stage.close()
+        self.assertEqual(len(sink.data), len(blocks))
+        for block, result in zip(blocks, sink.data):
+            np.testing.assert_array_almost_equal(block**2, result, 5)
+        self.assertRaises(ValueError, stage.send, blocks[0])
+
+    def test_workers(self):
+        sink = Collector()
+        stage = cr.offload(channel_sum, (2, 10), 'i', sink, workers=3,
+                           out_shape=(10,))
+        for i in range(20):
+            stage.send(np.ones((2, 10))*i)
+        stage.close()
+        self.assertEqual([r[0] for r in sink.data], range(0, 40, 2))
+
+    def test_oversized(self):
+        stage = cr.offload(square, (2, 10), 'f', Collector())
+        self.assertRaises(ValueError, stage.send, np.zeros((2, 11)))
+        stage.close()
+
+    def test_worker_error(self):
+        stage = cr.offload(fail, (2, 10), 'f', Collector())
+        stage.send(np.zeros((2, 10)))
+        self.assertRaises(RuntimeError, stage.join)
+        stage.close()
+
+    def test_worker_crash(self):
+        stage = cr.offload(crash, (2, 10), 'f', Collector(),
+                           poll_interval=0.1)
+        stage.send(np.zeros((2, 10)))
+        self.assertRaises(RuntimeError, stage.join)
+        self.assertRaises(RuntimeError, stage.send, np.zeros((2, 10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,9 @@ from traits.api import HasTraits, on_trait_change
 
 from experiment.evaluate import (Expression, ParameterExpression,
                                  ExpressionNamespace, choice, expr)
+from experiment.evaluate import compiler
+from experiment.evaluate.compiler import compile_expression
+from experiment.evaluate.planner import TrialPlanner
 
 
 class TestExpressions(unittest.TestCase):
@@ -132,6 +135,178 @@ class TestExpressions(unittest.TestCase):
                 self.assertTrue(parameter not in self.ns._expressions)
             self.ns.reset_values()
 
+    def test_evaluation_order(self):
+        order = self.ns._order
+        self.assertEqual(set(order), set(self.parameters))
+        for name, dependencies in self.ns._graph.items():
+            for d in dependencies:
+                self.assertTrue(order.index(d) < order.index(name))
+        self.assertEqual(self.ns._get_plan('e'), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(self.ns._get_plan('q'), ['p', 'q'])
+
+    def test_circular_reference(self):
+        parameters = {
+            'a': ParameterExpression('b+1'),
+            'b': ParameterExpression('c+1'),
+            'c': ParameterExpression('a+1'),
+            'd': 5,
+        }
+        self.assertRaises(ValueError, ExpressionNamespace, parameters)
+
+    def test_kind(self):
+        kinds = dict((k, getattr(v, 'kind', None))
+                     for k, v in self.parameters.items())
+        self.assertEqual(kinds['a'], 'constant')
+        self.assertEqual(kinds['c'], 'dependent')
+        self.assertEqual(kinds['h'], 'volatile')
+        self.assertEqual(kinds['m'], 'volatile')
+        self.assertEqual(kinds['q'], 'volatile')
+        self.assertEqual(ParameterExpression('toss(a)').kind, 'volatile')
+        self.assertEqual(ParameterExpression(5).kind, 'constant')
+
+    def test_incremental(self):
+        counts = dict((k, 0) for k in self.parameters)
+
+        def counter(name, evaluate):
+            def wrapper(*args, **kwargs):
+                counts[name] += 1
+                return evaluate(*args, **kwargs)
+            return wrapper
+
+        for name, e in self.parameters.items():
+            if isinstance(e, ParameterExpression):
+                e.evaluate = counter(name, e.evaluate)
+
+        ns = ExpressionNamespace(self.parameters)
+        results = []
+        for i in range(3):
+            ns.reset_values()
+            results.append(ns.evaluate_values(notify=False).copy())
+        for name in 'abcdefl':
+            self.assertEqual(counts[name], 1)
+            self.assertFalse(ns.value_changed(name))
+        # Mutable values (e.g. the list returned by range) are rebuilt
+        for name in 'ghimo':
+            self.assertEqual(counts[name], 3)
+        self.assertFalse(ns.value_changed('g'))
+        self.assertTrue(results[0]['i'] != results[1]['i'])
+        self.assertEqual([r['o'] for r in results], [0, 1, 2])
+
+        # Overriding a dependency forces the dependent expressions to be
+        # re-evaluated.
+        ns.reset_values()
+        ns.evaluate_value('d', {'a': 4}, notify=False)
+        self.assertEqual(ns._context['d'], 44)
+        self.assertEqual(counts['c'], 2)
+        ns.reset_values()
+        self.assertEqual(ns.evaluate_value('d', notify=False), 55)
+
+    def test_mutable_inputs(self):
+        # Values computed from mutable inputs are re-evaluated on each trial
+        # since the inputs may have been modified in place.
+        seq = [1, 2, 3]
+        x = np.arange(3)
+        ns = ExpressionNamespace({
+            'n': ParameterExpression('len(seq)'),
+            's': ParameterExpression('x.sum()'),
+        })
+        extra_context = {'seq': seq, 'x': x}
+        ns.reset_values(extra_context)
+        self.assertEqual(ns.evaluate_values(notify=False), {'n': 3, 's': 3})
+        seq.append(4)
+        x *= 2
+        ns.reset_values(extra_context)
+        self.assertEqual(ns.evaluate_values(notify=False), {'n': 4, 's': 6})
+        self.assertTrue(ns.value_changed('n'))
+
+    def test_mutable_values(self):
+        # Mutable values are not shared across trials
+        ns = ExpressionNamespace({
+            'x': ParameterExpression('[1, 2, 3]'),
+            'y': ParameterExpression('{"a": 1}'),
+        })
+        for i in range(3):
+            ns.reset_values()
+            values = ns.evaluate_values(notify=False)
+            self.assertEqual(values['x'], [1, 2, 3])
+            self.assertEqual(values['y'], {'a': 1})
+            values['x'].append(9)
+            values['y']['b'] = 2
+
+    def test_notifications(self):
+        class Controller(object):
+            def __init__(self):
+                self.calls = []
+
+            def set_c(self, value):
+                self.calls.append(('c', value))
+
+            def set_e(self, value):
+                self.calls.append(('e', value))
+
+            def set_a(self, value):
+                self.calls.append(('a', value))
+
+            def _update_current_context_list(self):
+                self.calls.append('update')
+
+        controller = Controller()
+        ns = ExpressionNamespace(self.parameters, controller=controller)
+        ns.evaluate_values()
+        self.assertEqual(controller.calls,
+                         [('a', 5), ('c', 25), ('e', 80), 'update'])
+
+    def test_replace_expressions(self):
+        self.ns.evaluate_values(notify=False)
+        ns, affected = self.ns.replace_expressions(
+            {'a': ParameterExpression('7')})
+        self.assertEqual(affected, ['a', 'c', 'd', 'e', 'g'])
+
+        # Validation does not advance the sequences
+        ns.validate(affected + ['o', 'q'])
+        ns.evaluate_values(notify=False)
+        self.assertEqual(ns._context['e'], 112)
+        self.assertEqual(ns._context['o'], 1)
+        self.assertEqual(ns._context['q'], 3)
+        self.assertTrue(ns.value_changed('a'))
+        self.assertFalse(ns.value_changed('l'))
+
+        ns, affected = ns.replace_expressions(
+            {'b': ParameterExpression('a/x')})
+        self.assertRaises(NameError, ns.validate, affected)
+
+    def test_replace_expressions_invalid(self):
+        # A namespace that fails validation leaves the sequences of the
+        # current namespace where they were.
+        ns = ExpressionNamespace({
+            'a': ParameterExpression('1'),
+            'b': ParameterExpression('exact_order([a, 2, 3, 4], c=1)'),
+        })
+        for i in range(2):
+            ns.reset_values()
+            ns.evaluate_values(notify=False)
+        new_ns, affected = ns.replace_expressions(
+            {'a': ParameterExpression('x')})
+        self.assertEqual(affected, ['a', 'b'])
+        self.assertRaises(NameError, new_ns.validate, affected)
+        ns.reset_values()
+        self.assertEqual(ns.evaluate_value('b', notify=False), 3)
+
+    def test_replace_sequence(self):
+        # The dependents of a sequence are checked using its first value
+        ns = ExpressionNamespace({
+            'a': ParameterExpression('exact_order([1, 2, 3], c=1)'),
+            'b': ParameterExpression('a*2'),
+        })
+        ns.reset_values()
+        ns.evaluate_values(notify=False)
+        new_ns, affected = ns.replace_expressions(
+            {'a': ParameterExpression('exact_order([4, 5], c=1)')})
+        new_ns.validate(affected)
+        new_ns.reset_values()
+        self.assertEqual(new_ns.evaluate_values(notify=False),
+                         {'a': 4, 'b': 8})
+
     def test_equal(self):
         a = ParameterExpression('a+b')
         b = ParameterExpression('a+b')
@@ -189,6 +364,207 @@ class TestChoice(unittest.TestCase):
             self.assertRaises(StopIteration, c.next)
 
 
+    def test_take(self):
+        selectors = (choice.ascending(self.seq), choice.descending(self.seq),
+                     choice.exact_order(self.seq),
+                     choice.shuffled_set(self.seq, seed=1),
+                     choice.pseudorandom(self.seq, seed=1),
+                     choice.counterbalanced(self.seq, 20, seed=1))
+        for c in selectors:
+            state = c.get_state()
+            expected = [c.next() for i in range(30)]
+            c.set_state(state)
+            indices = c.take(30)
+            self.assertEqual(len(indices), 30)
+            self.assertEqual([c.sequence[i] for i in indices], expected)
+
+        c = choice.exact_order(self.seq, c=2)
+        self.assertEqual(len(c.take(10)), 10)
+        self.assertEqual(len(c.take(10)), 4)
+        self.assertRaises(StopIteration, c.take, 10)
+
+    def test_seed(self):
+        a = choice.shuffled_set(self.seq, seed=5)
+        b = choice.shuffled_set(self.seq, seed=5)
+        np.testing.assert_array_equal(a.take(100), b.take(100))
+
+        # Without a seed, the global seed is honored
+        results = []
+        for i in range(2):
+            np.random.seed(3)
+            results.append(choice.counterbalanced(self.seq, 4).take(20))
+        np.testing.assert_array_equal(*results)
+
+    def test_update(self):
+        c = choice.shuffled_set(range(6), seed=1)
+        first = [c.next() for i in range(3)]
+        c.update([0, 1, 2, 3, 4, 6, 7])
+        # The rest of the cycle contains the elements not presented yet
+        expected = set([0, 1, 2, 3, 4, 6, 7]) - set(first)
+        rest = [c.next() for i in range(len(expected))]
+        self.assertEqual(sorted(rest), sorted(expected))
+        self.assertEqual(sorted(c.next() for i in range(7)),
+                         [0, 1, 2, 3, 4, 6, 7])
+
+        c = choice.counterbalanced(['A', 'B'], 10, seed=1)
+        values = [c.next() for i in range(4)]
+        c.update(['A', 'B', 'C'])
+        values.extend(c.next() for i in range(6))
+        self.assertEqual(values.count('C'), 3)
+        self.assertEqual(values.count('A') + values.count('B'), 7)
+        self.assertEqual(sorted(c.next() for i in range(10)),
+                         ['A']*4 + ['B']*3 + ['C']*3)
+
+        # Unhashable elements and updates at the end of a cycle
+        c = choice.exact_order([{'x': 1}, {'x': 2}])
+        c.next()
+        c.update([{'x': 2}, {'x': 1}])
+        self.assertEqual(c.next(), {'x': 2})
+        c.update([{'x': 3}])
+        self.assertEqual(c.next(), {'x': 3})
+        self.assertRaises(ValueError, c.update, [])
+
+
+class TestCompiler(unittest.TestCase):
+
+    def test_dependencies(self):
+        e = ParameterExpression('np.arange(a)*b + max(c, 1)')
+        self.assertEqual(e._dependencies, ['a', 'b', 'c'])
+        e = ParameterExpression('[x*a for x in range(3)]')
+        self.assertEqual(e._dependencies, ['a'])
+        e = ParameterExpression('(lambda x: x + y)(1)')
+        self.assertEqual(e._dependencies, ['y'])
+        e = ParameterExpression('a + b if c > 2 else d')
+        self.assertEqual(e._dependencies, ['c', 'a', 'b', 'd'])
+        e = ParameterExpression('toss(x) if y else z')
+        self.assertEqual(e._dependencies, ['y', 'x', 'z'])
+
+    def test_volatile(self):
+        self.assertEqual(ParameterExpression('np.random.uniform(1, 5)').kind,
+                         'volatile')
+        self.assertEqual(ParameterExpression('np.arange(5)').kind, 'constant')
+        self.assertEqual(ParameterExpression('a.random').kind, 'dependent')
+
+    def test_folding(self):
+        e = ParameterExpression('ascending(octave_space(2e3, 16e3, 1))')
+        compiled = compile_expression(e._expression, e.GLOBALS,
+                                      e.VOLATILE_NAMES)
+        self.assertEqual(len(compiled.constants), 1)
+        folded = compiled.constants.values()[0]
+        self.assertFalse(folded.flags.writeable)
+        self.assertEqual([e.evaluate() for i in range(4)],
+                         [2e3, 4e3, 8e3, 16e3])
+
+        # Each evaluation returns a copy of the folded array that can be
+        # modified in place.
+        e = ParameterExpression('np.arange(5)')
+        x = e.evaluate()
+        x *= 2
+        np.testing.assert_array_equal(e.evaluate(), np.arange(5))
+
+        # Volatile calls and calls that depend on other parameters are not
+        # folded.
+        e = ParameterExpression('np.random.uniform(0, 1)')
+        self.assertNotEqual(e.evaluate(), e.evaluate())
+        e = ParameterExpression('np.sum(imul(a, 0.5))')
+        self.assertEqual(e.evaluate({'a': 3.2}), 3.0)
+
+        # Errors raised while folding are deferred until evaluation
+        e = ParameterExpression('int("a")')
+        self.assertRaises(ValueError, e.evaluate)
+
+    def test_function(self):
+        e = ParameterExpression('[x*a for x in range(b)]')
+        self.assertEqual(e.evaluate({'a': 2, 'b': 3}), [0, 2, 4])
+        # Arguments are in the order the names are evaluated
+        self.assertEqual(e._dependencies, ['b', 'a'])
+        self.assertEqual(e.evaluate(arguments=[2, 3]), [0, 3])
+        self.assertRaises(NameError, e.evaluate, {'a': 2})
+
+        # The context can override names in the global namespace
+        e = ParameterExpression('max(a, 3)')
+        self.assertEqual(e.evaluate({'a': 1}), 3)
+        self.assertEqual(e.evaluate({'a': 1, 'max': min}), 1)
+
+    def test_cache(self):
+        a = compile_expression('a*2', ParameterExpression.GLOBALS)
+        b = compile_expression('a*2', ParameterExpression.GLOBALS)
+        self.assertTrue(a is b)
+        c = compile_expression('a*2', ParameterExpression.GLOBALS.copy())
+        self.assertFalse(a is c)
+        self.assertTrue(len(compiler._cache) <= compiler._CACHE_SIZE)
+
+    def test_division(self):
+        self.assertEqual(ParameterExpression('1/2').evaluate(), 0.5)
+        self.assertEqual(ParameterExpression('a/b').evaluate({'a': 1, 'b': 2}),
+                         0.5)
+        self.assertEqual(ParameterExpression('a//b').evaluate({'a': 1, 'b': 2}),
+                         0)
+
+
+class TestPlanner(unittest.TestCase):
+
+    def create_namespace(self):
+        parameters = {
+            'a': ParameterExpression('exact_order([1, 2, 3, 4, 5], c=1)'),
+            'b': ParameterExpression('a*n'),
+            'c': ParameterExpression('u(ascending([7, 8]), a)'),
+            'd': 2,
+        }
+        return ExpressionNamespace(parameters)
+
+    def run_trials(self, n, planned=False, extra_context=None):
+        if extra_context is None:
+            extra_context = {'n': 10}
+        ns = self.create_namespace()
+        planner = TrialPlanner(ns, depth=2)
+        results = []
+        for i in range(n):
+            ns.reset_values(extra_context)
+            if not planner.commit(extra_context):
+                ns.evaluate_values(notify=False)
+            results.append(ns._context.copy())
+            if planned:
+                planner.plan(extra_context)
+        return results, planner
+
+    def test_plan(self):
+        expected, _ = self.run_trials(5)
+        actual, planner = self.run_trials(5, planned=True)
+        self.assertEqual(expected, actual)
+        self.assertEqual([r['b'] for r in actual], [10, 20, 30, 40, 50])
+        # Planning stops once the sequence is exhausted
+        self.assertEqual(len(planner), 0)
+
+    def test_discard(self):
+        ns = self.create_namespace()
+        planner = TrialPlanner(ns, depth=2)
+        ns.evaluate_values({'n': 10}, notify=False)
+        self.assertEqual(planner.plan({'n': 10}), 2)
+
+        # The outcome of the trial changed the extra context
+        ns.reset_values({'n': 5})
+        self.assertFalse(planner.commit({'n': 5}))
+        self.assertEqual(len(planner), 0)
+        ns.evaluate_values(notify=False)
+        self.assertEqual(ns._context['a'], 2)
+        self.assertEqual(ns._context['b'], 10)
+
+        # A live evaluation of a generator invalidates the plan
+        planner.plan({'n': 5})
+        ns.reset_values({'n': 5})
+        ns.evaluate_values(notify=False)
+        ns.reset_values({'n': 5})
+        self.assertFalse(planner.commit({'n': 5}))
+        ns.evaluate_values(notify=False)
+        self.assertEqual(ns._context['a'], 4)
+
+    def test_uninitialized(self):
+        ns = self.create_namespace()
+        planner = TrialPlanner(ns, depth=2)
+        self.assertEqual(planner.plan({'n': 10}), 0)
+
+
 class TestExpr(unittest.TestCase):
 
     test_octave = [
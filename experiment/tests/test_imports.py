@@ -0,0 +1,98 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+
+# Modules that can be used without the GUI toolkit
+CORE_MODULES = ['experiment.arraytools', 'experiment.channel',
+                'experiment.coroutine', 'experiment.evaluate',
+                'experiment.abstract_data', 'experiment.abstract_controller',
+                'experiment.simulate']
+
+# Maximum time (in seconds) to import all the core modules.  This is well above
+# the typical import time (mostly spent importing Numpy, Scipy and PyTables) so
+# that the test is not sensitive to the load on the machine.
+IMPORT_BUDGET = 5.0
+
+GUI_MODULES = ['traitsui.api', 'traitsui.tabular_adapter', 'traitsui.ui',
+               'traitsui.editors', 'pyface.api', 'pyface.toolkit']
+
+SCRIPT = '''
+import json
+import sys
+from timeit import default_timer as clock
+start = clock()
+for name in {modules!r}:
+    __import__(name)
+import experiment
+elapsed = clock()-start
+loaded = [m for m in {gui_modules!r} + ['pkg_resources'] if m in sys.modules]
+json.dump({{'elapsed': elapsed, 'loaded': loaded}}, sys.stdout)
+'''
+
+
+SIMULATE_SCRIPT = '''
+import json
+import sys
+from experiment import AbstractController, AbstractParadigm, Expression
+from experiment.simulate import Simulator, RandomSubject
+
+class Paradigm(AbstractParadigm):
+    level = Expression('exact_order([0, 10, 20])', context=True, log=True)
+
+class Controller(AbstractController):
+    extra_dtypes = [('response', 'b')]
+    def next_trial(self):
+        self.refresh_context()
+        self.set_gui_trait('current_trial', self.current_trial+1)
+
+simulator = Simulator(Controller(), Paradigm(), RandomSubject([True]))
+simulator.run(3)
+levels = simulator.data.trial_log.col('level').tolist()
+simulator.close()
+loaded = [m for m in {gui_modules!r} if m in sys.modules]
+json.dump({{'levels': levels, 'loaded': loaded}}, sys.stdout)
+'''
+
+
+def run_script(script):
+    # Run in a new interpreter since the modules may already have been imported
+    # by other tests.
+    root = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join([root, env.get('PYTHONPATH', '')])
+    output = subprocess.check_output([sys.executable, '-c', script], env=env)
+    return json.loads(output)
+
+
+def import_core(modules):
+    return run_script(SCRIPT.format(modules=modules, gui_modules=GUI_MODULES))
+
+
+class TestImports(unittest.TestCase):
+
+    def test_core_without_gui(self):
+        result = import_core(CORE_MODULES)
+        # PyTables imports pkg_resources, so that one can only be checked
+        # without importing channel or abstract_data
+        loaded = [m for m in result['loaded'] if m != 'pkg_resources']
+        self.assertEqual(loaded, [])
+        self.assertTrue(result['elapsed'] < IMPORT_BUDGET,
+                        'Importing the core took {:.2f} s'
+                        .format(result['elapsed']))
+
+    def test_package_without_gui(self):
+        result = import_core(['experiment.evaluate', 'experiment.coroutine'])
+        self.assertEqual(result['loaded'], [])
+
+    def test_simulate_controller(self):
+        result = run_script(SIMULATE_SCRIPT.format(gui_modules=GUI_MODULES))
+        self.assertEqual(result['levels'], [0, 10, 20])
+        self.assertEqual(result['loaded'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+
+from experiment.simulate import Simulator, RandomSubject
+from experiment.rig import Rig, MemoryBudget, RenderScheduler
+from experiment.tests.test_simulate import (SimulatedController,
+                                            SimulatedParadigm)
+
+
+class TestMemoryBudget(unittest.TestCase):
+
+    def test_reserve(self):
+        budget = MemoryBudget(100)
+        budget.reserve('a', 60)
+        self.assertRaises(MemoryError, budget.reserve, 'b', 60)
+        budget.reserve('a', 80)
+        self.assertEqual(budget.available, 20)
+        budget.release('a')
+        budget.reserve('b', 60)
+        self.assertEqual(budget.used, 60)
+
+
+class TestRenderScheduler(unittest.TestCase):
+
+    def test_budget(self):
+        dispatched = []
+        calls = []
+        scheduler = RenderScheduler(budget=0, dispatch=dispatched.append)
+        for key in 'abc':
+            scheduler.post(key, calls.append, key)
+        scheduler.post('a', calls.append, 'a2')
+        self.assertEqual(len(dispatched), 1)
+
+        # Only one update runs per pass with no time budget.  Deferred
+        # updates run before the ones posted since.
+        dispatched.pop()()
+        self.assertEqual(calls, ['b'])
+        scheduler.post('d', calls.append, 'd')
+        scheduler.post('c', calls.append, 'c2')
+        while dispatched:
+            dispatched.pop()()
+        self.assertEqual(calls, ['b', 'a2', 'd', 'c2'])
+        self.assertEqual(scheduler.deferred, 5)
+        self.assertEqual(scheduler.coalesced, 2)
+
+
+class TestRig(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatched = []
+        self.rig = Rig(writer_interval=60, memory_budget=1e6,
+                       dispatch=self.dispatched.append)
+        self.simulators = []
+        for name in ('a', 'b'):
+            simulator = Simulator(SimulatedController(), SimulatedParadigm(),
+                                  RandomSubject([True], seed=1))
+            self.rig.add(name, simulator.controller)
+            self.simulators.append(simulator)
+
+    def tearDown(self):
+        self.rig.close()
+        for simulator in self.simulators:
+            simulator.close()
+
+    def run_trials(self, name, n):
+        engine = self.rig.engines[name]
+        for i in range(n):
+            engine.submit('evaluate_pending_expressions')
+            engine.submit('log_trial', response=True)
+            engine.submit('next_trial')
+
+    def test_experiments(self):
+        a, b = self.simulators
+        for engine in self.rig.engines.values():
+            engine.start()
+        self.run_trials('a', 3)
+        self.run_trials('b', 1)
+        for engine in self.rig.engines.values():
+            engine.join()
+
+        # The sequences are independent
+        self.assertEqual(list(a.data.trial_log.col('level')), [0, 10, 20])
+        self.assertEqual(list(b.data.trial_log.col('level')), [0])
+        self.assertFalse(a.data.trial_log.flush_interval)
+        self.assertEqual(a.data.trial_log.pending, 3)
+
+        self.rig.writer.flush()
+        self.assertEqual(a.data.trial_log.pending, 0)
+        self.assertEqual(a.data.trial_log.table.nrows, 3)
+        self.assertTrue(self.rig.memory_budget.used > 0)
+
+        # A single pass updates the GUI of both experiments
+        self.assertEqual(len(self.dispatched), 1)
+        self.dispatched.pop()()
+        for simulator in self.simulators:
+            controller = simulator.controller
+            self.assertEqual(len(controller.current_context_list), 2)
+
+        summary = self.rig.get_summary()
+        self.assertEqual(summary['engines']['a']['commands']['log_trial']['n'],
+                         3)
+        self.assertEqual(summary['writer']['n'], 1)
+
+        self.rig.remove('a')
+        self.assertTrue(a.data.trial_log.lock is not self.rig.writer.lock)
+        self.assertEqual(a.data.trial_log.flush_interval, 10)
+
+    def test_memory_budget(self):
+        self.rig.memory_budget.max_bytes = 1
+        engine = self.rig.engines['a']
+        engine.start()
+        self.assertRaises(MemoryError, engine.join)
+        self.assertRaises(MemoryError, self.rig.remove, 'a')
+        self.assertEqual(self.rig.memory_budget.used, 0)
+
+    def test_add_twice(self):
+        simulator = self.simulators[0]
+        self.assertRaises(ValueError, self.rig.add, 'a', simulator.controller)
+
+
+if __name__ == '__main__':
+    unittest.main()
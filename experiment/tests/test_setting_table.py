@@ -0,0 +1,136 @@
+import doctest
+import unittest
+
+import numpy as np
+from traits.api import HasTraits, Any
+
+from experiment.selector import setting_table, MultiTypeListSelector
+from experiment.paradigm.constant_limits import (GoNogoCLSettings,
+                                                 GoNogoCLControllerMixin)
+from experiment.selector.setting_table import SettingTable
+
+
+class CLController(GoNogoCLControllerMixin, HasTraits):
+
+    shadow_paradigm = Any
+
+
+class TestSettingTable(unittest.TestCase):
+
+    def setUp(self):
+        settings = [
+            {'setting_type': 'GO', 'level': 20.0, 'repeats': 1},
+            {'setting_type': 'NOGO', 'level': 0.0, 'repeats': 1},
+            {'setting_type': 'GO', 'level': 10.0, 'repeats': 2},
+            {'setting_type': 'GO', 'level': 20.0, 'repeats': 1},
+        ]
+        self.table = SettingTable.from_dicts(settings, ['setting_type',
+                                                        'level', 'repeats'])
+
+    def test_select(self):
+        go = self.table.select(setting_type='GO')
+        self.assertEqual([r['level'] for r in go], [20, 10, 20])
+        self.assertEqual(len(self.table.select(setting_type='GO', level=20)),
+                         2)
+        self.assertEqual(len(self.table.select(setting_type='GO_REMIND')), 0)
+
+    def test_sort_dedupe(self):
+        np.testing.assert_array_equal(self.table.sort_index(), [2, 0, 3, 1])
+        np.testing.assert_array_equal(self.table.sort_index(['repeats']),
+                                      [0, 1, 3, 2])
+        self.assertEqual(self.table.dedupe().to_dicts(),
+                         self.table.take([0, 1, 2]).to_dicts())
+
+    def test_row(self):
+        row = self.table[-1]
+        self.assertTrue('setting_type' in row)
+        self.assertEqual(row, self.table[0])
+        self.assertEqual(hash(row), hash(self.table[0]))
+        self.assertEqual(len(set(self.table)), 3)
+        row['level'] = 5
+        self.assertEqual(self.table.data['level'][-1], 5)
+        self.assertEqual(row.copy(), {'setting_type': 'GO', 'level': 5,
+                                      'repeats': 1})
+        self.assertRaises(KeyError, row.__getitem__, 'missing')
+        np.testing.assert_array_equal(self.table.sort_index(), [3, 2, 0, 1])
+
+    def test_records(self):
+        settings = [{'setting_type': 'GO', 'level': 10},
+                    {'setting_type': 'GO', 'level': 2.5}]
+        table = SettingTable.from_dicts(settings, ['setting_type', 'level'])
+        self.assertEqual(table.data['level'].dtype, np.float)
+        records = table.sort().records()
+        self.assertTrue(records[0] is settings[1])
+        self.assertTrue(type(table[0]['level']) is int)
+        self.assertEqual(table.to_dicts(), settings)
+
+    def test_empty(self):
+        table = SettingTable.from_dicts([], ['setting_type', 'level'])
+        self.assertEqual(len(table.select(setting_type='GO')), 0)
+        self.assertEqual(len(table.dedupe()), 0)
+
+    def test_selector(self):
+        selector = MultiTypeListSelector('GO', 'NOGO')
+        selector.add_parameter('level')
+        selector.add_setting('GO', {'level': 10})
+        selector.add_setting('NOGO', {'level': 0})
+        self.assertEqual([s['level'] for s in selector.get_sequence('GO')],
+                         [10])
+        selector.add_setting('GO', {'level': 20})
+        sequence = selector.get_sequence('GO')
+        self.assertEqual([s['level'] for s in sequence], [10, 20])
+        self.assertTrue(all(type(s) is dict for s in sequence))
+
+    def test_update_selector(self):
+        selector = MultiTypeListSelector('GO', 'NOGO')
+        selector.add_parameter('level')
+        for level in (10, 20, 30):
+            selector.add_setting('GO', {'level': level})
+        selector.add_setting('NOGO', {'level': 0})
+        selector.GO_order = 'exact_order'
+        go = selector.update_selector(None, 'GO')
+        nogo = selector.update_selector(None, 'NOGO')
+        self.assertEqual(go.next()['level'], 10)
+
+        selector.sequence[1]['level'] = 25
+        selector.settings_updated()
+        self.assertTrue(selector.update_selector(go, 'GO') is go)
+        self.assertTrue(selector.update_selector(nogo, 'NOGO') is nogo)
+        self.assertEqual([go.next()['level'] for i in range(3)], [25, 30, 10])
+
+        # Changing the order creates a new selector
+        selector.GO_order = 'ascending'
+        self.assertFalse(selector.update_selector(go, 'GO') is go)
+
+    def test_applied_settings(self):
+        # Settings edited in the GUI are only used once they are applied
+        selector = MultiTypeListSelector('GO', 'GO_REMIND', 'NOGO')
+        selector.add_parameter('level')
+        selector.GO_order = 'exact_order'
+        for setting_type, level in (('GO', 10), ('GO', 20), ('GO_REMIND', 30),
+                                    ('NOGO', 0)):
+            selector.add_setting(setting_type, {'level': level})
+        paradigm = GoNogoCLSettings(selector=selector)
+        controller = CLController()
+        controller.shadow_paradigm = paradigm.clone_traits()
+        controller._update_selectors()
+        go = controller.current_sequence_GO
+        self.assertEqual(go.next()['level'], 10)
+
+        paradigm.selector.sequence[1]['level'] = 25
+        paradigm.selector.settings_updated()
+        controller._update_selectors()
+        self.assertEqual(go.next()['level'], 20)
+
+        controller.shadow_paradigm.copy_traits(paradigm, traits=['selector'])
+        controller._update_selectors()
+        self.assertTrue(controller.current_sequence_GO is go)
+        self.assertEqual([go.next()['level'] for i in range(2)], [10, 25])
+
+    def test_doctest(self):
+        failures, tests = doctest.testmod(setting_table)
+        self.assertEqual(failures, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
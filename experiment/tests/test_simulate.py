@@ -0,0 +1,128 @@
+import time
+import unittest
+
+import numpy as np
+
+from experiment import AbstractParadigm, AbstractController
+from experiment.evaluate import Expression
+from experiment.simulate import Simulator, PsychometricSubject, RandomSubject
+
+
+class SimulatedParadigm(AbstractParadigm):
+
+    kw = dict(context=True, log=True)
+    level = Expression('exact_order(np.arange(0, 60, 10), c=4)', **kw)
+    frequency = Expression('4e3*2', **kw)
+
+
+class SimulatedController(AbstractController):
+
+    extra_dtypes = [('response', 'b')]
+
+    def next_trial(self):
+        self.refresh_context()
+        self.set_gui_trait('current_trial', self.current_trial+1)
+
+
+class TimedController(SimulatedController):
+
+    log_phase_times = True
+    timed_phases = SimulatedController.timed_phases + ['hardware']
+
+    def set_level(self, level):
+        with self.trial_timer.phase('hardware'):
+            time.sleep(0.001)
+
+
+class TestSimulator(unittest.TestCase):
+
+    def setUp(self):
+        subject = PsychometricSubject('level', 30, 0.5, seed=1)
+        self.simulator = Simulator(SimulatedController(), SimulatedParadigm(),
+                                   subject)
+
+    def tearDown(self):
+        self.simulator.close()
+
+    def test_run(self):
+        result = self.simulator.run(100)
+        # The level sequence is exhausted after 4 cycles
+        self.assertEqual(result['trials'], 24)
+        trial_log = self.simulator.data.trial_log
+        self.assertEqual(len(trial_log), 24)
+        np.testing.assert_array_equal(trial_log.col('level')[:6],
+                                      [0, 10, 20, 30, 40, 50])
+        responses = trial_log.col('response').reshape((4, 6))
+        self.assertTrue(responses[:, 0].sum() < responses[:, -1].sum())
+        self.assertTrue(result['trials_per_second'] > 0)
+        phases = result['phases']
+        self.assertEqual(phases['log_trial']['n'], 24)
+        self.assertEqual(phases['refresh_context']['n'], 25)
+        self.assertTrue(phases['next_trial']['total'] >=
+                        phases['refresh_context']['total'] -
+                        phases['refresh_context']['max'])
+
+    def test_logged_expressions(self):
+        self.simulator.run(2)
+        self.simulator.paradigm.frequency = '4e3'
+        self.simulator.controller.apply()
+        self.simulator.run(2)
+        trial_log = self.simulator.data.trial_log
+        self.assertEqual(list(trial_log.col('expression_frequency')),
+                         ['4e3*2']*2 + ['4e3']*2)
+        np.testing.assert_array_equal(trial_log.col('frequency'),
+                                      [8e3]*2 + [4e3]*2)
+
+    def test_apply_unchanged(self):
+        self.simulator.run(1)
+        controller = self.simulator.controller
+        shadow = controller.shadow_paradigm.trait_get()
+        revision = controller.paradigm_revision
+        controller.apply()
+        self.assertEqual(controller.paradigm_revision, revision)
+        self.assertEqual(controller.shadow_paradigm.trait_get(), shadow)
+
+    def test_phase_times(self):
+        subject = RandomSubject([True], seed=1)
+        simulator = Simulator(TimedController(), SimulatedParadigm(), subject)
+        try:
+            simulator.run(3)
+            trial_log = simulator.data.trial_log
+            self.assertTrue('time_log_trial' not in trial_log.dtype.names)
+            self.assertTrue(all(trial_log.col('time_hardware') >= 0.001))
+            self.assertTrue(all(trial_log.col('time_notify') <
+                                trial_log.col('time_hardware')))
+            # Values are drawn from the level sequence once it is created
+            self.assertEqual(trial_log.col('time_select')[0], 0)
+            self.assertTrue(all(trial_log.col('time_select')[1:] > 0))
+
+            summary = simulator.controller.get_phase_summary()
+            self.assertEqual(summary['hardware']['n'], 3)
+            self.assertTrue(summary['total']['p50'] >=
+                            summary['hardware']['p50'])
+        finally:
+            simulator.close()
+
+    def test_lookahead(self):
+        subject = RandomSubject([True], seed=1)
+        controller = SimulatedController(lookahead=2)
+        simulator = Simulator(controller, SimulatedParadigm(), subject)
+        try:
+            simulator.run(8)
+            # Two trials are planned after each trial is logged and the next
+            # trial is committed when the context is refreshed.
+            self.assertEqual(len(controller.planner), 1)
+            levels = simulator.data.trial_log.col('level')
+            np.testing.assert_array_equal(levels, [0, 10, 20, 30, 40, 50, 0,
+                                                   10])
+            self.assertEqual(controller.get_phase_summary()['plan']['n'], 8)
+        finally:
+            simulator.close()
+
+    def test_random_subject(self):
+        subject = RandomSubject([True, False], p=[1, 0], seed=1)
+        self.assertEqual(subject.respond({}), {'response': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+
+from experiment.simulate import Simulator, RandomSubject
+from experiment.timing import clock
+from experiment.trial_engine import TrialEngine, GUIUpdater
+from experiment.tests.test_simulate import (SimulatedController,
+                                            SimulatedParadigm)
+
+
+class Recorder(object):
+
+    gui_updater = None
+
+    def __init__(self):
+        self.calls = []
+
+    def record(self, value):
+        self.calls.append(value)
+
+
+class TestTrialEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatched = []
+        self.simulator = Simulator(SimulatedController(), SimulatedParadigm(),
+                                   RandomSubject([True], seed=1))
+        self.engine = TrialEngine(self.simulator.controller,
+                                  dispatch=self.dispatched.append)
+
+    def tearDown(self):
+        self.engine.close()
+        self.simulator.close()
+
+    def test_trials(self):
+        self.engine.start()
+        for i in range(5):
+            self.engine.submit('evaluate_pending_expressions')
+            self.engine.submit('log_trial', response=True)
+            self.engine.submit('next_trial')
+        self.engine.join()
+        self.assertEqual(len(self.simulator.data.trial_log), 5)
+
+        # The updates to the context list are coalesced until the GUI runs the
+        # pending updates.
+        controller = self.simulator.controller
+        self.assertEqual(len(self.dispatched), 1)
+        self.assertEqual(controller.current_context_list, [])
+        self.dispatched[0]()
+        names = [r[0] for r in controller.current_context_list]
+        self.assertEqual(names, ['frequency', 'level'])
+
+        summary = self.engine.get_summary()
+        self.assertEqual(summary['commands']['log_trial']['n'], 5)
+        self.assertEqual(summary['latency']['n'], 16)
+        # Context list, state, current trial and trial log
+        self.assertEqual(summary['gui_updates'], 4)
+        self.assertTrue(summary['gui_updates_coalesced'] > 0)
+
+    def test_gui_listeners(self):
+        # Listeners to the controller and data run when the GUI runs the
+        # pending updates rather than on the engine thread
+        controller = self.simulator.controller
+        data = self.simulator.data
+        state, trial, record = Recorder(), Recorder(), Recorder()
+        controller.on_trait_change(state.record, 'state')
+        controller.on_trait_change(trial.record, 'current_trial')
+        data.on_trait_change(record.record, 'trial_log_updated')
+        self.engine.start()
+        for i in range(3):
+            self.engine.submit('log_trial', response=True)
+            self.engine.submit('next_trial')
+        self.engine.join()
+        self.assertEqual(state.calls + trial.calls + record.calls, [])
+        self.assertEqual(controller.state, 'running')
+        self.assertEqual(controller.current_trial, 4)
+
+        # Only the most recent change of each trait is notified, but every
+        # logged trial is delivered
+        self.dispatched.pop()()
+        self.assertEqual(state.calls, ['running'])
+        self.assertEqual(trial.calls, [4])
+        self.assertEqual([r.level[0] for r in record.calls], [0, 10, 20])
+
+        # Once the engine is closed, listeners are notified immediately
+        self.engine.close()
+        self.assertTrue(data.gui_updater is None)
+        controller.next_trial()
+        self.assertEqual(trial.calls, [4, 5])
+
+    def test_close(self):
+        self.engine.close()
+        self.assertTrue(self.simulator.controller.gui_updater is None)
+        self.assertRaises(ValueError, self.engine.submit, 'next_trial')
+
+
+class TestScheduling(unittest.TestCase):
+
+    def test_submit_at(self):
+        recorder = Recorder()
+        engine = TrialEngine(recorder, dispatch=lambda f: f())
+        now = clock()
+        engine.submit_at(now+0.05, 'record', 'late')
+        engine.submit_at(now+0.01, 'record', 'early')
+        engine.submit('record', 'now')
+        engine.close()
+        self.assertEqual(recorder.calls, ['now', 'early', 'late'])
+        self.assertEqual(engine.get_summary()['commands']['record']['n'], 3)
+
+    def test_error(self):
+        engine = TrialEngine(Recorder(), dispatch=lambda f: f())
+        # Both commands are queued before the first one fails
+        due = clock() + 0.05
+        engine.submit_at(due, 'missing')
+        engine.submit_at(due, 'record', 1)
+        self.assertRaises(AttributeError, engine.join)
+        self.assertRaises(AttributeError, engine.submit, 'record', 2)
+        self.assertEqual(engine.controller.calls, [])
+
+    def test_gui_updater(self):
+        dispatched = []
+        updater = GUIUpdater(dispatched.append)
+        values = []
+        for i in range(3):
+            updater.post('a', values.append, i)
+        updater.post('b', values.append, 'b')
+        dispatched[0]()
+        self.assertEqual(values, [2, 'b'])
+        self.assertEqual(updater.coalesced, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+
+import numpy as np
+import tables
+
+from experiment.abstract_data import AbstractData
+from experiment.rig import MemoryBudget
+from experiment.trial_summary import (TrialColumns, CountBy, RateBy,
+                                      SlidingRate)
+
+
+class TestTrialColumns(unittest.TestCase):
+
+    def test_grow(self):
+        dtype = np.dtype([('level', 'f'), ('window', '2f')])
+        columns = TrialColumns(dtype, capacity=2)
+        self.assertEqual(columns.last('level'), None)
+        for i in range(5):
+            columns.append(np.array((i, (i, i+1)), dtype=dtype))
+        self.assertEqual(len(columns), 5)
+        np.testing.assert_array_equal(columns['level'], range(5))
+        np.testing.assert_array_equal(columns.last('window'), [4, 5])
+        self.assertRaises(ValueError, columns['level'].__setitem__, 0, 1)
+
+
+class TestAggregates(unittest.TestCase):
+
+    def setUp(self):
+        self.fh = tables.open_file('trial_summary', 'w', driver='H5FD_CORE',
+                                   driver_core_backing_store=0)
+        self.data = AbstractData(store_node=self.fh.root)
+        self.data.register_dtypes([('ttype', 'S8'), ('level', 'i'),
+                                   ('yes', 'b')])
+        self.trials = [('GO', 10, 0), ('GO', 20, 1), ('NOGO', 0, 1),
+                       ('GO', 20, 1), ('GO', 10, 1), ('NOGO', 0, 0)]
+
+    def tearDown(self):
+        self.fh.close()
+
+    def log(self, trials):
+        for ttype, level, yes in trials:
+            self.data.log_trial(ttype=ttype, level=level, yes=yes)
+
+    def test_aggregates(self):
+        self.data.register_aggregate('ttype', CountBy('ttype'))
+        hit_rate = RateBy('yes', 'level', where=lambda r: r['ttype'] == 'GO')
+        self.data.register_aggregate('hit_rate', hit_rate)
+        recent = SlidingRate('yes', 2)
+        self.data.register_aggregate('recent', recent)
+
+        self.log(self.trials)
+        self.assertEqual(self.data.aggregates['ttype'].as_dict(),
+                         {'GO': 4, 'NOGO': 2})
+        self.assertEqual(hit_rate.keys, [10, 20])
+        self.assertEqual(hit_rate.rates, [0.5, 1.0])
+        self.assertEqual(recent.rate, 0.5)
+        np.testing.assert_array_equal(self.data.get_column('yes'),
+                                      [0, 1, 1, 1, 1, 0])
+        self.assertEqual(self.data.trial_columns.last('ttype'), 'NOGO')
+
+    def test_trial_log_updated(self):
+        records = []
+        self.data.on_trait_change(lambda r: records.append(r),
+                                  'trial_log_updated')
+        self.log(self.trials[:1])
+        self.assertEqual(records[0].ttype, ['GO'])
+        self.assertEqual(records[0].level, [10])
+
+    def test_register_after_logging(self):
+        self.log(self.trials[:3])
+        counts = CountBy('ttype')
+        self.data.register_aggregate('ttype', counts)
+        self.log(self.trials[3:])
+        self.assertEqual(counts.counts, [4, 2])
+
+    def test_memory_exhausted(self):
+        # The trials are still logged and aggregated once the columns can no
+        # longer grow
+        fh = tables.open_file('trial_summary_budget', 'w', driver='H5FD_CORE',
+                              driver_core_backing_store=0)
+        budget = MemoryBudget(1e6)
+        data = AbstractData(store_node=fh.root, memory_budget=budget)
+        data.register_dtypes([('ttype', 'S8'), ('level', 'i'), ('yes', 'b')])
+        budget.max_bytes = budget.used
+        counts = CountBy('ttype')
+        data.register_aggregate('ttype', counts)
+        updated = []
+        data.on_trait_change(lambda: updated.append(True), 'trial_log_updated')
+        n = 300
+        for i in range(n):
+            data.log_trial(ttype='GO', level=i, yes=1)
+        self.assertTrue(data.trial_columns is None)
+        self.assertEqual(len(data.trial_log), n)
+        self.assertEqual(counts.counts, [n])
+        self.assertEqual(len(updated), n)
+        np.testing.assert_array_equal(data.get_column('level'), range(n))
+        self.assertTrue(budget.used < budget.max_bytes)
+        fh.close()
+
+
+class TestQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.fh = tables.open_file('query', 'w', driver='H5FD_CORE',
+                                   driver_core_backing_store=0)
+        self.data = AbstractData(store_node=self.fh.root,
+                                 trial_log_indexes=['ttype', 'missing'])
+        self.data.register_dtypes([('ttype', 'S8'), ('level', 'i'),
+                                   ('yes', 'b')])
+        for i in range(6):
+            ttype = 'GO' if i % 3 else 'NOGO'
+            self.data.log_trial(ttype=ttype, level=i*10, yes=i % 2)
+            self.data.log_event(i, 'trial_start')
+
+    def tearDown(self):
+        self.fh.close()
+
+    def test_query_trials(self):
+        trial_log = self.data.trial_log.table
+        self.assertTrue(trial_log.cols.ttype.is_indexed)
+        self.assertFalse(trial_log.cols.level.is_indexed)
+        trials = self.data.query_trials("(ttype == 'GO') & (level > 20)",
+                                        columns=['level', 'yes'])
+        self.assertEqual(trials.dtype.names, ('level', 'yes'))
+        np.testing.assert_array_equal(trials['level'], [40, 50])
+        np.testing.assert_array_equal(trials['yes'], [0, 1])
+        trials = self.data.query_trials('level < x', condvars={'x': 20})
+        self.assertEqual(list(trials['ttype']), ['NOGO', 'GO'])
+
+    def test_query_events(self):
+        self.assertTrue(self.data.event_log.table.cols.timestamp.is_indexed)
+        events = self.data.query_events('timestamp >= 4', columns=['name'])
+        self.assertEqual(list(events['name']), ['trial_start']*2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+'''
+Utilities for timing sections of code (e.g. stages of a pipeline or the phases
+of a trial)
+'''
+
+import ctypes
+import ctypes.util
+import sys
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class _timespec(ctypes.Structure):
+
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _posix_clock():
+    # clock_gettime is in librt on older versions of glibc
+    if sys.platform.startswith('linux'):
+        clock_id = 1
+    elif sys.platform == 'darwin':
+        clock_id = 6
+    else:
+        return None
+    for name in ('rt', 'c'):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        break
+    else:
+        return None
+
+    def clock():
+        t = _timespec()
+        if clock_gettime(clock_id, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'clock_gettime failed')
+        return t.tv_sec + t.tv_nsec*1e-9
+
+    try:
+        clock()
+    except OSError:
+        return None
+    return clock
+
+
+# Monotonic (i.e. not affected by changes to the system time).  On Python 2,
+# `time.clock` is monotonic on Windows and CLOCK_MONOTONIC is read using
+# ctypes on Linux and OS X.  `time.time` is only used if neither is available.
+if hasattr(time, 'monotonic'):
+    clock = time.monotonic
+elif sys.platform == 'win32':
+    clock = time.clock
+else:
+    clock = _posix_clock() or time.time
+
+
+class LatencyStats(object):
+    '''
+    Tracks the count and cumulative duration of an operation along with the
+    most recent durations so that percentiles can be computed on demand.
+
+    Parameters
+    ----------
+    maxlen : int
+        Number of recent durations retained for computing percentiles.
+    '''
+
+    def __init__(self, maxlen=1000):
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = deque(maxlen=maxlen)
+
+    def add(self, duration):
+        self.n += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        self._recent.append(duration)
+
+    def percentile(self, q):
+        if not self._recent:
+            return np.nan
+        return np.percentile(self._recent, q)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        '''
+        Return dictionary containing n, total, mean, max and the requested
+        percentiles (e.g. p50) of the recent durations.
+        '''
+        result = {
+            'n': self.n,
+            'total': self.total,
+            'mean': self.total/self.n if self.n else np.nan,
+            'max': self.max,
+        }
+        if self._recent:
+            values = np.percentile(self._recent, percentiles)
+        else:
+            values = [np.nan]*len(percentiles)
+        for q, value in zip(percentiles, values):
+            result['p{}'.format(q)] = value
+        return result
+
+
+class PhaseTimer(object):
+    '''
+    Tracks the time spent in each phase of a trial
+
+    Phases can be nested (e.g. the setters called while the context is
+    evaluated).  Time spent in a nested phase only counts towards the nested
+    phase, so the durations of the phases add up to the time spent in all
+    phases.
+
+        >>> with timer.phase('evaluate'):
+        ...     with timer.phase('notify'):
+        ...         pass
+        >>> durations = timer.end_trial()
+
+    Parameters
+    ----------
+    phases : list of str
+        Phases that are included in the summary of each trial (with a duration
+        of 0 if the phase did not run).  Other phases are added as they are
+        timed.
+    maxlen : int
+        Number of recent trials retained for computing percentiles.
+    '''
+
+    def __init__(self, phases, maxlen=1000):
+        self.phases = list(phases)
+        self.stats = OrderedDict((p, LatencyStats(maxlen)) for p in phases)
+        self.total = LatencyStats(maxlen)
+        self._maxlen = maxlen
+        self._nested = []
+        self.durations = dict.fromkeys(self.phases, 0.0)
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Add the time spent in the block to the duration of the phase for the
+        current trial
+        '''
+        self._nested.append(0.0)
+        start = clock()
+        try:
+            yield
+        finally:
+            elapsed = clock()-start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            self.durations[name] = self.durations.get(name, 0.0) + \
+                elapsed - nested
+
+    def end_trial(self):
+        '''
+        Add the durations of the current trial to the statistics and start a
+        new trial
+
+        Returns
+        -------
+        durations : dict
+            Time spent in each phase during the trial.
+        '''
+        durations = self.durations
+        self.durations = dict.fromkeys(self.phases, 0.0)
+        for name, duration in durations.items():
+            if name not in self.stats:
+                self.stats[name] = LatencyStats(self._maxlen)
+            self.stats[name].add(duration)
+        self.total.add(sum(durations.values()))
+        return durations
+
+    def summary(self, percentiles=(50, 90, 99)):
+        '''
+        Return a dictionary with the summary of the per-trial durations of each
+        phase and of the total (see `LatencyStats.summary`)
+        '''
+        result = OrderedDict((n, s.summary(percentiles))
+                             for n, s in self.stats.items())
+        result['total'] = self.total.summary(percentiles)
+        return result
@@ -0,0 +1,279 @@
+'''
+Runs the trial logic of a controller on a dedicated thread
+
+By default, all controller logic (e.g. `next_trial`, evaluating the context,
+`log_trial` and writing to the HDF5 file) runs in trait handlers on the GUI
+thread, so a slow redraw delays the next trial.  `TrialEngine` instead runs
+the controller methods on its own thread.  Commands (e.g. from the GUI buttons
+or hardware callbacks) are queued and executed in order:
+
+    >>> engine = TrialEngine(controller)
+    >>> engine.start()
+    >>> engine.submit('log_trial', response='yes')
+    >>> engine.submit('next_trial')
+    >>> engine.submit_at(clock()+0.5, 'start_trial')
+    >>> engine.close()
+
+Updates to the GUI made by the controller while running on the engine thread
+are passed to a `GUIUpdater`, which runs them on the GUI thread.  This includes
+the listeners to the trial and event logs of the data and to the controller
+traits set using `AbstractController.set_gui_trait` (e.g. `state`).  Only the
+most recent update for each key is run, so a burst of trials results in a
+single redraw (the listeners to the logs still receive every record).
+
+The engine tracks the scheduling latency of each command (i.e. the time from
+when the command was due, either when submitted or the time passed to
+`submit_at`, to when it started running) as well as the time spent running
+each command (see `get_summary`).
+
+Since PyTables is not thread-safe, the data file should only be accessed from
+the engine thread once the engine is running.
+'''
+
+import heapq
+import itertools
+import sys
+import threading
+import time
+import Queue
+from collections import OrderedDict
+
+import logging
+log = logging.getLogger(__name__)
+
+from .timing import clock, LatencyStats
+
+
+_SENTINEL = object()
+
+
+def _invoke_later(function):
+    # Imported here so that the GUI toolkit is only loaded when needed
+    from pyface.api import GUI
+    GUI.invoke_later(function)
+
+
+class GUIUpdater(object):
+    '''
+    Coalesces updates to the GUI and runs them on the GUI thread
+
+    Parameters
+    ----------
+    dispatch : {None, callable}
+        Function that runs the function passed to it on the GUI thread.  If
+        None, `pyface.api.GUI.invoke_later` is used.  Pass a function that
+        calls its argument directly to run updates synchronously (e.g. when
+        there is no GUI).
+    '''
+
+    def __init__(self, dispatch=None):
+        if dispatch is None:
+            dispatch = _invoke_later
+        self.dispatch = dispatch
+        self.posted = 0
+        self.run = 0
+        self._pending = OrderedDict()
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def post(self, key, function, *args, **kwargs):
+        '''
+        Schedule a call to `function` on the GUI thread
+
+        If an update with the same key is still pending, it is replaced (i.e.
+        only the most recent update for each key is run).
+        '''
+        with self._lock:
+            self.posted += 1
+            self._pending.pop(key, None)
+            self._pending[key] = function, args, kwargs
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.dispatch(self.flush)
+
+    def _take_pending(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = OrderedDict()
+            self._scheduled = False
+        return pending.items()
+
+    def _run_update(self, key, function, args, kwargs):
+        try:
+            function(*args, **kwargs)
+        except Exception:
+            log.exception('Error updating GUI (%s)', key)
+        self.run += 1
+
+    def flush(self):
+        '''
+        Run the pending updates (called on the GUI thread)
+        '''
+        for key, (function, args, kwargs) in self._take_pending():
+            self._run_update(key, function, args, kwargs)
+
+    @property
+    def coalesced(self):
+        '''
+        Number of updates that were replaced by a more recent update
+        '''
+        with self._lock:
+            return self.posted - self.run - len(self._pending)
+
+
+class TrialEngine(object):
+    '''
+    Runs the methods of a controller on a dedicated thread
+
+    Parameters
+    ----------
+    controller : AbstractController
+        Controller whose methods are run by the engine.  While the engine is
+        running, `controller.gui_updater` is set to the engine's `GUIUpdater`.
+    dispatch : {None, callable}
+        See `GUIUpdater`.
+    maxlen : int
+        Number of recent latencies retained for computing percentiles.
+    gui_updater : {None, GUIUpdater}
+        Updater to pass the GUI updates to (e.g. one shared by several
+        engines).  If None, a new `GUIUpdater` is created using `dispatch`.
+    name : str
+        Name of the engine thread.
+    '''
+
+    def __init__(self, controller, dispatch=None, maxlen=1000,
+                 gui_updater=None, name='TrialEngine'):
+        self.controller = controller
+        if gui_updater is None:
+            gui_updater = GUIUpdater(dispatch)
+        self.gui_updater = gui_updater
+        self.latency = LatencyStats(maxlen)
+        self.stats = OrderedDict()
+        self._maxlen = maxlen
+        self._queue = Queue.Queue()
+        self._scheduled = []
+        self._counter = itertools.count()
+        self._exc_info = None
+        self._closed = False
+        controller.gui_updater = self.gui_updater
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self._scheduled:
+                timeout = max(0, self._scheduled[0][0]-clock())
+            try:
+                command = self._queue.get(timeout=timeout)
+            except Queue.Empty:
+                command = None
+            if command is _SENTINEL:
+                # Run the remaining scheduled commands before exiting
+                while self._scheduled:
+                    time.sleep(max(0, self._scheduled[0][0]-clock()))
+                    self._execute(heapq.heappop(self._scheduled))
+                self._queue.task_done()
+                return
+            if command is not None:
+                due = command[0]
+                if due > clock():
+                    heapq.heappush(self._scheduled, command)
+                else:
+                    self._execute(command)
+            while self._scheduled and self._scheduled[0][0] <= clock():
+                self._execute(heapq.heappop(self._scheduled))
+
+    def _execute(self, command):
+        due, i, name, args, kwargs = command
+        start = clock()
+        self.latency.add(start-due)
+        try:
+            # Once a command has failed, the controller may be in an undefined
+            # state so the remaining commands are discarded.
+            if self._exc_info is None:
+                getattr(self.controller, name)(*args, **kwargs)
+        except Exception:
+            log.exception('Error running %s', name)
+            self._exc_info = sys.exc_info()
+        finally:
+            if name not in self.stats:
+                self.stats[name] = LatencyStats(self._maxlen)
+            self.stats[name].add(clock()-start)
+            self._queue.task_done()
+
+    def _raise_engine_error(self):
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_tb = self._exc_info
+            raise exc_type, exc_value, exc_tb
+
+    def submit_at(self, due, name, *args, **kwargs):
+        '''
+        Run the controller method `name` once `clock()` reaches `due`
+
+        Commands that are due at the same time run in the order they were
+        submitted.
+        '''
+        self._raise_engine_error()
+        if self._closed:
+            raise ValueError('Cannot submit to a closed engine')
+        self._queue.put((due, next(self._counter), name, args, kwargs))
+
+    def submit(self, name, *args, **kwargs):
+        '''
+        Run the controller method `name` as soon as possible
+        '''
+        self.submit_at(clock(), name, *args, **kwargs)
+
+    def start(self, info=None):
+        self.submit('start', info)
+
+    def pause(self, info=None):
+        self.submit('pause', info)
+
+    def resume(self, info=None):
+        self.submit('resume', info)
+
+    def stop(self, info=None):
+        self.submit('stop', info)
+
+    def join(self):
+        '''
+        Wait until all submitted commands (including the scheduled ones) have
+        run
+        '''
+        self._queue.join()
+        self._raise_engine_error()
+
+    def close(self):
+        '''
+        Wait for the submitted commands to run and stop the engine thread
+        '''
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_SENTINEL)
+            self._thread.join()
+            if self.controller.gui_updater is self.gui_updater:
+                self.controller.gui_updater = None
+        self._raise_engine_error()
+
+    def get_summary(self, percentiles=(50, 90, 99)):
+        '''
+        Return a dictionary with the scheduling latency, the time spent running
+        each command (see `LatencyStats.summary`), the number of GUI updates
+        that were coalesced and the time spent in each phase of the trial (see
+        `AbstractController.get_phase_summary`)
+        '''
+        commands = OrderedDict((n, s.summary(percentiles))
+                               for n, s in self.stats.items())
+        summary = {
+            'latency': self.latency.summary(percentiles),
+            'commands': commands,
+            'gui_updates': self.gui_updater.run,
+            'gui_updates_coalesced': self.gui_updater.coalesced,
+        }
+        if hasattr(self.controller, 'get_phase_summary'):
+            summary['phases'] = self.controller.get_phase_summary(percentiles)
+        return summary
@@ -29,25 +29,39 @@ class TrialSetting(HasTraits):
         string = ', '.join('{}={}'.format(k, v) for k, v in self.items())
         return '<TrialSetting::{}>'.format(string)
 
+    def _anytrait_changed(self, name, old, new):
+        if name in self._parameters:
+            self._key = None
+
+    def key(self):
+        '''
+        Tuple of the parameter values used for sorting and comparison (cached
+        until one of the values changes)
+        '''
+        key = self.__dict__.get('_key')
+        if key is None:
+            key = self._key = tuple(getattr(self, p) for p in self._parameters)
+        return key
+
     def __lt__(self, other):
         if not isinstance(other, TrialSetting):
             return NotImplemented
-        return self.values() < other.values()
+        return self.key() < other.key()
 
     def __ge__(self, other):
         if not isinstance(other, TrialSetting):
             return NotImplemented
-        return self.values() > other.values()
+        return self.key() > other.key()
 
     def __eq__(self, other):
         if not isinstance(other, TrialSetting):
             return NotImplemented
-        return self.values() == other.values()
+        return self.key() == other.key()
 
     def __ne__(self, other):
         if not isinstance(other, TrialSetting):
             return NotImplemented
-        return self.values() != other.values()
+        return self.key() != other.key()
 
     def values(self):
         return [getattr(self, p) for p in self._parameters]
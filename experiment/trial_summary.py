@@ -0,0 +1,280 @@
+'''
+In-memory summaries of the trial log
+
+`TrialColumns` mirrors the trial log as one growable NumPy array per column so
+that controllers can look up recent values (e.g. the response on the last
+trial) without reading the table.
+
+Aggregates are updated incrementally as each trial is logged, so summary
+statistics do not require rescanning the trial log.  They are registered with
+`AbstractData.register_aggregate`:
+
+    >>> data.register_aggregate('ttype_count', CountBy('ttype'))
+    >>> data.register_aggregate('hit_rate',
+    ...                         RateBy('yes', 'level',
+    ...                                where=lambda r: r['ttype'] == 'GO'))
+    >>> data.register_aggregate('recent_fa',
+    ...                         SlidingRate('yes', 10,
+    ...                                     where=lambda r: r['ttype'] == 'NOGO'))
+
+Aggregates are `HasTraits` objects, so plots can listen to them directly (e.g.
+a `DynamicBarPlot` with `source=data.aggregates['hit_rate']`,
+`value_trait='rates'` and a `DynamicBarplotAxis` with `label_trait='keys'`).
+'''
+
+from bisect import bisect_left
+from collections import deque
+
+import numpy as np
+from traits.api import (HasTraits, Str, Int, Float, Dict, List, Trait,
+                        Callable, Event)
+
+
+def _key(value):
+    # Convert NumPy values to hashable Python values
+    if isinstance(value, np.ndarray):
+        return tuple(value.tolist())
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class TrialColumns(object):
+    '''
+    Growable per-column arrays containing the logged trials
+
+    Parameters
+    ----------
+    dtype : np.dtype
+        Structured dtype of the trial log.
+    capacity : int
+        Initial number of trials to allocate space for.  The capacity is
+        doubled as needed.
+    reserve : {None, callable}
+        If provided, called with the total number of bytes needed before the
+        arrays are allocated (e.g. to reserve memory from a
+        `experiment.rig.MemoryBudget`).  The arrays are not grown if it raises
+        an exception.
+    '''
+
+    def __init__(self, dtype, capacity=256, reserve=None):
+        self.dtype = np.dtype(dtype)
+        self.names = self.dtype.names
+        self._capacity = capacity
+        self._reserve = reserve
+        self._n = 0
+        if reserve is not None:
+            reserve(capacity*self.dtype.itemsize)
+        self._arrays = dict((n, np.empty(capacity, self.dtype.fields[n][0]))
+                            for n in self.names)
+
+    def _grow(self):
+        if self._reserve is not None:
+            self._reserve(self._capacity*2*self.dtype.itemsize)
+        self._capacity *= 2
+        for name, old in self._arrays.items():
+            new = np.empty((self._capacity,)+old.shape[1:], dtype=old.dtype)
+            new[:self._n] = old[:self._n]
+            self._arrays[name] = new
+
+    def append(self, record):
+        '''
+        Append a trial (e.g. a row of a structured array)
+        '''
+        if self._n == self._capacity:
+            self._grow()
+        for name in self.names:
+            self._arrays[name][self._n] = record[name]
+        self._n += 1
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, name):
+        '''
+        Return the values of the column for all trials
+
+        The array is a read-only view that is not updated when trials are
+        appended.
+        '''
+        view = self._arrays[name][:self._n]
+        view.flags.writeable = False
+        return view
+
+    def last(self, name, default=None):
+        '''
+        Return the value of the column on the most recent trial (or default if
+        no trials have been logged)
+        '''
+        if self._n == 0:
+            return default
+        return self._arrays[name][self._n-1]
+
+
+class Aggregate(HasTraits):
+    '''
+    Summary of the trial log that is updated as each trial is logged
+
+    Parameters
+    ----------
+    where : {None, callable}
+        If provided, only trials for which `where(record)` is True are
+        included.
+    '''
+
+    where = Trait(None, Callable)
+
+    # Fired after the aggregate is updated
+    updated = Event
+
+    def update(self, record):
+        if self.where is None or self.where(record):
+            self._update(record)
+            self.updated = True
+
+    def _update(self, record):
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+
+class _KeyedAggregate(Aggregate):
+
+    # Name of the column the trials are grouped by
+    by = Str
+
+    # Sorted list of the values of `by`.  Lists are reassigned (rather than
+    # modified in place) on each update so that listeners see a single change.
+    keys = List
+
+    def _index(self, record):
+        key = _key(record[self.by])
+        i = bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            self._insert(i, key)
+        return i
+
+    def _insert(self, i, key):
+        self.keys = self.keys[:i] + [key] + self.keys[i:]
+
+
+class CountBy(_KeyedAggregate):
+    '''
+    Number of trials for each value of a column
+
+    Attributes
+    ----------
+    keys : list
+        Values of the column (sorted).
+    counts : list
+        Number of trials for each value in `keys`.
+    '''
+
+    counts = List(Int)
+
+    def __init__(self, by, **kwargs):
+        super(CountBy, self).__init__(by=by, **kwargs)
+
+    def _insert(self, i, key):
+        self.counts = self.counts[:i] + [0] + self.counts[i:]
+        super(CountBy, self)._insert(i, key)
+
+    def _update(self, record):
+        i = self._index(record)
+        counts = self.counts[:]
+        counts[i] += 1
+        self.counts = counts
+
+    def reset(self):
+        self.keys = []
+        self.counts = []
+
+    def as_dict(self):
+        return dict(zip(self.keys, self.counts))
+
+
+class RateBy(_KeyedAggregate):
+    '''
+    Mean of a column (e.g. fraction of trials with a response) for each value
+    of another column
+
+    Attributes
+    ----------
+    keys : list
+        Values of `by` (sorted).
+    counts : list
+        Number of trials for each value in `keys`.
+    rates : list
+        Mean of `column` for each value in `keys`.
+    '''
+
+    column = Str
+    counts = List(Int)
+    totals = List(Float)
+    rates = List(Float)
+
+    def __init__(self, column, by, **kwargs):
+        super(RateBy, self).__init__(column=column, by=by, **kwargs)
+
+    def _insert(self, i, key):
+        self.counts = self.counts[:i] + [0] + self.counts[i:]
+        self.totals = self.totals[:i] + [0.0] + self.totals[i:]
+        self.rates = self.rates[:i] + [np.nan] + self.rates[i:]
+        super(RateBy, self)._insert(i, key)
+
+    def _update(self, record):
+        i = self._index(record)
+        counts, totals, rates = self.counts[:], self.totals[:], self.rates[:]
+        counts[i] += 1
+        totals[i] += float(record[self.column])
+        rates[i] = totals[i]/counts[i]
+        self.counts, self.totals, self.rates = counts, totals, rates
+
+    def reset(self):
+        self.keys = []
+        self.counts = []
+        self.totals = []
+        self.rates = []
+
+    def as_dict(self):
+        return dict(zip(self.keys, self.rates))
+
+
+class SlidingRate(Aggregate):
+    '''
+    Mean of a column over the most recent trials
+
+    Attributes
+    ----------
+    rate : float
+        Mean of `column` over the last `window` trials (NaN if no trials have
+        been included yet).
+    n : int
+        Number of trials in the window.
+    '''
+
+    column = Str
+    window = Int
+    rate = Float(np.nan)
+    n = Int(0)
+
+    def __init__(self, column, window, **kwargs):
+        super(SlidingRate, self).__init__(column=column, window=window,
+                                          **kwargs)
+        self.reset()
+
+    def _update(self, record):
+        value = float(record[self.column])
+        if len(self._values) == self.window:
+            self._total -= self._values[0]
+        self._values.append(value)
+        self._total += value
+        self.n = len(self._values)
+        self.rate = self._total/self.n
+
+    def reset(self):
+        self._values = deque(maxlen=self.window)
+        self._total = 0.0
+        self.n = 0
+        self.rate = np.nan
@@ -1,8 +1,8 @@
 import cPickle as pickle
-from pyface.api import FileDialog, OK
 
 
 def get_save_file(path, wildcard):
+    from pyface.api import FileDialog, OK
     wildcard_base = wildcard.split('|')[1][1:]
     fd = FileDialog(action='save as', default_directory=path, wildcard=wildcard)
     if fd.open() == OK and fd.path:
@@ -13,6 +13,7 @@ def get_save_file(path, wildcard):
 
 
 def load_instance(path, wildcard):
+    from pyface.api import FileDialog, OK
     fd = FileDialog(action='open', default_directory=path, wildcard=wildcard)
     if fd.open() == OK and fd.path:
         with open(fd.path, 'rb') as infile: